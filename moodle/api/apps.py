@@ -4,3 +4,18 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.conf import settings
+
+        from services import debug_capture, tenants, upstream
+        from .sessions import redis_client
+
+        debug_capture.configure(
+            settings.DEBUG_CAPTURE_DIR,
+            sample_rate=settings.DEBUG_CAPTURE_SAMPLE_RATE,
+            max_files=settings.DEBUG_CAPTURE_MAX_FILES,
+        )
+        tenants.configure(settings.MOODLE_TENANTS, default=settings.MOODLE_DEFAULT_TENANT)
+        # Rate limits are shared by all the workers through Redis
+        upstream.configure(redis_client(), key_prefix=settings.CACHES['default'].get('KEY_PREFIX', ''))
@@ -0,0 +1,280 @@
+# api/async_views.py
+# Async versions of the Moodle endpoints, served under /api/async/. Under an
+# ASGI server (moodle/asgi.py) a request waiting on Moodle does not hold a
+# worker thread; only parsing and database work run in threads.
+import asyncio
+import json
+import logging
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from services.login import alogin
+from services.webservice import get_token as get_webservice_token
+from .catalog_cache import aenrolled_in, aget_catalog, aget_catalog_entry
+from .catalog_store import stored_categories, stored_chapters, stored_courses
+from .course_bundle import astream_course_bundle, bundle_filename, course_resources
+from .notifications import async_notifications
+from .resource_cache import aserve_resource
+from .responses import archive_response, conditional_data_response
+from .sessions import (
+    aget_session, arequest_university, login_key, moodle_backend, remember_login, reusable_session, session_pool,
+    store_session, store_webservice_token,
+)
+from .tasks import enqueue_webhooks
+
+logger = logging.getLogger(__name__)
+
+
+def _invalid_session():
+    return JsonResponse({'error': 'Invalid or expired session'}, status=401)
+
+
+def _unknown_university():
+    return JsonResponse({'error': 'Unknown university'}, status=400)
+
+
+def _not_stored():
+    return JsonResponse({'error': 'Not in the catalog store yet'}, status=404)
+
+
+@csrf_exempt
+@require_POST
+async def login(request):
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        data = request.POST
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return JsonResponse({'error': 'Missing credentials'}, status=400)
+
+    university = await arequest_university(request, requested=data.get('university'))
+    if university is None:
+        return _unknown_university()
+
+    # Reuse the session of a previous login with the same credentials while
+    # Moodle still has it logged in
+    reuse_key = login_key(username, password, university)
+    session_token, cookies_json = await sync_to_async(reusable_session, thread_sensitive=False)(
+        reuse_key, university
+    )
+
+    if cookies_json is None:
+        cookies_json = await alogin(username, password, university)
+
+        if cookies_json in ("Login failed", None):
+            return JsonResponse({'error': 'Login failed'}, status=401)
+
+        # The token of the previous login is kept, now with fresh cookies
+        session_token = session_token or str(uuid.uuid4())
+
+        if moodle_backend(university) == 'webservice':
+            # The password is only available now, request the web service token
+            try:
+                ws_token = await asyncio.to_thread(
+                    get_webservice_token, session_pool.get(session_token, cookies_json), username, password,
+                    university, settings.MOODLE_WEBSERVICE_NAME,
+                )
+                await sync_to_async(store_webservice_token, thread_sensitive=False)(
+                    session_token, ws_token, university
+                )
+            except Exception as e:
+                logger.warning(f"Could not obtain a web service token, scraping instead: {e}")
+
+    await sync_to_async(store_session, thread_sensitive=False)(session_token, cookies_json, university)
+    await sync_to_async(remember_login, thread_sensitive=False)(reuse_key, session_token)
+
+    return JsonResponse({
+        'session_token': session_token,
+        'cookies': cookies_json,
+        'notifications': {},
+    })
+
+
+@require_GET
+async def fetch_category(request):
+    token = request.GET.get('session_token')
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    # Categories are public, fall back to an anonymous session
+    session = await aget_session(token, allow_anonymous=True)
+
+    entry = await aget_catalog_entry('categories', session, university, token)
+    return conditional_data_response(request, entry['data'], entry['etag'], private=False)
+
+
+@require_GET
+async def fetch_courses(request):
+    token = request.GET.get('session_token')
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    id = request.GET.get('id')
+    if id:
+        entry = await aget_catalog_entry('courses', session, university, token, id)
+    else:
+        # Without a category, list the courses the user is enrolled in
+        entry = await aget_catalog_entry('enrolled', session, university, token)
+    return conditional_data_response(request, entry['data'], entry['etag'])
+
+
+@require_GET
+async def fetch_chapters(request):
+    token = request.GET.get('session_token')
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    id = request.GET.get('id')
+    entry = await aget_catalog_entry('chapters', session, university, token, id)
+    return conditional_data_response(request, entry['data'], entry['etag'])
+
+
+@require_GET
+async def catalog_categories(request):
+    token = request.GET.get('session_token')
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    entry = await sync_to_async(stored_categories)(university)
+    if entry is None:
+        return _not_stored()
+    return conditional_data_response(request, entry['data'], entry['etag'], private=False)
+
+
+@require_GET
+async def catalog_courses(request):
+    token = request.GET.get('session_token')
+    id = request.GET.get('id')
+    if not id:
+        return JsonResponse({'error': 'Missing category ID'}, status=400)
+
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    entry = await sync_to_async(stored_courses)(university, id)
+    if entry is None:
+        return _not_stored()
+    return conditional_data_response(request, entry['data'], entry['etag'])
+
+
+@require_GET
+async def catalog_chapters(request):
+    token = request.GET.get('session_token')
+    id = request.GET.get('id')
+    if not id:
+        return JsonResponse({'error': 'Missing course ID'}, status=400)
+
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    entry = None
+    if await aenrolled_in(session, university, token, id):
+        entry = await sync_to_async(stored_chapters)(university, id)
+    if entry is None:
+        entry = await aget_catalog_entry('chapters', session, university, token, id)
+    return conditional_data_response(request, entry['data'], entry['etag'])
+
+
+@require_GET
+async def fetch_resource(request):
+    token = request.GET.get('session_token')
+    resource_id = request.GET.get('id')
+
+    if not token or not resource_id:
+        return JsonResponse({'error': 'Missing session token or resource ID'}, status=400)
+
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    # Serve the file from the blob store, or stream it from Moodle
+    response = await aserve_resource(request, session, resource_id, university)
+    if response is None:
+        return JsonResponse({'error': 'Could not retrieve the resource'}, status=404)
+    return response
+
+
+@require_GET
+async def fetch_course_bundle(request):
+    token = request.GET.get('session_token')
+    course_id = request.GET.get('id')
+
+    if not token or not course_id:
+        return JsonResponse({'error': 'Missing session token or course ID'}, status=400)
+
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    chapters = await aget_catalog('chapters', session, university, token, course_id)
+    resources = course_resources(chapters)
+    if not resources:
+        return JsonResponse({'error': 'No files in this course'}, status=404)
+
+    return archive_response(
+        astream_course_bundle(session, resources, university), bundle_filename(chapters, course_id)
+    )
+
+
+@require_GET
+async def scrape_and_store_notifications(request):
+    token = request.GET.get('session_token')
+    if not token:
+        return JsonResponse({'error': 'Session token missing'}, status=400)
+
+    session = await aget_session(token)
+    if session is None:
+        return _invalid_session()
+    university = await arequest_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    try:
+        # Only the notifications posted since the last sync are fetched
+        notifications, new_ids = await async_notifications(session.cookies, university)
+
+        if not notifications:
+            return JsonResponse({'status': 'No new notifications found'})
+
+        # Trigger the webhook for the new notifications
+        await sync_to_async(enqueue_webhooks, thread_sensitive=False)(new_ids)
+
+        return JsonResponse({
+            'status': 'Notifications scraped and stored',
+            'notifications_count': len(new_ids),
+            'total_notifications': len(notifications)
+        })
+    except Exception as e:
+        logger.error(f"Error scraping notifications: {e}")
+        return JsonResponse({'error': f'Error scraping notifications: {str(e)}'}, status=500)
@@ -0,0 +1,381 @@
+# api/catalog_cache.py
+import hashlib
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from services.categories import aget_categories, get_categories
+from services.chapters import aget_chapters, get_chapters
+from services import webservice
+from services.ajax import AjaxClient, AsyncAjaxClient
+from services.courses import aget_courses, aget_enrolled_courses, get_courses, get_enrolled_courses
+from services.metrics import CACHE_REQUESTS, RETRIES
+from services.upstream import UPSTREAM_ERRORS
+
+from services.webservice import WebServiceError
+
+from . import singleflight
+from .sessions import get_moodle_cfg, get_session, get_webservice_client, moodle_backend, store_moodle_cfg
+
+logger = logging.getLogger(__name__)
+
+# Kinds of catalog data served through the cache
+CATALOG_KINDS = ("categories", "courses", "chapters", "enrolled")
+# Kinds also copied into the catalog tables (api/catalog_store.py)
+STORED_KINDS = ("categories", "courses", "chapters")
+
+PUBLIC_SCOPE = "public"
+USER_SCOPE = "user"
+
+# How long a stale entry may be refreshed by a single background task
+REFRESH_LOCK_TIMEOUT = 120
+
+
+def _config(kind):
+    return settings.CATALOG_CACHE[kind]
+
+
+def _version(kind):
+    """
+    Returns the generation of `kind`. Bumping it invalidates every entry of
+    that kind without scanning the keyspace.
+    """
+    version = cache.get(f"catalog_version_{kind}")
+    if version is None:
+        cache.add(f"catalog_version_{kind}", 1, timeout=None)
+        version = cache.get(f"catalog_version_{kind}", 1)
+    return version
+
+
+def _scope_key(kind, token):
+    if _config(kind)["scope"] == USER_SCOPE:
+        return f"user:{token}"
+    return PUBLIC_SCOPE
+
+
+def catalog_key(kind, university_name, token=None, object_id=None):
+    """
+    Builds the cache key of a catalog entry. Public data (e.g. the category
+    tree) is shared across users, per-user data is keyed by session token.
+    """
+    return (
+        f"catalog:{kind}:v{_version(kind)}:{university_name}:"
+        f"{_scope_key(kind, token)}:{object_id or ''}"
+    )
+
+
+def fetch_catalog(kind, session, university_name, object_id=None, token=None):
+    """
+    Fetches fresh catalog data from Moodle, bypassing the cache.
+
+    Universities configured with the web service backend (MOODLE_TENANTS)
+    are queried through webservice/rest/server.php when the user has a web
+    service token; otherwise, or if the web service call fails, the pages are
+    scraped.
+    """
+    # Enrolled courses already come from a single batched AJAX call
+    client = get_webservice_client(token, university_name, session) if kind != "enrolled" else None
+    if client is not None:
+        try:
+            return fetch_webservice_catalog(kind, client, university_name, object_id)
+        except WebServiceError as e:
+            logger.warning(f"Web service backend failed for {kind}, scraping instead: {e}")
+            RETRIES.inc(reason="webservice_fallback")
+
+    if kind == "categories":
+        return get_categories(session, university_name, max_workers=settings.MOODLE_CATEGORY_CRAWL_WORKERS)
+    if kind == "courses":
+        return get_courses(session, object_id, university_name)
+    if kind == "chapters":
+        return get_chapters(session, object_id, university_name)
+    if kind == "enrolled":
+        cfg = get_moodle_cfg(session.cookies, university_name)
+        client = AjaxClient(session, university_name, cfg)
+        try:
+            return get_enrolled_courses(client)
+        finally:
+            store_moodle_cfg(session.cookies, university_name, client.cfg, cfg)
+    raise ValueError(f"Unknown catalog kind: {kind}")
+
+
+def fetch_webservice_catalog(kind, client, university_name, object_id=None):
+    if kind == "categories":
+        return webservice.get_categories(client, university_name)
+    if kind == "courses":
+        return webservice.get_courses(client, object_id, university_name)
+    if kind == "chapters":
+        return webservice.get_chapters(client, object_id, university_name)
+    raise ValueError(f"Unknown catalog kind: {kind}")
+
+
+def content_etag(data):
+    """
+    Hashes catalog data into an ETag. The data is serialized with sorted
+    keys, so the same data gets the same tag in every process, and a scrape
+    returning unchanged data keeps the tag the clients already have.
+    """
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return f'"{hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def is_complete(kind, data):
+    """
+    Tells whether fetched catalog data looks whole. Empty results, category
+    trees with pages that could not be fetched and chapters without a title
+    (e.g. the login page of an expired session) may be partial.
+    """
+    if not data:
+        return False
+    if kind == "categories":
+        return not any("error" in category for category in data)
+    if kind == "chapters":
+        return bool(data.get("sections")) and bool((data.get("course_title") or "").strip())
+    return True
+
+
+def store_catalog(kind, university_name, token, object_id, data):
+    config = _config(kind)
+    now = time.time()
+    entry = {"data": data, "etag": content_etag(data)}
+    complete = is_complete(kind, data)
+    if complete:
+        entry["fresh_until"] = now + config["ttl"]
+        entry["stale_until"] = now + config["ttl"] + config["stale_ttl"]
+        # Expired entries are kept a while longer in case Moodle is down
+        timeout = config["ttl"] + config["stale_ttl"] + settings.CATALOG_CACHE_OUTAGE_TTL
+    else:
+        # Partial data is cached briefly and never copied into the tables
+        entry["fresh_until"] = entry["stale_until"] = now + settings.CATALOG_CACHE_INCOMPLETE_TTL
+        timeout = settings.CATALOG_CACHE_INCOMPLETE_TTL
+    cache.set(catalog_key(kind, university_name, token, object_id), entry, timeout=timeout)
+    if settings.CATALOG_STORE and kind in STORED_KINDS and complete:
+        _schedule_store(kind, university_name, object_id, data, entry["etag"])
+    return entry
+
+
+def get_catalog(kind, session, university_name, token=None, object_id=None):
+    """
+    Returns catalog data from the cache, scraping Moodle on a miss. Requests
+    missing the same entry at the same time wait for a single scrape.
+
+    Fresh entries are served directly. Stale entries (older than the TTL but
+    within the stale window) are served as well while a Celery task refreshes
+    them in the background. Expired entries are only served when Moodle
+    cannot be reached.
+
+    Args:
+        kind: One of CATALOG_KINDS
+        session: The requests session used on a cache miss
+        university_name: The university subdomain (e.g. 'bba')
+        token: The session token, used to key per-user data
+        object_id: The category or course id, if any
+
+    Returns:
+        The data returned by the matching service function
+    """
+    return get_catalog_entry(kind, session, university_name, token, object_id)["data"]
+
+
+def enrolled_in(session, university_name, token, course_id):
+    """
+    Tells whether the user of `token` is enrolled in a course, from their
+    cached list of enrolled courses.
+    """
+    courses = get_catalog("enrolled", session, university_name, token)
+    return str(course_id) in {str(course.get("id")) for course in courses}
+
+
+def _cached_entry(entry):
+    # Entries stored before ETags were introduced get theirs on read
+    if "etag" not in entry:
+        entry["etag"] = content_etag(entry["data"])
+    return entry
+
+
+def _servable(entry):
+    return entry is not None and entry.get("stale_until", float("inf")) > time.time()
+
+
+def _outage_fallback(kind, key, expired, error):
+    """
+    Returns the expired entry of a catalog fetch that failed on Moodle's
+    side, or re-raises the error when there is none.
+    """
+    if expired is None:
+        raise error
+    logger.warning(f"Moodle unavailable, serving the expired entry {key}: {error}")
+    CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="fallback")
+    return _cached_entry(expired)
+
+
+def get_catalog_entry(kind, session, university_name, token=None, object_id=None):
+    """
+    Same as get_catalog(), with the ETag of the data.
+
+    Returns:
+        dict: The data ('data') and its ETag ('etag')
+    """
+    key = catalog_key(kind, university_name, token, object_id)
+    entry = cache.get(key)
+    if _servable(entry):
+        if entry["fresh_until"] <= time.time():
+            CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="stale")
+            _schedule_refresh(kind, university_name, token, object_id)
+        else:
+            CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="hit")
+        return _cached_entry(entry)
+    CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="miss")
+
+    def fetch():
+        data = fetch_catalog(kind, session, university_name, object_id, token)
+        return store_catalog(kind, university_name, token, object_id, data)
+
+    # Concurrent misses of the same entry (same university, kind, id and
+    # scope) share a single scrape
+    try:
+        return singleflight.do(key, fetch)
+    except UPSTREAM_ERRORS as e:
+        return _outage_fallback(kind, key, entry, e)
+
+
+async def afetch_catalog(kind, session, university_name, object_id=None, token=None):
+    """
+    Async counterpart of fetch_catalog(), with an AsyncMoodleSession.
+    Universities on the web service backend go through fetch_catalog() in a
+    worker thread.
+    """
+    if moodle_backend(university_name) == "webservice" and kind != "enrolled":
+        sync_session = await sync_to_async(get_session, thread_sensitive=False)(
+            token, allow_anonymous=True, university_name=university_name
+        )
+        return await sync_to_async(fetch_catalog, thread_sensitive=False)(
+            kind, sync_session, university_name, object_id, token
+        )
+
+    if kind == "categories":
+        return await aget_categories(session, university_name, max_workers=settings.MOODLE_CATEGORY_CRAWL_WORKERS)
+    if kind == "courses":
+        return await aget_courses(session, object_id, university_name)
+    if kind == "chapters":
+        return await aget_chapters(session, object_id, university_name)
+    if kind == "enrolled":
+        cfg = await sync_to_async(get_moodle_cfg, thread_sensitive=False)(session.cookies, university_name)
+        client = AsyncAjaxClient(session, university_name, cfg)
+        try:
+            return await aget_enrolled_courses(client)
+        finally:
+            await sync_to_async(store_moodle_cfg, thread_sensitive=False)(
+                session.cookies, university_name, client.cfg, cfg
+            )
+    raise ValueError(f"Unknown catalog kind: {kind}")
+
+
+async def aget_catalog(kind, session, university_name, token=None, object_id=None):
+    """
+    Async counterpart of get_catalog(), with an AsyncMoodleSession.
+    """
+    return (await aget_catalog_entry(kind, session, university_name, token, object_id))["data"]
+
+
+async def aenrolled_in(session, university_name, token, course_id):
+    """
+    Async counterpart of enrolled_in().
+    """
+    courses = await aget_catalog("enrolled", session, university_name, token)
+    return str(course_id) in {str(course.get("id")) for course in courses}
+
+
+async def aget_catalog_entry(kind, session, university_name, token=None, object_id=None):
+    """
+    Async counterpart of get_catalog_entry().
+    """
+    key = await sync_to_async(catalog_key, thread_sensitive=False)(kind, university_name, token, object_id)
+    entry = await cache.aget(key)
+    if _servable(entry):
+        if entry["fresh_until"] <= time.time():
+            CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="stale")
+            await sync_to_async(_schedule_refresh, thread_sensitive=False)(kind, university_name, token, object_id)
+        else:
+            CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="hit")
+        return _cached_entry(entry)
+    CACHE_REQUESTS.inc(cache="catalog", kind=kind, result="miss")
+
+    async def fetch():
+        data = await afetch_catalog(kind, session, university_name, object_id, token)
+        return await sync_to_async(store_catalog, thread_sensitive=False)(
+            kind, university_name, token, object_id, data
+        )
+
+    try:
+        return await singleflight.ado(key, fetch)
+    except UPSTREAM_ERRORS as e:
+        return _outage_fallback(kind, key, entry, e)
+
+
+def _schedule_refresh(kind, university_name, token, object_id):
+    lock_key = f"catalog_refresh_{catalog_key(kind, university_name, token, object_id)}"
+    if not cache.add(lock_key, 1, timeout=REFRESH_LOCK_TIMEOUT):
+        # A refresh is already in progress
+        return
+    from .tasks import refresh_catalog_entry
+    try:
+        refresh_catalog_entry.delay(kind, university_name, token, object_id)
+    except Exception as e:
+        # Keep serving the stale entry, the next request will try again
+        logger.error(f"Error queueing catalog refresh for {lock_key}: {e}")
+        cache.delete(lock_key)
+
+
+def _schedule_store(kind, university_name, object_id, data, etag):
+    from .tasks import store_catalog_rows
+    try:
+        store_catalog_rows.delay(kind, university_name, object_id, data, etag)
+    except Exception as e:
+        # The tables catch up on the next fetch
+        logger.error(f"Error queueing the storage of {kind} {object_id or ''} for {university_name}: {e}")
+
+
+def refresh_catalog(kind, university_name, token=None, object_id=None):
+    """
+    Scrapes and stores a catalog entry. Called by the refresh task.
+
+    Returns:
+        bool: True if the entry was refreshed, False if the session expired
+    """
+    lock_key = f"catalog_refresh_{catalog_key(kind, university_name, token, object_id)}"
+    try:
+        session = get_session(
+            token, allow_anonymous=_config(kind)["scope"] == PUBLIC_SCOPE, university_name=university_name
+        )
+        if session is None:
+            return False
+        data = fetch_catalog(kind, session, university_name, object_id, token)
+        store_catalog(kind, university_name, token, object_id, data)
+        return True
+    finally:
+        cache.delete(lock_key)
+
+
+def invalidate_catalog(kind=None, university_name=None, object_id=None, token=None):
+    """
+    Invalidates cached catalog data.
+
+    With an `object_id` (or for the category tree, a `university_name`) only
+    that entry is deleted; otherwise every entry of `kind` (or of all kinds)
+    is invalidated by bumping its generation.
+
+    Returns:
+        list: The kinds that were invalidated
+    """
+    kinds = [kind] if kind else list(CATALOG_KINDS)
+    for k in kinds:
+        if university_name and (object_id or k == "categories"):
+            cache.delete(catalog_key(k, university_name, token, object_id))
+        else:
+            _version(k)
+            cache.incr(f"catalog_version_{k}")
+    return kinds
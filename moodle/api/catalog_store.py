@@ -0,0 +1,374 @@
+# api/catalog_store.py
+# Normalized copy of the catalog in the database (Category, Course, Section,
+# Activity). Fresh scrapes are diffed against the stored rows and only the
+# changes are written, in bulk; the read functions rebuild the data in the
+# shape returned by the services.
+import logging
+import re
+
+from django.db import transaction
+from django.db.models import Q
+
+from .catalog_cache import content_etag
+from .models import Activity, Category, Course, Section
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_FIELDS = ["name", "url", "position"]
+COURSE_FIELDS = ["name", "url", "category_id", "position"]
+SECTION_FIELDS = ["section_id", "number", "name", "summary"]
+ACTIVITY_FIELDS = ["activity_id", "name", "url", "type"]
+
+_COURSE_ID = re.compile(r"[?&]id=(\d+)")
+
+
+def _diff(existing, fresh, fields):
+    """
+    Compares fresh rows with the stored ones, by key. The stored rows that
+    changed are updated in place.
+
+    Args:
+        existing: dict of key -> model instance
+        fresh: dict of key -> dict of field values
+        fields: The fields compared
+
+    Returns:
+        tuple: (keys to create, instances to update, instances no longer listed)
+    """
+    create, update = [], []
+    for key, values in fresh.items():
+        row = existing.get(key)
+        if row is None:
+            create.append(key)
+        elif any(getattr(row, field) != values[field] for field in fields):
+            for field in fields:
+                setattr(row, field, values[field])
+            update.append(row)
+    removed = [row for key, row in existing.items() if key not in fresh]
+    return create, update, removed
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+
+def _optional(value):
+    return None if value is None else str(value)
+
+
+def _course_id(course):
+    if course.get("id"):
+        return str(course["id"])
+    # Category pages only link the courses
+    match = _COURSE_ID.search(course.get("url") or "")
+    return match.group(1) if match else None
+
+
+def _store_courses(university_name, course_lists):
+    """
+    Stores the course lists of several categories of a Moodle.
+
+    Courses no longer listed in their category are kept (with their
+    chapters) but detached from it.
+
+    Args:
+        course_lists: dict of category id -> course dicts (name, url, id)
+
+    Returns:
+        int: Number of rows written
+    """
+    fresh = {}
+    for category_id, courses in course_lists.items():
+        for position, course in enumerate(courses):
+            course_id = _course_id(course)
+            if course_id is None:
+                continue
+            fresh[course_id] = {
+                "name": _text(course.get("name")),
+                "url": _text(course.get("url")),
+                "category_id": category_id,
+                "position": position,
+            }
+
+    existing = {
+        course.course_id: course
+        for course in Course.objects.filter(
+            Q(course_id__in=list(fresh)) | Q(category_id__in=list(course_lists)), university=university_name,
+        )
+    }
+    create, update, removed = _diff(existing, fresh, COURSE_FIELDS)
+
+    Course.objects.bulk_create(
+        [Course(university=university_name, course_id=course_id, **fresh[course_id]) for course_id in create],
+        # Created meanwhile by the chapters of that course
+        update_conflicts=True, unique_fields=["university", "course_id"], update_fields=COURSE_FIELDS,
+    )
+    Course.objects.bulk_update(update, COURSE_FIELDS)
+    Course.objects.filter(pk__in=[course.pk for course in removed]).update(category_id=None, position=None)
+    return len(create) + len(update) + len(removed)
+
+
+def store_categories(university_name, categories):
+    """
+    Stores the category tree of a Moodle (get_categories() data): the
+    categories, and the courses listed in each category page that changed.
+
+    An empty tree (e.g. a page that could not be parsed) is not stored.
+
+    Returns:
+        int: Number of rows written
+    """
+    if not categories:
+        return 0
+    fresh = {
+        str(category["id"]): {
+            "name": _text(category.get("name")),
+            "url": _text(category.get("url")),
+            "position": position,
+        }
+        for position, category in enumerate(categories)
+        if category.get("id")
+    }
+    # Pages that could not be fetched keep their stored courses
+    course_lists = {
+        str(category["id"]): category.get("subcategories", [])
+        for category in categories
+        if category.get("id") and "error" not in category
+    }
+
+    with transaction.atomic():
+        existing = {category.category_id: category for category in Category.objects.filter(university=university_name)}
+        create, update, removed = _diff(existing, fresh, CATEGORY_FIELDS)
+        # Categories that left the jump menu stay for their courses
+        removed = [category for category in removed if category.position is not None]
+        Category.objects.bulk_create(
+            [Category(university=university_name, category_id=key, **fresh[key]) for key in create],
+            update_conflicts=True, unique_fields=["university", "category_id"], update_fields=CATEGORY_FIELDS,
+        )
+        Category.objects.bulk_update(update, CATEGORY_FIELDS)
+        Category.objects.filter(pk__in=[category.pk for category in removed]).update(position=None)
+        written = len(create) + len(update) + len(removed)
+
+        etags = {key: content_etag(courses) for key, courses in course_lists.items()}
+        changed = {
+            key: courses for key, courses in course_lists.items()
+            if key not in existing or existing[key].courses_etag != etags[key]
+        }
+        if changed:
+            written += _store_courses(university_name, changed)
+            rows = list(Category.objects.filter(university=university_name, category_id__in=list(changed)))
+            for category in rows:
+                category.courses_etag = etags[category.category_id]
+            Category.objects.bulk_update(rows, ["courses_etag"])
+    return written
+
+
+def store_courses(university_name, category_id, courses, etag=None):
+    """
+    Stores the courses of a category (get_courses() data). Nothing is
+    written if the list did not change since it was last stored, or if it
+    is empty.
+
+    Returns:
+        int: Number of rows written
+    """
+    if not courses:
+        return 0
+    category_id = str(category_id)
+    etag = etag or content_etag(courses)
+    with transaction.atomic():
+        category, _ = Category.objects.select_for_update().get_or_create(
+            university=university_name, category_id=category_id,
+        )
+        if category.courses_etag == etag:
+            return 0
+        written = _store_courses(university_name, {category_id: courses})
+        category.courses_etag = etag
+        category.save(update_fields=["courses_etag", "updated_at"])
+    return written
+
+
+def store_chapters(university_name, chapters, etag=None):
+    """
+    Stores the sections and activities of a course (get_chapters() data).
+    Nothing is written if the course did not change since it was last
+    stored, or if the scrape has no title or no sections (e.g. the login
+    page of an expired session), which would delete the stored rows.
+
+    Returns:
+        int: Number of rows written
+    """
+    course_id = chapters.get("course_id")
+    title = _text(chapters.get("course_title")).strip()
+    if not course_id or not title or not chapters.get("sections"):
+        return 0
+    etag = etag or content_etag(chapters)
+
+    with transaction.atomic():
+        course, _ = Course.objects.select_for_update().get_or_create(
+            university=university_name, course_id=str(course_id), defaults={"name": title},
+        )
+        if course.chapters_etag == etag:
+            return 0
+
+        sections = chapters.get("sections", [])
+        fresh_sections = {
+            position: {
+                "section_id": _optional(section.get("id")),
+                "number": _optional(section.get("number")),
+                "name": _text(section.get("name")),
+                "summary": section.get("summary"),
+            }
+            for position, section in enumerate(sections)
+        }
+        existing_sections = {section.position: section for section in course.sections.all()}
+        create, update, removed = _diff(existing_sections, fresh_sections, SECTION_FIELDS)
+        # Their activities go with them
+        Section.objects.filter(pk__in=[section.pk for section in removed]).delete()
+        Section.objects.bulk_update(update, SECTION_FIELDS)
+        created = Section.objects.bulk_create(
+            [Section(course=course, position=position, **fresh_sections[position]) for position in create]
+        )
+        written = len(create) + len(update) + len(removed)
+
+        section_pks = {
+            position: existing_sections[position].pk for position in fresh_sections if position in existing_sections
+        }
+        section_pks.update({section.position: section.pk for section in created})
+        section_positions = {pk: position for position, pk in section_pks.items()}
+
+        fresh_activities = {
+            (section_position, position): {
+                "activity_id": _optional(activity.get("id")),
+                "name": _optional(activity.get("name")),
+                "url": _optional(activity.get("url")),
+                "type": _optional(activity.get("type")),
+            }
+            for section_position, section in enumerate(sections)
+            for position, activity in enumerate(section.get("activities", []))
+        }
+        existing_activities = {
+            (section_positions[activity.section_id], activity.position): activity
+            for activity in Activity.objects.filter(course=course, section_id__in=list(section_positions))
+        }
+        create, update, removed = _diff(existing_activities, fresh_activities, ACTIVITY_FIELDS)
+        Activity.objects.filter(pk__in=[activity.pk for activity in removed]).delete()
+        Activity.objects.bulk_update(update, ACTIVITY_FIELDS)
+        Activity.objects.bulk_create([
+            Activity(course=course, section_id=section_pks[key[0]], position=key[1], **fresh_activities[key])
+            for key in create
+        ])
+        written += len(create) + len(update) + len(removed)
+
+        course.name = title
+        course.chapters_etag = etag
+        course.save(update_fields=["name", "chapters_etag", "updated_at"])
+    return written
+
+
+def store_catalog_data(kind, university_name, object_id, data, etag=None):
+    """
+    Copies fresh catalog data of one of the STORED_KINDS into the database.
+
+    Returns:
+        int: Number of rows written
+    """
+    if kind == "categories":
+        written = store_categories(university_name, data)
+    elif kind == "courses":
+        written = store_courses(university_name, object_id, data, etag)
+    elif kind == "chapters":
+        written = store_chapters(university_name, data, etag)
+    else:
+        raise ValueError(f"Kind not stored in the database: {kind}")
+    logger.debug(f"Stored {kind} {object_id or ''} for {university_name}: {written} rows written")
+    return written
+
+
+def _entry(data):
+    return {"data": data, "etag": content_etag(data)}
+
+
+def stored_categories(university_name):
+    """
+    Returns the stored category tree of a Moodle, with the courses of each
+    category, in the get_categories() shape.
+
+    Returns:
+        dict: The data ('data') and its ETag ('etag'), or None if the tree
+              was never stored
+    """
+    categories = list(
+        Category.objects.filter(university=university_name, position__isnull=False)
+        .order_by("position").values_list("category_id", "name", "url")
+    )
+    if not categories:
+        return None
+    courses = {}
+    for category_id, name, url in (
+        Course.objects.filter(university=university_name, category_id__isnull=False)
+        .order_by("category_id", "position").values_list("category_id", "name", "url")
+    ):
+        courses.setdefault(category_id, []).append({"name": name, "url": url})
+    return _entry([
+        {"id": category_id, "name": name, "url": url, "subcategories": courses.get(category_id, [])}
+        for category_id, name, url in categories
+    ])
+
+
+def stored_courses(university_name, category_id):
+    """
+    Returns the stored courses of a category, in the get_courses() shape.
+
+    Returns:
+        dict: The data ('data') and its ETag ('etag'), or None if the
+              category was never stored
+    """
+    if not Category.objects.filter(
+        university=university_name, category_id=category_id, courses_etag__isnull=False,
+    ).exists():
+        return None
+    courses = (
+        Course.objects.filter(university=university_name, category_id=category_id)
+        .order_by("position").values_list("name", "url", "course_id")
+    )
+    return _entry([{"name": name, "url": url, "id": course_id} for name, url, course_id in courses])
+
+
+def stored_chapters(university_name, course_id):
+    """
+    Returns the stored sections and activities of a course, in the
+    get_chapters() shape.
+
+    Returns:
+        dict: The data ('data') and its ETag ('etag'), or None if the
+              chapters of the course were never stored
+    """
+    course = (
+        Course.objects.filter(university=university_name, course_id=course_id, chapters_etag__isnull=False)
+        .values_list("pk", "name").first()
+    )
+    if course is None:
+        return None
+    pk, title = course
+
+    activities = {}
+    for section, activity_id, name, url, activity_type in (
+        Activity.objects.filter(course_id=pk).order_by("section", "position")
+        .values_list("section", "activity_id", "name", "url", "type")
+    ):
+        activity = {"name": name, "url": url, "id": activity_id, "type": activity_type}
+        # Keys the scraper did not find are left out, as in get_chapters()
+        activities.setdefault(section, []).append({key: value for key, value in activity.items() if value is not None})
+
+    sections = []
+    for section, section_id, number, name, summary in (
+        Section.objects.filter(course_id=pk).order_by("position")
+        .values_list("pk", "section_id", "number", "name", "summary")
+    ):
+        section_data = {"id": section_id, "number": number, "name": name, "activities": activities.get(section, [])}
+        if summary is not None:
+            section_data["summary"] = summary
+        sections.append(section_data)
+
+    return _entry({"course_id": course_id, "course_title": title, "sections": sections})
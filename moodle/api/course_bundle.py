@@ -0,0 +1,156 @@
+# api/course_bundle.py
+# A whole course as one ZIP: the resource files of its chapters are fetched
+# through the blob store with bounded concurrency and streamed into the
+# archive as they arrive.
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connection
+
+from services.zip_stream import ZipStream, safe_name
+from .resource_cache import aensure_resource, blob_store, ensure_resource
+
+logger = logging.getLogger(__name__)
+
+MISSING_FILES_NAME = "MISSING FILES.txt"
+
+
+def course_resources(chapters):
+    """
+    Lists the resource activities of get_chapters() data, with the folder
+    (section) they go into in the archive.
+
+    Returns:
+        list: (folder, activity) tuples
+    """
+    resources = []
+    for index, section in enumerate(chapters.get('sections', [])):
+        number = section.get('number') or index
+        name = section.get('name') or f"Section {number}"
+        folder = safe_name(f"{int(number):02d} - {name}" if str(number).isdigit() else name)
+        for activity in section.get('activities', []):
+            if activity.get('type') == 'resource' and activity.get('id'):
+                resources.append((folder, activity))
+    return resources
+
+
+def bundle_filename(chapters, course_id):
+    return f"{safe_name(chapters.get('course_title') or '', default='course')}-{course_id}.zip"
+
+
+def _archive_name(bundle, folder, activity, entry):
+    # The activity name is more telling than the uploaded file name, keep
+    # the extension of the latter
+    extension = os.path.splitext(entry.filename or '')[1]
+    name = safe_name(activity.get('name') or '', default=f"resource_{activity['id']}")
+    if extension and not name.lower().endswith(extension.lower()):
+        name += extension
+    return bundle.unique_name(f"{folder}/{name}")
+
+
+def _missing_files(missing):
+    lines = ["These files could not be downloaded from Moodle:", ""]
+    lines += [f"- {folder}/{activity.get('name') or activity['id']}" for folder, activity in missing]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _ensure(session, folder, activity, university_name):
+    try:
+        return folder, activity, ensure_resource(session, activity['id'], university_name)
+    except Exception as e:
+        logger.warning(f"Could not fetch resource {activity['id']} for a course bundle: {e}")
+        return folder, activity, None
+    finally:
+        # Worker threads are not part of a request, close their connection
+        connection.close()
+
+
+def stream_course_bundle(session, resources, university_name):
+    """
+    Yields a ZIP archive of the course resources. Up to
+    COURSE_BUNDLE_CONCURRENCY files are fetched at once (from the blob store
+    when the cached copy is still valid), and each one is written to the
+    archive as soon as it is stored. Files Moodle did not return are listed
+    in a text entry at the end.
+
+    Args:
+        session: The requests session of the user
+        resources: (folder, activity) tuples from course_resources()
+        university_name: The university subdomain (e.g. 'bba')
+    """
+    bundle = ZipStream()
+    missing = []
+    executor = ThreadPoolExecutor(max_workers=settings.COURSE_BUNDLE_CONCURRENCY, thread_name_prefix="bundle")
+    try:
+        futures = [
+            executor.submit(_ensure, session, folder, activity, university_name) for folder, activity in resources
+        ]
+        for future in as_completed(futures):
+            folder, activity, entry = future.result()
+            try:
+                source = open(blob_store.path(entry.digest), 'rb') if entry is not None else None
+            except OSError:
+                # Evicted in the meantime
+                source = None
+            if source is None:
+                missing.append((folder, activity))
+                continue
+            with source, bundle.open(_archive_name(bundle, folder, activity, entry), entry.size) as target:
+                while chunk := source.read(settings.RESOURCE_STREAM_CHUNK_SIZE):
+                    target.write(chunk)
+                    yield bundle.drain()
+            yield bundle.drain()
+
+        if missing:
+            yield bundle.add(MISSING_FILES_NAME, _missing_files(missing))
+        yield bundle.close()
+    finally:
+        # Stops fetching when the client went away
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _aensure(semaphore, session, folder, activity, university_name):
+    async with semaphore:
+        try:
+            return folder, activity, await aensure_resource(session, activity['id'], university_name)
+        except Exception as e:
+            logger.warning(f"Could not fetch resource {activity['id']} for a course bundle: {e}")
+            return folder, activity, None
+
+
+async def astream_course_bundle(session, resources, university_name):
+    """
+    Async counterpart of stream_course_bundle(), with an AsyncMoodleSession.
+    """
+    bundle = ZipStream()
+    missing = []
+    semaphore = asyncio.Semaphore(settings.COURSE_BUNDLE_CONCURRENCY)
+    tasks = [
+        asyncio.ensure_future(_aensure(semaphore, session, folder, activity, university_name))
+        for folder, activity in resources
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            folder, activity, entry = await next_done
+            try:
+                source = await asyncio.to_thread(open, blob_store.path(entry.digest), 'rb') if entry else None
+            except OSError:
+                source = None
+            if source is None:
+                missing.append((folder, activity))
+                continue
+            with source, bundle.open(_archive_name(bundle, folder, activity, entry), entry.size) as target:
+                while chunk := await asyncio.to_thread(source.read, settings.RESOURCE_STREAM_CHUNK_SIZE):
+                    target.write(chunk)
+                    yield bundle.drain()
+            yield bundle.drain()
+
+        if missing:
+            yield bundle.add(MISSING_FILES_NAME, _missing_files(missing))
+        yield bundle.close()
+    finally:
+        for task in tasks:
+            task.cancel()
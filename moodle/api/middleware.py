@@ -0,0 +1,108 @@
+# api/middleware.py
+import logging
+import math
+import time
+
+import httpx
+import requests
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from services.metrics import DB_SECONDS, RENDER_SECONDS, REQUEST_SECONDS
+from services.upstream import UPSTREAM_ERRORS, UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def _endpoint(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match else 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    Records the duration of every API request, and for synchronous views
+    the time spent in database queries and rendering the response, labelled
+    by endpoint (URL route).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        db_time = [0.0]
+
+        def time_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                db_time[0] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(time_query):
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - start)
+        DB_SECONDS.observe(db_time[0], endpoint=_endpoint(request))
+        return response
+
+    async def __acall__(self, request):
+        # Database queries run in worker threads here, they are not timed
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - start)
+        return response
+
+    def _record(self, request, response, seconds):
+        # Streaming responses are timed until their headers are ready
+        REQUEST_SECONDS.observe(
+            seconds,
+            endpoint=_endpoint(request),
+            # Set by the views once they know the university of the request
+            university=getattr(request, 'university', ''),
+            method=request.method,
+            status=response.status_code,
+        )
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after the template response
+        # middleware ran
+        start = time.perf_counter()
+        endpoint = _endpoint(request)
+
+        def rendered(response):
+            RENDER_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+class UpstreamErrorMiddleware(MiddlewareMixin):
+    """
+    Answers the requests whose view could not reach Moodle: 503 with a
+    Retry-After header when the request was not sent (circuit open, rate
+    limit or slots exhausted), 504 when Moodle timed out and 502 otherwise.
+    """
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, UpstreamUnavailable):
+            response = JsonResponse({'error': str(exception)}, status=503)
+            if exception.retry_after is not None:
+                response['Retry-After'] = str(max(math.ceil(exception.retry_after), 1))
+            return response
+        if isinstance(exception, (requests.Timeout, httpx.TimeoutException)):
+            logger.warning(f"Moodle timed out on {request.path}: {exception}")
+            return JsonResponse({'error': 'Moodle did not answer in time'}, status=504)
+        if isinstance(exception, UPSTREAM_ERRORS):
+            logger.warning(f"Moodle request failed on {request.path}: {exception}")
+            return JsonResponse({'error': 'Could not reach Moodle'}, status=502)
+        return None
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_cachedresource'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('university', models.CharField(max_length=64)),
+                ('user_id', models.CharField(max_length=64)),
+                ('last_timecreated', models.BigIntegerField(default=0)),
+                ('last_notification_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('university', 'user_id'), name='unique_notification_sync_state')],
+            },
+        ),
+    ]
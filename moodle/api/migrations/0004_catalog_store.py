@@ -0,0 +1,90 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_notificationsyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('university', models.CharField(max_length=64)),
+                ('category_id', models.CharField(max_length=64)),
+                ('name', models.TextField(blank=True)),
+                ('url', models.TextField(blank=True)),
+                ('position', models.IntegerField(null=True)),
+                ('courses_etag', models.CharField(max_length=64, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'categories',
+                'indexes': [models.Index(fields=['university', 'position'], name='category_position')],
+                'constraints': [models.UniqueConstraint(fields=('university', 'category_id'), name='unique_category')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Course',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('university', models.CharField(max_length=64)),
+                ('course_id', models.CharField(max_length=64)),
+                ('category_id', models.CharField(max_length=64, null=True)),
+                ('name', models.TextField(blank=True)),
+                ('url', models.TextField(blank=True)),
+                ('position', models.IntegerField(null=True)),
+                ('chapters_etag', models.CharField(max_length=64, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['university', 'category_id', 'position'], name='course_category_position')],
+                'constraints': [models.UniqueConstraint(fields=('university', 'course_id'), name='unique_course')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Section',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('section_id', models.CharField(max_length=64, null=True)),
+                ('number', models.CharField(max_length=16, null=True)),
+                ('name', models.TextField(blank=True)),
+                ('summary', models.TextField(null=True)),
+                ('course', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sections', to='api.course')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Activity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('activity_id', models.CharField(max_length=64, null=True)),
+                ('name', models.TextField(null=True)),
+                ('url', models.TextField(null=True)),
+                ('type', models.CharField(max_length=64, null=True)),
+                ('course', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='activities', to='api.course')),
+                ('section', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='activities', to='api.section')),
+            ],
+            options={
+                'verbose_name_plural': 'activities',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='section',
+            constraint=models.UniqueConstraint(fields=('course', 'position'), name='unique_section_position'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['course', 'section', 'position'], name='activity_course_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='activity',
+            constraint=models.UniqueConstraint(fields=('section', 'position'), name='unique_activity_position'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_default_university(apps, schema_editor):
+    # Notifications stored before several universities were served came
+    # from the default one
+    Notification = apps.get_model('api', 'Notification')
+    Notification.objects.update(university=getattr(settings, 'MOODLE_DEFAULT_TENANT', 'bba'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_catalog_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='university',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_default_university, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='notification',
+            name='notification_id',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('university', 'notification_id'), name='unique_notification'),
+        ),
+    ]
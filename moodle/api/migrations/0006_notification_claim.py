@@ -0,0 +1,23 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_notification_university'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='claim',
+            field=models.CharField(max_length=36, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='claimed_until',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
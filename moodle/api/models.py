@@ -3,11 +3,157 @@ from django.db import models
 # Create your models here.
 
 class Notification(models.Model):
-    notification_id = models.CharField(max_length=255, unique=True)
+    university = models.CharField(max_length=64)  # Notification ids are only unique within a Moodle
+    notification_id = models.CharField(max_length=255)
     message = models.TextField()
     aria_label = models.CharField(max_length=255)
     timestamp = models.DateTimeField()
     sent = models.BooleanField(default=False)  # Whether the notification was sent to the webhook
+    claim = models.CharField(max_length=36, null=True)  # Delivery currently sending it
+    claimed_until = models.DateTimeField(null=True)  # When that claim lapses
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['university', 'notification_id'], name='unique_notification'),
+        ]
 
     def __str__(self):
         return self.message
+
+
+class CachedResource(models.Model):
+    """
+    Index of the resource files kept in the on-disk blob store.
+    """
+    university = models.CharField(max_length=64)
+    resource_id = models.CharField(max_length=64)
+    digest = models.CharField(max_length=64, db_index=True)  # sha256 of the file content
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=255)
+    filename = models.CharField(max_length=255)
+    etag = models.CharField(max_length=255, blank=True)  # Upstream ETag, used to revalidate
+    last_modified = models.CharField(max_length=64, blank=True)  # Upstream Last-Modified
+    last_access = models.DateTimeField(db_index=True)  # Used for LRU eviction
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['university', 'resource_id'], name='unique_cached_resource'),
+        ]
+
+    def __str__(self):
+        return f"{self.university}:{self.resource_id}"
+
+
+class NotificationSyncState(models.Model):
+    """
+    High-water mark of the incremental notification sync of a Moodle user.
+    """
+    university = models.CharField(max_length=64)
+    user_id = models.CharField(max_length=64)  # Moodle userId (M.cfg)
+    last_timecreated = models.BigIntegerField(default=0)  # timecreated of the newest notification seen
+    last_notification_id = models.BigIntegerField(default=0)  # id of the newest notification seen
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['university', 'user_id'], name='unique_notification_sync_state'),
+        ]
+
+    def __str__(self):
+        return f"{self.university}:{self.user_id}"
+
+
+class Category(models.Model):
+    """
+    A course category of a Moodle, as listed by its jump menu.
+    """
+    university = models.CharField(max_length=64)
+    category_id = models.CharField(max_length=64)
+    name = models.TextField(blank=True)
+    url = models.TextField(blank=True)
+    position = models.IntegerField(null=True)  # Order in the jump menu, None once it left the menu
+    courses_etag = models.CharField(max_length=64, null=True)  # ETag of the course list last stored
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'categories'
+        constraints = [
+            models.UniqueConstraint(fields=['university', 'category_id'], name='unique_category'),
+        ]
+        indexes = [
+            models.Index(fields=['university', 'position'], name='category_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.university}:{self.category_id} {self.name}"
+
+
+class Course(models.Model):
+    """
+    A course of a Moodle, with the category it is listed in.
+    """
+    university = models.CharField(max_length=64)
+    course_id = models.CharField(max_length=64)
+    category_id = models.CharField(max_length=64, null=True)  # Moodle id of its category, if known
+    name = models.TextField(blank=True)
+    url = models.TextField(blank=True)
+    position = models.IntegerField(null=True)  # Order in its category page
+    chapters_etag = models.CharField(max_length=64, null=True)  # ETag of the chapters last stored
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['university', 'course_id'], name='unique_course'),
+        ]
+        indexes = [
+            models.Index(fields=['university', 'category_id', 'position'], name='course_category_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.university}:{self.course_id} {self.name}"
+
+
+class Section(models.Model):
+    """
+    A section (chapter) of a course, identified by its position in the course.
+    """
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='sections', db_index=False)
+    position = models.IntegerField()
+    section_id = models.CharField(max_length=64, null=True)  # Moodle section id
+    number = models.CharField(max_length=16, null=True)  # Moodle section number
+    name = models.TextField(blank=True)
+    summary = models.TextField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['course', 'position'], name='unique_section_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.course_id}:{self.position} {self.name}"
+
+
+class Activity(models.Model):
+    """
+    An activity of a course section, identified by its position in the section.
+    """
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='activities', db_index=False)
+    section = models.ForeignKey(Section, on_delete=models.CASCADE, related_name='activities', db_index=False)
+    position = models.IntegerField()
+    activity_id = models.CharField(max_length=64, null=True)  # Moodle course module id
+    name = models.TextField(null=True)
+    url = models.TextField(null=True)
+    type = models.CharField(max_length=64, null=True)  # Moodle module name (resource, forum, ...)
+
+    class Meta:
+        verbose_name_plural = 'activities'
+        constraints = [
+            models.UniqueConstraint(fields=['section', 'position'], name='unique_activity_position'),
+        ]
+        indexes = [
+            # All the activities of a course in one index range scan
+            models.Index(fields=['course', 'section', 'position'], name='activity_course_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.section_id}:{self.position} {self.name}"
@@ -0,0 +1,188 @@
+# api/notifications.py
+import logging
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from services.ajax import AsyncAjaxClient
+from services.async_http import AsyncMoodleSession
+from services.notification import MoodleTerminator, aget_notifications, high_water_mark
+
+from .models import Notification, NotificationSyncState
+from .sessions import get_moodle_cfg, store_moodle_cfg
+
+logger = logging.getLogger(__name__)
+
+
+def notification_fields(notif):
+    """
+    Maps a Moodle popup notification to Notification fields.
+
+    Returns:
+        dict, or None if the notification is not a dictionary
+    """
+    # Make sure notif is a dictionary before using get()
+    if not isinstance(notif, dict):
+        logger.warning(f"Unexpected notification format: {notif}")
+        return None
+
+    message = notif.get("fullmessage", "")
+    subject = notif.get("subject", "")
+
+    # Use fullmessagehtml as a fallback if fullmessage is empty
+    if not message and notif.get("fullmessagehtml"):
+        message = notif.get("fullmessagehtml")
+
+    # Get timestamp
+    timestamp_str = notif.get("timecreated")
+    try:
+        # Convert Unix timestamp to datetime if available
+        timestamp = datetime.fromtimestamp(int(timestamp_str), tz=dt_timezone.utc) if timestamp_str else timezone.now()
+    except (ValueError, TypeError):
+        # If parsing fails, use current time
+        timestamp = timezone.now()
+
+    return {
+        'notification_id': str(notif.get("id", "")),
+        'message': message,
+        # Use subject as aria_label if available
+        'aria_label': (subject or message[:50])[:255],
+        'timestamp': timestamp,
+    }
+
+
+def ingest_rows(rows, university_name):
+    """
+    Stores the notifications of a university that are not in the database yet.
+
+    Existing IDs are fetched in one query and the new rows are inserted with a
+    single bulk INSERT. If another worker inserted some of them in between,
+    the rows are inserted one by one instead, so that only the notifications
+    this call created are returned (and sent to the webhook once).
+
+    Args:
+        rows: dicts of Notification fields
+        university_name: The university the notifications come from
+
+    Returns:
+        list: The primary keys of the notifications created by this call
+    """
+    by_id = {}
+    for row in rows:
+        by_id.setdefault(row['notification_id'], row)
+    if not by_id:
+        return []
+
+    stored = Notification.objects.filter(university=university_name)
+    existing = set(stored.filter(notification_id__in=list(by_id)).values_list('notification_id', flat=True))
+    new = [row for notification_id, row in by_id.items() if notification_id not in existing]
+    if not new:
+        return []
+    try:
+        with transaction.atomic():
+            Notification.objects.bulk_create([Notification(university=university_name, **row) for row in new])
+        return list(
+            stored.filter(notification_id__in=[row['notification_id'] for row in new]).values_list('pk', flat=True)
+        )
+    except IntegrityError:
+        pass
+
+    created = []
+    for row in new:
+        try:
+            with transaction.atomic():
+                notification = Notification.objects.create(university=university_name, **row)
+        except IntegrityError:
+            # Inserted by a concurrent sync
+            continue
+        created.append(notification.pk)
+    return created
+
+
+def ingest_notifications(notifications, university_name):
+    """
+    Stores the new notifications of a Moodle popup notifications response.
+
+    Returns:
+        list: The primary keys of the newly created notifications
+    """
+    rows = [notification_fields(notif) for notif in notifications]
+    return ingest_rows([row for row in rows if row is not None], university_name)
+
+
+def sync_notifications(session_cookies, university_name):
+    """
+    Fetches the notifications posted since the last sync of the Moodle user
+    and stores the new ones.
+
+    The high-water mark is only advanced once the notifications are stored,
+    so a failed sync is retried from the same point.
+
+    Returns:
+        tuple: The fetched notifications and the primary keys of the
+               newly created ones
+    """
+    # The sesskey/userId of the session are cached, the terminator only reloads
+    # them from Moodle when they are missing or rejected
+    cached_cfg = get_moodle_cfg(session_cookies, university_name)
+    terminator = MoodleTerminator(session_cookies, university_name, cfg=cached_cfg)
+    try:
+        return _sync(terminator, university_name)
+    finally:
+        store_moodle_cfg(session_cookies, university_name, terminator.cfg, cached_cfg)
+
+
+def _sync(terminator, university_name):
+    state, _ = NotificationSyncState.objects.get_or_create(
+        university=university_name, user_id=str(terminator.user_id),
+    )
+    since = _since(state)
+
+    notifications = terminator.get_notifications(since=since)
+    new_ids = ingest_notifications(notifications, university_name)
+    _advance_mark(state, notifications, since)
+    return notifications, new_ids
+
+
+def _since(state):
+    if state.last_timecreated or state.last_notification_id:
+        return {'timecreated': state.last_timecreated, 'id': state.last_notification_id}
+    return None
+
+
+def _advance_mark(state, notifications, since):
+    mark = high_water_mark(notifications, since)
+    if mark and mark != since:
+        state.last_timecreated = mark['timecreated']
+        state.last_notification_id = mark['id']
+        state.save(update_fields=['last_timecreated', 'last_notification_id', 'updated_at'])
+
+
+async def async_notifications(session_cookies, university_name):
+    """
+    Async counterpart of sync_notifications(): the Moodle calls go through the
+    shared async connection pool, the database work runs in a worker thread.
+
+    Returns:
+        tuple: The fetched notifications and the primary keys of the
+               newly created ones
+    """
+    cached_cfg = await sync_to_async(get_moodle_cfg, thread_sensitive=False)(session_cookies, university_name)
+    client = AsyncAjaxClient(AsyncMoodleSession(session_cookies), university_name, cached_cfg)
+    try:
+        await client.ensure_cfg()
+        state, _ = await NotificationSyncState.objects.aget_or_create(
+            university=university_name, user_id=str(client.user_id),
+        )
+        since = _since(state)
+
+        notifications = await aget_notifications(client, since=since)
+        new_ids = await sync_to_async(ingest_notifications)(notifications, university_name)
+        await sync_to_async(_advance_mark)(state, notifications, since)
+        return notifications, new_ids
+    finally:
+        await sync_to_async(store_moodle_cfg, thread_sensitive=False)(
+            session_cookies, university_name, client.cfg, cached_cfg
+        )
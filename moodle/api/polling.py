@@ -0,0 +1,125 @@
+# api/polling.py
+import statistics
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .sessions import SESSION_TIMEOUT
+
+# Per-host in-flight counters expire on their own if a worker dies mid-poll
+HOST_SLOT_TIMEOUT = 300
+# Pending poll markers expire on their own if a poll is lost before it runs
+POLL_PENDING_TIMEOUT = 600
+
+
+def poll_shard(token):
+    """
+    Returns the shard of a session token. Stable across beats, so a user is
+    always polled by the same workers.
+    """
+    return zlib.crc32(token.encode("utf-8")) % settings.NOTIFICATION_POLL_SHARDS
+
+
+def poll_jitter(token):
+    """
+    Returns the delay (in seconds) applied to a user's poll after each beat.
+    Derived from the token so that a user keeps a regular polling interval
+    while the users of a beat are spread over NOTIFICATION_POLL_JITTER.
+    """
+    spread_ms = int(settings.NOTIFICATION_POLL_JITTER * 1000)
+    if spread_ms <= 0:
+        return 0
+    return (zlib.crc32(token.encode("utf-8")) // settings.NOTIFICATION_POLL_SHARDS % spread_ms) / 1000
+
+
+def acquire_host_slot(host):
+    """
+    Takes one of the NOTIFICATION_POLL_HOST_CONCURRENCY poll slots of a Moodle
+    host, shared by all workers through the cache.
+
+    Returns:
+        bool: True if a slot was taken; release it with release_host_slot()
+    """
+    key = f"notification_poll_inflight_{host}"
+    cache.add(key, 0, timeout=HOST_SLOT_TIMEOUT)
+    try:
+        inflight = cache.incr(key)
+    except ValueError:
+        # The counter expired in between
+        cache.add(key, 1, timeout=HOST_SLOT_TIMEOUT)
+        inflight = 1
+    if inflight > settings.NOTIFICATION_POLL_HOST_CONCURRENCY:
+        release_host_slot(host)
+        return False
+    return True
+
+
+def release_host_slot(host):
+    try:
+        cache.decr(f"notification_poll_inflight_{host}")
+    except ValueError:
+        pass
+
+
+def mark_poll_pending(token):
+    """
+    Marks a user's poll as dispatched, so that the next beats do not queue
+    another one while it is still waiting for its jitter or retrying.
+
+    Returns:
+        bool: False if a poll of the session is already pending; clear the
+              mark with clear_poll_pending() once the poll is done
+    """
+    return cache.add(f"notification_poll_pending_{token}", 1, timeout=POLL_PENDING_TIMEOUT)
+
+
+def clear_poll_pending(token):
+    cache.delete(f"notification_poll_pending_{token}")
+
+
+def record_poll(token, duration, error=None):
+    """
+    Stores the outcome of a user's poll for poll_metrics().
+    """
+    key = f"notification_poll_{token}"
+    state = cache.get(key) or {}
+    now = time.time()
+    state.update({"last_poll": now, "duration": duration, "error": error})
+    if error is None:
+        state["last_success"] = now
+    cache.set(key, state, timeout=SESSION_TIMEOUT)
+
+
+def poll_metrics(sessions):
+    """
+    Summarizes poll latency and lag over the active sessions.
+
+    Args:
+        sessions: The active sessions, as returned by active_sessions()
+
+    Returns:
+        dict: Session counts, poll latency (seconds) and lag, i.e. the time
+              since the last successful poll of the most behind user
+    """
+    now = time.time()
+    states = cache.get_many([f"notification_poll_{token}" for token in sessions])
+    durations = []
+    lags = []
+    failing = 0
+    for token, entry in sessions.items():
+        state = states.get(f"notification_poll_{token}") or {}
+        if "duration" in state:
+            durations.append(state["duration"])
+        if state.get("error"):
+            failing += 1
+        lags.append(now - state.get("last_success", entry["registered_at"]))
+    return {
+        "sessions": len(sessions),
+        "polled": len(durations),
+        "failing": failing,
+        "latency_p50": statistics.median(durations) if durations else None,
+        "latency_max": max(durations) if durations else None,
+        "lag_max": max(lags) if lags else None,
+    }
@@ -0,0 +1,373 @@
+# api/resource_cache.py
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from services.blob_store import BlobStore
+from services.metrics import CACHE_REQUESTS
+from services.resources import aget_resource, get_resource
+from . import singleflight
+from .models import CachedResource
+from .responses import (
+    as_async_streaming, astreaming_resource_response, file_resource_response, streaming_resource_response,
+)
+
+logger = logging.getLogger(__name__)
+
+blob_store = BlobStore(settings.RESOURCE_CACHE_DIR)
+
+
+def _cached_entry(university_name, resource_id):
+    entry = CachedResource.objects.filter(university=university_name, resource_id=resource_id).first()
+    if entry is not None and not blob_store.exists(entry.digest):
+        # The blob was removed from disk behind our back
+        entry.delete()
+        return None
+    return entry
+
+
+def _serve_entry(request, entry):
+    CachedResource.objects.filter(pk=entry.pk).update(last_access=timezone.now())
+    return file_resource_response(
+        request,
+        blob_store.path(entry.digest),
+        entry.size,
+        entry.content_type,
+        entry.filename,
+        etag=entry.etag or f'"{entry.digest}"',
+        last_modified=entry.last_modified,
+    )
+
+
+def _fill_key(university_name, resource_id):
+    return f"resource_fill:{university_name}:{resource_id}"
+
+
+def _claim_fill(university_name, resource_id):
+    """
+    Returns the cached entry of a resource or, if it is not cached yet, the
+    lock of its download. When another request is already downloading it,
+    waits at most RESOURCE_FILL_WAIT seconds for it to land in the blob
+    store (small files do), so that a slow download does not hold the
+    others back.
+
+    Returns:
+        tuple: (CachedResource or None, flight id or None)
+    """
+    key = _fill_key(university_name, resource_id)
+    entry = _cached_entry(university_name, resource_id)
+    if entry is not None:
+        return entry, None
+    flight = singleflight.acquire(key, settings.RESOURCE_FILL_LOCK_TIMEOUT)
+    if flight is not None:
+        return None, flight
+    singleflight.wait_released(key, settings.RESOURCE_FILL_WAIT)
+    return _cached_entry(university_name, resource_id), None
+
+
+def _tee_to_store(upstream, university_name, resource_id, content_type, filename, flight):
+    """
+    Yields the upstream chunks while writing them to the blob store. The blob
+    is indexed once the whole body went through; an interrupted download is
+    discarded. The download lock (`flight`), if any, is released either way.
+    """
+    writer = blob_store.writer()
+    committed = False
+    try:
+        for chunk in upstream.iter_content(chunk_size=settings.RESOURCE_STREAM_CHUNK_SIZE):
+            writer.write(chunk)
+            yield chunk
+        digest, size = writer.commit()
+        committed = True
+        _index_blob(university_name, resource_id, digest, size, content_type, filename, upstream.headers)
+    finally:
+        if not committed:
+            writer.abort()
+        upstream.close()
+        if flight is not None:
+            singleflight.release(_fill_key(university_name, resource_id), flight)
+
+
+def _index_blob(university_name, resource_id, digest, size, content_type, filename, upstream_headers):
+    previous = _cached_entry(university_name, resource_id)
+    CachedResource.objects.update_or_create(
+        university=university_name,
+        resource_id=resource_id,
+        defaults={
+            'digest': digest,
+            'size': size,
+            'content_type': content_type,
+            'filename': filename,
+            'etag': upstream_headers.get('ETag', ''),
+            'last_modified': upstream_headers.get('Last-Modified', ''),
+            'last_access': timezone.now(),
+        }
+    )
+    if previous is not None and previous.digest != digest:
+        # The file changed upstream, drop the old blob if nothing else uses it
+        if not CachedResource.objects.filter(digest=previous.digest).exists():
+            blob_store.delete(previous.digest)
+    evict_resources(settings.RESOURCE_CACHE_MAX_BYTES)
+
+
+def _revalidation_headers(entry):
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+def serve_resource(request, session, resource_id, university_name):
+    """
+    Serves a Moodle resource through the on-disk blob store.
+
+    A cached copy is revalidated against Moodle with the user's session
+    (If-None-Match / If-Modified-Since), which also checks that the user may
+    still access the resource; on 304 it is served from disk. Otherwise the
+    file is streamed to the client and stored on the way.
+
+    Concurrent requests for a resource that is not cached yet download it
+    once. The others serve it from disk if it was stored within
+    RESOURCE_FILL_WAIT seconds, otherwise they stream it from Moodle.
+
+    Returns:
+        HttpResponse, or None if Moodle did not return the resource
+    """
+    if request.headers.get('Range') and _cached_entry(university_name, resource_id) is None:
+        # A partial download cannot fill the store, pass it through
+        result = get_resource(session, resource_id, university_name, headers=request.headers)
+        if 'error' in result:
+            return None
+        return streaming_resource_response(result['response'], result['content_type'], result['filename'])
+
+    key = _fill_key(university_name, resource_id)
+    entry, flight = _claim_fill(university_name, resource_id)
+    try:
+        result = get_resource(session, resource_id, university_name, headers=_revalidation_headers(entry))
+        if 'error' in result:
+            return None
+        upstream = result['response']
+
+        if entry is not None and upstream.status_code == 304:
+            upstream.close()
+            CACHE_REQUESTS.inc(cache="resource", kind="file", result="hit")
+            return _serve_entry(request, entry)
+
+        if upstream.status_code != 200:
+            return streaming_resource_response(upstream, result['content_type'], result['filename'])
+
+        if flight is None:
+            flight = singleflight.acquire(key, settings.RESOURCE_FILL_LOCK_TIMEOUT)
+        if flight is None:
+            # Another request is storing the file, pass this one through
+            return streaming_resource_response(upstream, result['content_type'], result['filename'])
+
+        chunks = _tee_to_store(
+            upstream, university_name, resource_id, result['content_type'], result['filename'], flight
+        )
+        CACHE_REQUESTS.inc(cache="resource", kind="file", result="miss")
+        # Released by _tee_to_store()
+        flight = None
+        return streaming_resource_response(upstream, result['content_type'], result['filename'], chunks=chunks)
+    finally:
+        if flight is not None:
+            singleflight.release(key, flight)
+
+
+def ensure_resource(session, resource_id, university_name):
+    """
+    Makes sure the blob store holds the current version of a resource,
+    revalidating or downloading it like serve_resource() does, without
+    serving it.
+
+    Returns:
+        CachedResource, or None if Moodle did not return the resource
+    """
+    key = _fill_key(university_name, resource_id)
+    entry, flight = _claim_fill(university_name, resource_id)
+    try:
+        result = get_resource(session, resource_id, university_name, headers=_revalidation_headers(entry))
+        if 'error' in result:
+            return None
+        upstream = result['response']
+
+        if entry is not None and upstream.status_code == 304:
+            upstream.close()
+            CACHE_REQUESTS.inc(cache="resource", kind="file", result="hit")
+            CachedResource.objects.filter(pk=entry.pk).update(last_access=timezone.now())
+            return entry
+
+        if upstream.status_code != 200:
+            upstream.close()
+            return None
+
+        if flight is None:
+            flight = singleflight.acquire(key, settings.RESOURCE_FILL_LOCK_TIMEOUT)
+        # Without the lock another request is storing the file too; storing
+        # the same content twice is cheaper than waiting for its download
+        chunks = _tee_to_store(
+            upstream, university_name, resource_id, result['content_type'], result['filename'], flight
+        )
+        CACHE_REQUESTS.inc(cache="resource", kind="file", result="miss")
+        # Released by _tee_to_store()
+        flight = None
+        for _ in chunks:
+            pass
+        return _cached_entry(university_name, resource_id)
+    finally:
+        if flight is not None:
+            singleflight.release(key, flight)
+
+
+async def _atee_to_store(upstream, university_name, resource_id, content_type, filename, flight):
+    """
+    Async counterpart of _tee_to_store(), for an httpx response.
+    """
+    writer = blob_store.writer()
+    committed = False
+    try:
+        async for chunk in upstream.aiter_bytes(settings.RESOURCE_STREAM_CHUNK_SIZE):
+            writer.write(chunk)
+            yield chunk
+        digest, size = writer.commit()
+        committed = True
+        await sync_to_async(_index_blob)(
+            university_name, resource_id, digest, size, content_type, filename, upstream.headers
+        )
+    finally:
+        if not committed:
+            writer.abort()
+        await upstream.aclose()
+        if flight is not None:
+            await singleflight.arelease(_fill_key(university_name, resource_id), flight)
+
+
+async def _aclaim_fill(university_name, resource_id):
+    """
+    Async counterpart of _claim_fill().
+    """
+    key = _fill_key(university_name, resource_id)
+    entry = await sync_to_async(_cached_entry)(university_name, resource_id)
+    if entry is not None:
+        return entry, None
+    flight = await singleflight.aacquire(key, settings.RESOURCE_FILL_LOCK_TIMEOUT)
+    if flight is not None:
+        return None, flight
+    await singleflight.await_released(key, settings.RESOURCE_FILL_WAIT)
+    return await sync_to_async(_cached_entry)(university_name, resource_id), None
+
+
+async def aserve_resource(request, session, resource_id, university_name):
+    """
+    Async counterpart of serve_resource(), with an AsyncMoodleSession.
+
+    Returns:
+        HttpResponse, or None if Moodle did not return the resource
+    """
+    if request.headers.get('Range') and await sync_to_async(_cached_entry)(university_name, resource_id) is None:
+        # A partial download cannot fill the store, pass it through
+        result = await aget_resource(session, resource_id, university_name, headers=request.headers)
+        if 'error' in result:
+            return None
+        return await astreaming_resource_response(result['response'], result['content_type'], result['filename'])
+
+    key = _fill_key(university_name, resource_id)
+    entry, flight = await _aclaim_fill(university_name, resource_id)
+    try:
+        result = await aget_resource(session, resource_id, university_name, headers=_revalidation_headers(entry))
+        if 'error' in result:
+            return None
+        upstream = result['response']
+
+        if entry is not None and upstream.status_code == 304:
+            await upstream.aclose()
+            CACHE_REQUESTS.inc(cache="resource", kind="file", result="hit")
+            return as_async_streaming(await sync_to_async(_serve_entry)(request, entry))
+
+        if upstream.status_code != 200:
+            return await astreaming_resource_response(upstream, result['content_type'], result['filename'])
+
+        if flight is None:
+            flight = await singleflight.aacquire(key, settings.RESOURCE_FILL_LOCK_TIMEOUT)
+        if flight is None:
+            # Another request is storing the file, pass this one through
+            return await astreaming_resource_response(upstream, result['content_type'], result['filename'])
+
+        chunks = _atee_to_store(
+            upstream, university_name, resource_id, result['content_type'], result['filename'], flight
+        )
+        CACHE_REQUESTS.inc(cache="resource", kind="file", result="miss")
+        # Released by _atee_to_store()
+        flight = None
+        return await astreaming_resource_response(
+            upstream, result['content_type'], result['filename'], chunks=chunks
+        )
+    finally:
+        if flight is not None:
+            await singleflight.arelease(key, flight)
+
+
+async def aensure_resource(session, resource_id, university_name):
+    """
+    Async counterpart of ensure_resource(), with an AsyncMoodleSession.
+    """
+    key = _fill_key(university_name, resource_id)
+    entry, flight = await _aclaim_fill(university_name, resource_id)
+    try:
+        result = await aget_resource(session, resource_id, university_name, headers=_revalidation_headers(entry))
+        if 'error' in result:
+            return None
+        upstream = result['response']
+
+        if entry is not None and upstream.status_code == 304:
+            await upstream.aclose()
+            CACHE_REQUESTS.inc(cache="resource", kind="file", result="hit")
+            await CachedResource.objects.filter(pk=entry.pk).aupdate(last_access=timezone.now())
+            return entry
+
+        if upstream.status_code != 200:
+            await upstream.aclose()
+            return None
+
+        if flight is None:
+            flight = await singleflight.aacquire(key, settings.RESOURCE_FILL_LOCK_TIMEOUT)
+        # Without the lock another request is storing the file too; storing
+        # the same content twice is cheaper than waiting for its download
+        chunks = _atee_to_store(
+            upstream, university_name, resource_id, result['content_type'], result['filename'], flight
+        )
+        CACHE_REQUESTS.inc(cache="resource", kind="file", result="miss")
+        # Released by _atee_to_store()
+        flight = None
+        async for _ in chunks:
+            pass
+        return await sync_to_async(_cached_entry)(university_name, resource_id)
+    finally:
+        if flight is not None:
+            await singleflight.arelease(key, flight)
+
+
+def evict_resources(max_bytes):
+    """
+    Evicts the least recently used resources until the blobs referenced by
+    the index fit in `max_bytes`. A blob is deleted once no resource
+    references it anymore.
+    """
+    digests = CachedResource.objects.values('digest', 'size').distinct()
+    total = sum(row['size'] for row in digests)
+    if total <= max_bytes:
+        return
+
+    for entry in CachedResource.objects.order_by('last_access').iterator():
+        if total <= max_bytes:
+            break
+        entry.delete()
+        if not CachedResource.objects.filter(digest=entry.digest).exists():
+            blob_store.delete(entry.digest)
+            total -= entry.size
+            logger.info(f"Evicted resource blob {entry.digest} ({entry.size} bytes)")
@@ -0,0 +1,242 @@
+# api/responses.py
+import asyncio
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, parse_etags
+
+# Upstream response headers passed through to the client
+PASSTHROUGH_HEADERS = ('Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+
+def _iter_upstream(upstream, chunk_size):
+    try:
+        yield from upstream.iter_content(chunk_size=chunk_size)
+    finally:
+        upstream.close()
+
+
+def _resource_response(upstream, chunks, content_type, filename):
+    if upstream.status_code in (304, 416):
+        response = HttpResponse(status=upstream.status_code)
+    else:
+        response = StreamingHttpResponse(chunks, status=upstream.status_code, content_type=content_type)
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+        # The upstream body is decoded on the way, the upstream length only
+        # matches when the body is sent as is
+        content_length = upstream.headers.get('Content-Length')
+        if content_length and not upstream.headers.get('Content-Encoding'):
+            response['Content-Length'] = content_length
+
+    for name in PASSTHROUGH_HEADERS:
+        if upstream.headers.get(name):
+            response[name] = upstream.headers[name]
+    return response
+
+
+def streaming_resource_response(upstream, content_type, filename, chunks=None):
+    """
+    Pipes an open upstream requests response to the client chunk by chunk.
+
+    The upstream status is kept, so 206 partial content and 304 not modified
+    answers to Range / conditional requests are passed through.
+
+    Args:
+        upstream: A requests response opened with stream=True
+        content_type: The Content-Type of the file
+        filename: The filename announced in Content-Disposition
+        chunks: Iterator over the body, defaults to the upstream chunks
+
+    Returns:
+        StreamingHttpResponse or HttpResponse (for bodiless answers)
+    """
+    if upstream.status_code in (304, 416):
+        upstream.close()
+    return _resource_response(
+        upstream,
+        chunks or _iter_upstream(upstream, settings.RESOURCE_STREAM_CHUNK_SIZE),
+        content_type,
+        filename,
+    )
+
+
+async def _aiter_upstream(upstream, chunk_size):
+    try:
+        async for chunk in upstream.aiter_bytes(chunk_size):
+            yield chunk
+    finally:
+        await upstream.aclose()
+
+
+async def astreaming_resource_response(upstream, content_type, filename, chunks=None):
+    """
+    Async counterpart of streaming_resource_response(), for an open httpx
+    response. The body is streamed from an async iterator, so serving it
+    does not hold a worker thread under ASGI.
+    """
+    if upstream.status_code in (304, 416):
+        await upstream.aclose()
+    return _resource_response(
+        upstream,
+        chunks or _aiter_upstream(upstream, settings.RESOURCE_STREAM_CHUNK_SIZE),
+        content_type,
+        filename,
+    )
+
+
+async def _aiter_blocking(iterator):
+    # Each chunk is read in a worker thread, one at a time
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+
+def as_async_streaming(response):
+    """
+    Makes a streaming response built on blocking file reads (e.g. by
+    file_resource_response()) stream from an async iterator. Under ASGI,
+    Django would otherwise read the whole file into memory first.
+    """
+    if response.streaming and not response.is_async:
+        file = getattr(response, 'file_to_stream', None)
+        if file is not None:
+            iterator = iter(lambda: file.read(settings.RESOURCE_STREAM_CHUNK_SIZE), b'')
+        else:
+            iterator = iter(response.streaming_content)
+        response.streaming_content = _aiter_blocking(iterator)
+    return response
+
+
+def _parse_range(range_header, size):
+    """
+    Parses a single byte range of a Range header.
+
+    Returns:
+        tuple: The inclusive (start, end) offsets, None when the whole file
+               should be served, or False when the range is unsatisfiable
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header or "")
+    if not match or match.group(1) == match.group(2) == "":
+        # Missing, malformed or multi-range requests get the whole file
+        return None
+    if match.group(1) == "":
+        # Suffix range: the last N bytes
+        length = int(match.group(2))
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def _iter_file_range(path, start, length, chunk_size):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_resource_response(request, path, size, content_type, filename, etag="", last_modified=""):
+    """
+    Serves a file from local disk with conditional and Range support.
+
+    Whole files go through FileResponse so the WSGI server can use sendfile;
+    single byte ranges are answered with 206 partial content.
+
+    Args:
+        request: The client request
+        path: Path of the file on disk
+        size: Size of the file in bytes
+        content_type: The Content-Type of the file
+        filename: The filename announced in Content-Disposition
+        etag: The ETag of the file, if any
+        last_modified: The Last-Modified date of the file, if any
+
+    Returns:
+        HttpResponse
+    """
+    if etag and etag_matches(request, etag):
+        response = HttpResponse(status=304)
+    else:
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range in (etag, last_modified):
+            byte_range = _parse_range(request.headers.get('Range'), size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                _iter_file_range(path, start, end - start + 1, settings.RESOURCE_STREAM_CHUNK_SIZE),
+                status=206,
+                content_type=content_type,
+            )
+            response['Content-Length'] = str(end - start + 1)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Disposition'] = f'inline; filename="{filename}"'
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type, filename=filename)
+
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = last_modified
+    return response
+
+
+def archive_response(chunks, filename):
+    """
+    Streams a ZIP archive built on the fly as a download. The length is not
+    known in advance, the archive is sent chunked.
+    """
+    response = StreamingHttpResponse(chunks, content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(as_attachment=True, filename=filename)
+    return response
+
+
+def etag_matches(request, etag):
+    """
+    Tells whether the If-None-Match header of a request lists `etag`, with
+    the weak comparison used for GET requests.
+    """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = parse_etags(header)
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def conditional_data_response(request, data, etag, response_class=JsonResponse, private=True):
+    """
+    Answers `{'data': data}` with its ETag, or 304 Not Modified without
+    serializing anything when the client already has that version.
+
+    Args:
+        response_class: JsonResponse, or the DRF Response in DRF views
+        private: The data belongs to one user, shared caches must not keep it
+    """
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = response_class({'data': data})
+    response['ETag'] = etag
+    # Clients may keep the body but must revalidate it on every use
+    response['Cache-Control'] = 'private, no-cache' if private else 'no-cache'
+    return response
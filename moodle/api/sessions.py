@@ -0,0 +1,358 @@
+# api/sessions.py
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import salted_hmac
+from django_redis import get_redis_connection
+
+from services import async_http, tenants
+from services.async_http import AsyncMoodleSession
+from services.login import probe_session
+from services.session_pool import SessionPool
+from services.webservice import WebServiceClient
+
+# Anonymous requests (no or expired session token) share this pool key,
+# suffixed with their university
+ANONYMOUS_SESSION = "__anonymous__"
+
+session_pool = SessionPool(
+    max_sessions=settings.MOODLE_SESSION_POOL_MAX_SESSIONS,
+    idle_timeout=settings.MOODLE_SESSION_POOL_IDLE_TIMEOUT,
+    pool_maxsize=settings.MOODLE_SESSION_POOL_MAXSIZE,
+    max_total_connections=settings.MOODLE_SESSION_POOL_MAX_CONNECTIONS,
+)
+
+async_http.configure(
+    max_connections=settings.MOODLE_ASYNC_MAX_CONNECTIONS,
+    max_keepalive=settings.MOODLE_ASYNC_MAX_KEEPALIVE,
+    timeout=settings.MOODLE_ASYNC_TIMEOUT,
+)
+
+
+def get_session(token, allow_anonymous=False, university_name=None):
+    """
+    Returns the pooled requests session for a session token.
+
+    Args:
+        token: The session token returned by /api/login/
+        allow_anonymous: Return a cookie-less session instead of None when the
+                         token is missing or expired
+        university_name: The university of the anonymous session, so that
+                         each Moodle gets connections of its own
+
+    Returns:
+        requests.Session or None if the token is invalid or expired
+    """
+    cookie_json = cache.get(f"scrape_session_{token}") if token else None
+    if not cookie_json:
+        if token:
+            # The token expired, release its connections
+            session_pool.evict(token)
+        if allow_anonymous:
+            return session_pool.get(f"{ANONYMOUS_SESSION}:{university_name or ''}")
+        return None
+    return session_pool.get(token, cookie_json)
+
+
+def _request_university(request, meta, requested):
+    if meta:
+        # A token only works on the Moodle it was issued for
+        university = meta["university"]
+    else:
+        university = requested or request.GET.get('university') or tenants.default_tenant()
+    if not tenants.is_tenant(university):
+        return None
+    # Label of the per-university request metrics (see MetricsMiddleware)
+    getattr(request, '_request', request).university = university
+    return university
+
+
+def request_university(request, token=None, requested=None):
+    """
+    Returns the university (tenant) an API request is for: the one its
+    session token was issued for, else the requested one (by default the
+    `university` query parameter), else MOODLE_DEFAULT_TENANT.
+
+    Returns:
+        str, or None if that university is not served by this deployment
+    """
+    meta = cache.get(f"scrape_session_meta_{token}") if token else None
+    return _request_university(request, meta, requested)
+
+
+async def arequest_university(request, token=None, requested=None):
+    """
+    Async counterpart of request_university().
+    """
+    meta = await cache.aget(f"scrape_session_meta_{token}") if token else None
+    return _request_university(request, meta, requested)
+
+
+async def aget_session(token, allow_anonymous=False):
+    """
+    Async counterpart of get_session(): returns an AsyncMoodleSession with the
+    cookies of a session token, sharing the connections of the event loop.
+
+    Returns:
+        AsyncMoodleSession or None if the token is invalid or expired
+    """
+    cookie_json = await cache.aget(f"scrape_session_{token}") if token else None
+    if not cookie_json:
+        if allow_anonymous:
+            return AsyncMoodleSession()
+        return None
+    return AsyncMoodleSession(json.loads(cookie_json))
+
+
+# Registry of the active session tokens, so that background tasks can find
+# them without scanning the cache keyspace. On Redis it is a set; other cache
+# backends keep it in a single entry updated under a lock. The university and
+# timestamps of each token live in their own entry, next to its cookies.
+SESSION_REGISTRY_KEY = "scrape_session_registry"
+SESSION_TIMEOUT = 7200
+_REGISTRY_LOCK_KEY = "scrape_session_registry_lock"
+
+
+def redis_client():
+    """
+    Returns the Redis client of the cache, or None on other cache backends.
+    """
+    try:
+        return get_redis_connection("default")
+    except NotImplementedError:
+        return None
+
+
+@contextmanager
+def _registry_lock(timeout=5):
+    # cache.add() is atomic, it only succeeds for one caller at a time
+    deadline = time.monotonic() + timeout
+    acquired = cache.add(_REGISTRY_LOCK_KEY, 1, timeout=timeout)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.01)
+        acquired = cache.add(_REGISTRY_LOCK_KEY, 1, timeout=timeout)
+    try:
+        yield
+    finally:
+        if acquired:
+            cache.delete(_REGISTRY_LOCK_KEY)
+
+
+def _index_add(token):
+    client = redis_client()
+    if client is not None:
+        client.sadd(cache.make_key(SESSION_REGISTRY_KEY), token)
+        return
+    with _registry_lock():
+        tokens = set(cache.get(SESSION_REGISTRY_KEY) or ())
+        tokens.add(token)
+        cache.set(SESSION_REGISTRY_KEY, tokens, timeout=None)
+
+
+def _index_remove(tokens):
+    client = redis_client()
+    if client is not None:
+        client.srem(cache.make_key(SESSION_REGISTRY_KEY), *tokens)
+        return
+    with _registry_lock():
+        registered = set(cache.get(SESSION_REGISTRY_KEY) or ())
+        registered.difference_update(tokens)
+        cache.set(SESSION_REGISTRY_KEY, registered, timeout=None)
+
+
+def _index_members():
+    client = redis_client()
+    if client is not None:
+        return {token.decode("utf-8") for token in client.smembers(cache.make_key(SESSION_REGISTRY_KEY))}
+    return set(cache.get(SESSION_REGISTRY_KEY) or ())
+
+
+def store_session(token, cookies_json, university_name):
+    """
+    Stores the Moodle cookies of a new session token and registers the token
+    for background notification polling.
+    """
+    cache.set_many({
+        f"scrape_session_{token}": cookies_json,
+        f"scrape_session_meta_{token}": {"university": university_name, "registered_at": time.time()},
+    }, timeout=SESSION_TIMEOUT)
+    _index_add(token)
+
+
+def login_key(username, password, university_name):
+    """
+    Returns the cache key remembering the session token of a login. The
+    credentials only enter it through an HMAC keyed with SECRET_KEY, they are
+    never stored.
+    """
+    digest = salted_hmac(
+        "api.sessions.login_key", f"{university_name}\0{username}\0{password}", algorithm="sha256"
+    ).hexdigest()
+    return f"login_session_{digest}"
+
+
+def remember_login(key, token):
+    cache.set(key, token, timeout=settings.SESSION_MAX_AGE)
+
+
+def reusable_session(key, university_name):
+    """
+    Looks up the session token of a previous login with the same credentials
+    and probes its Moodle session.
+
+    Returns:
+        tuple: (token, cookies_json). cookies_json is None when the Moodle
+               session expired and must be logged in again; token is None
+               when there was no previous login.
+    """
+    token = cache.get(key)
+    if not token:
+        return None, None
+    cookies_json = cache.get(f"scrape_session_{token}")
+    if not cookies_json:
+        return token, None
+    try:
+        alive = probe_session(session_pool.get(token, cookies_json), university_name)
+    except requests.RequestException:
+        alive = False
+    return token, cookies_json if alive else None
+
+
+def session_needs_refresh(entry, now=None):
+    """
+    Tells whether the cached cookies of a registered session expire within
+    SESSION_REFRESH_MARGIN seconds. Sessions first registered more than
+    SESSION_MAX_AGE seconds ago are left to expire.
+    """
+    now = now or time.time()
+    if now - entry["registered_at"] >= settings.SESSION_MAX_AGE:
+        return False
+    stored_at = entry.get("refreshed_at", entry["registered_at"])
+    return now - stored_at >= SESSION_TIMEOUT - settings.SESSION_REFRESH_MARGIN
+
+
+def renew_session(token, university_name):
+    """
+    Keeps a session token alive: probes its Moodle session (which also keeps
+    it active on Moodle's side) and caches its cookies for another
+    SESSION_TIMEOUT. A session logged out of Moodle is dropped.
+
+    Returns:
+        bool: True if the session was renewed
+
+    Raises:
+        requests.RequestException: If Moodle could not be reached
+    """
+    cookies_json = cache.get(f"scrape_session_{token}")
+    if not cookies_json:
+        unregister_session(token)
+        return False
+
+    session = session_pool.get(token, cookies_json)
+    if not probe_session(session, university_name):
+        cache.delete(f"scrape_session_{token}")
+        unregister_session(token)
+        return False
+
+    # Moodle may have rotated a cookie along the way
+    cookies = session.cookies.get_dict()
+    meta = cache.get(f"scrape_session_meta_{token}") or {
+        "university": university_name, "registered_at": time.time(),
+    }
+    cache.set_many({
+        f"scrape_session_{token}": json.dumps(cookies),
+        f"scrape_session_meta_{token}": dict(meta, refreshed_at=time.time()),
+    }, timeout=SESSION_TIMEOUT)
+    cache.touch(f"webservice_token_{token}", timeout=SESSION_TIMEOUT)
+    cache.touch(_cfg_key(cookies, university_name), timeout=SESSION_TIMEOUT)
+    return True
+
+
+def unregister_session(token):
+    cache.delete(f"scrape_session_meta_{token}")
+    _index_remove([token])
+    session_pool.evict(token)
+
+
+def active_sessions():
+    """
+    Returns the registered session tokens whose cookies are still cached.
+    Expired tokens are dropped from the registry.
+
+    Returns:
+        dict: token -> {"university": ..., "registered_at": ...} (plus
+              "refreshed_at" once renewed)
+    """
+    tokens = _index_members()
+    entries = cache.get_many(
+        [f"scrape_session_{token}" for token in tokens] + [f"scrape_session_meta_{token}" for token in tokens]
+    )
+    sessions = {}
+    expired = []
+    for token in tokens:
+        meta = entries.get(f"scrape_session_meta_{token}")
+        if meta is not None and f"scrape_session_{token}" in entries:
+            sessions[token] = meta
+        else:
+            expired.append(token)
+    if expired:
+        _index_remove(expired)
+    return sessions
+
+
+def _cfg_key(session_cookies, university_name):
+    # Keyed on the Moodle session cookie, a new Moodle session gets a new sesskey
+    moodle_session = session_cookies.get("MoodleSession") or ""
+    digest = hashlib.sha256(moodle_session.encode("utf-8")).hexdigest()
+    return f"moodle_cfg_{university_name}_{digest}"
+
+
+def get_moodle_cfg(session_cookies, university_name):
+    """
+    Returns the cached sesskey/userId (M.cfg) of a Moodle session, or None.
+
+    Args:
+        session_cookies: The Moodle cookies, as a dict or cookie jar
+        university_name: The university subdomain (e.g. 'bba')
+    """
+    return cache.get(_cfg_key(session_cookies, university_name))
+
+
+def store_moodle_cfg(session_cookies, university_name, cfg, previous=None):
+    """
+    Caches the sesskey/userId of a Moodle session when they changed.
+    """
+    if cfg and cfg != previous:
+        cache.set(_cfg_key(session_cookies, university_name), cfg, timeout=SESSION_TIMEOUT)
+
+
+def moodle_backend(university_name):
+    """
+    Returns the backend used to fetch catalog data of a university:
+    "scraper" (HTML pages) or "webservice" (REST web service).
+    """
+    return tenants.get_tenant(university_name).backend or settings.MOODLE_DEFAULT_BACKEND
+
+
+def store_webservice_token(token, ws_token, university_name):
+    cache.set(f"webservice_token_{token}", {"token": ws_token, "university": university_name},
+              timeout=SESSION_TIMEOUT)
+
+
+def get_webservice_client(token, university_name, session):
+    """
+    Returns a web service client for a session token, or None if the
+    university does not use the web service backend or the user has no
+    web service token.
+    """
+    if not token or moodle_backend(university_name) != "webservice":
+        return None
+    entry = cache.get(f"webservice_token_{token}")
+    if not entry or entry["university"] != university_name:
+        return None
+    return WebServiceClient(session, university_name, entry["token"])
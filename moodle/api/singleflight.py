@@ -0,0 +1,232 @@
+# api/singleflight.py
+import asyncio
+import logging
+import threading
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+
+from services.metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
+# How long the leader's result stays readable by the requests that waited on it
+RESULT_TIMEOUT = 60
+# Polling interval of the requests waiting on another process (seconds)
+POLL_INITIAL = 0.05
+POLL_MAX = 0.5
+
+_MISSING = object()
+
+# Calls in flight in this process: threads wait on an Event, coroutines on a
+# task of their event loop
+_calls = {}
+_calls_lock = threading.Lock()
+_async_calls = weakref.WeakKeyDictionary()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _lock_key(key):
+    return f"singleflight_lock:{key}"
+
+
+def _result_key(key, flight):
+    return f"singleflight_result:{key}:{flight}"
+
+
+def acquire(key, timeout=None):
+    """
+    Takes the lock of `key`, shared by all processes through the cache.
+
+    Returns:
+        str: The flight id to pass to release(), or None if the lock is held
+    """
+    flight = uuid.uuid4().hex
+    if cache.add(_lock_key(key), flight, timeout=timeout or settings.SINGLEFLIGHT_LOCK_TIMEOUT):
+        return flight
+    return None
+
+
+def release(key, flight):
+    # The lock may have expired and been taken by someone else in between
+    if cache.get(_lock_key(key)) == flight:
+        cache.delete(_lock_key(key))
+
+
+def wait_released(key, timeout):
+    """
+    Waits until nobody holds the lock of `key`.
+
+    Returns:
+        bool: False if the lock was still held after `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    delay = POLL_INITIAL
+    while cache.get(_lock_key(key)) is not None:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+    return True
+
+
+async def aacquire(key, timeout=None):
+    flight = uuid.uuid4().hex
+    if await cache.aadd(_lock_key(key), flight, timeout=timeout or settings.SINGLEFLIGHT_LOCK_TIMEOUT):
+        return flight
+    return None
+
+
+async def arelease(key, flight):
+    if await cache.aget(_lock_key(key)) == flight:
+        await cache.adelete(_lock_key(key))
+
+
+async def await_released(key, timeout):
+    """
+    Async counterpart of wait_released().
+    """
+    deadline = time.monotonic() + timeout
+    delay = POLL_INITIAL
+    while await cache.aget(_lock_key(key)) is not None:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+    return True
+
+
+def _shared(key, fetch):
+    """
+    Runs `fetch` in at most one process at a time: the other processes wait
+    for its result in the cache. If the leader fails, one of the waiting
+    processes takes over.
+    """
+    deadline = time.monotonic() + settings.SINGLEFLIGHT_WAIT
+    delay = POLL_INITIAL
+    waiting_on = None
+    while True:
+        if waiting_on is not None:
+            result = cache.get(_result_key(key, waiting_on), _MISSING)
+            if result is not _MISSING:
+                return result
+
+        flight = acquire(key)
+        if flight is not None:
+            try:
+                result = fetch()
+                cache.set(_result_key(key, flight), result, timeout=RESULT_TIMEOUT)
+                return result
+            finally:
+                release(key, flight)
+
+        waiting_on = cache.get(_lock_key(key)) or waiting_on
+        if time.monotonic() >= deadline:
+            logger.warning(f"Gave up waiting for the fetch of {key}, fetching it again")
+            RETRIES.inc(reason="singleflight_timeout")
+            return fetch()
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+
+
+def do(key, fetch):
+    """
+    Collapses concurrent identical fetches into one: `fetch` runs once for
+    all the threads and processes asking for `key` at the same time, and
+    every caller gets its result.
+
+    Args:
+        key: Identifies the fetch, e.g. a catalog cache key
+        fetch: Callable without arguments returning a picklable result
+
+    Returns:
+        The result of `fetch`. The threads of this process that joined a
+        failed call get its exception.
+    """
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _shared(key, fetch)
+        return call.result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key]
+        call.event.set()
+
+
+async def _ashared(key, fetch):
+    """
+    Async counterpart of _shared().
+    """
+    deadline = time.monotonic() + settings.SINGLEFLIGHT_WAIT
+    delay = POLL_INITIAL
+    waiting_on = None
+    while True:
+        if waiting_on is not None:
+            result = await cache.aget(_result_key(key, waiting_on), _MISSING)
+            if result is not _MISSING:
+                return result
+
+        flight = await aacquire(key)
+        if flight is not None:
+            try:
+                result = await fetch()
+                await cache.aset(_result_key(key, flight), result, timeout=RESULT_TIMEOUT)
+                return result
+            finally:
+                await arelease(key, flight)
+
+        waiting_on = await cache.aget(_lock_key(key)) or waiting_on
+        if time.monotonic() >= deadline:
+            logger.warning(f"Gave up waiting for the fetch of {key}, fetching it again")
+            RETRIES.inc(reason="singleflight_timeout")
+            return await fetch()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+
+
+def _forget(calls, key):
+    def callback(task):
+        calls.pop(key, None)
+        # Retrieved here so that a failure nobody waited for is not logged
+        if not task.cancelled():
+            task.exception()
+    return callback
+
+
+async def ado(key, fetch):
+    """
+    Async counterpart of do(): `fetch` is a coroutine function, and the
+    coroutines of the running event loop asking for `key` share its result.
+    """
+    loop = asyncio.get_running_loop()
+    calls = _async_calls.setdefault(loop, {})
+    task = calls.get(key)
+    if task is None:
+        # A task of its own, so that the fetch goes on if the request that
+        # started it is cancelled (client disconnected)
+        task = calls[key] = loop.create_task(_ashared(key, fetch))
+        task.add_done_callback(_forget(calls, key))
+    return await asyncio.shield(task)
@@ -1,153 +1,300 @@
 # api/tasks.py
 from celery import shared_task
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import random
+import time
+import uuid
+from datetime import timedelta
+from urllib.parse import urlparse
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
 import logging
-from datetime import datetime
+from .catalog_cache import refresh_catalog
+from .catalog_store import store_catalog_data
 from .models import Notification
-from services.notification import get_notifications
+from .notifications import sync_notifications
+from .polling import (
+    acquire_host_slot, clear_poll_pending, mark_poll_pending, poll_jitter, poll_metrics, poll_shard, record_poll,
+    release_host_slot,
+)
+from .sessions import active_sessions, renew_session, session_needs_refresh, unregister_session
+from services.hosts import moodle_url
 
 logger = logging.getLogger(__name__)
 
 @shared_task
 def scrape_notifications():
     """
-    Task that scrapes notifications from Moodle and stores them in the database.
+    Task that dispatches a notification poll for every active session.
     This task is scheduled to run periodically via Celery Beat.
 
-    Note: This task requires valid session cookies to be stored in the cache.
+    Sessions are read from the session registry filled at login. Each poll
+    runs as its own task, delayed by a per-user jitter and, when
+    NOTIFICATION_POLL_SHARDS > 1, routed to the "notifications-<shard>" queue
+    so that the users are spread over the workers consuming those queues.
+    Sessions whose previous poll has not run yet are skipped.
     """
     try:
-        # Get all active session tokens from cache
-        # This is a simplified approach - in production, you might want to use a more robust method
-        # to store and retrieve session credentials
-
-        # For now, we'll check if there's a stored session in settings
-        if hasattr(settings, 'MOODLE_SESSION_COOKIES') and settings.MOODLE_SESSION_COOKIES:
-            session_cookies = settings.MOODLE_SESSION_COOKIES
-            logger.info("Using session cookies from settings")
-        else:
-            # Try to find any active session in cache
-            # This is just a fallback and not reliable for production
-            active_sessions = []
-            for key in cache.keys("scrape_session_*"):
-                cookie_json = cache.get(key)
-                if cookie_json:
-                    active_sessions.append(json.loads(cookie_json))
-
-            if not active_sessions:
-                logger.warning("No active sessions found in cache")
-                return "No active sessions found"
-
-            # Use the first active session
-            session_cookies = active_sessions[0]
-            logger.info("Using session cookies from cache")
-
-        # Use the MoodleTerminator to get notifications
-        notifications = get_notifications(session_cookies)
-
-        if not notifications:
-            logger.info("No notifications found")
-            return "No notifications found"
-
-        # Process notifications
-        new_notifications = []
-        for notif in notifications:
-            # Extract notification details
-            notif_id = notif.get("id", "")
-            message = notif.get("fullmessage", "")
-            subject = notif.get("subject", "")
-
-            # Use fullmessagehtml as a fallback if fullmessage is empty
-            if not message and notif.get("fullmessagehtml"):
-                message = notif.get("fullmessagehtml")
-
-            # Use subject as aria_label if available
-            aria_label = subject or message[:50]
-
-            # Get timestamp
-            timestamp_str = notif.get("timecreated")
-            try:
-                # Convert Unix timestamp to datetime if available
-                timestamp = datetime.fromtimestamp(int(timestamp_str)) if timestamp_str else datetime.now()
-            except (ValueError, TypeError):
-                # If parsing fails, use current time
-                timestamp = datetime.now()
-
-            # Store new notifications in the database
-            notification, created = Notification.objects.get_or_create(
-                notification_id=notif_id,
-                defaults={
-                    'message': message,
-                    'aria_label': aria_label,
-                    'timestamp': timestamp
-                }
-            )
-
-            if created:
-                new_notifications.append(notification)
-                # Trigger the webhook for each new notification
-                send_notification_to_webhook.delay(notification.notification_id)
-
-        return f"Scraped {len(notifications)} notifications, {len(new_notifications)} new"
+        # Optional account configured in settings (see MOODLE_SESSION_COOKIES)
+        if getattr(settings, 'MOODLE_SESSION_COOKIES', None):
+            logger.info("Polling session cookies from settings")
+            _, new_ids = sync_notifications(settings.MOODLE_SESSION_COOKIES, settings.MOODLE_DEFAULT_TENANT)
+            enqueue_webhooks(new_ids)
+
+        sessions = active_sessions()
+        if not sessions:
+            logger.info("No active sessions to poll")
+            return "No active sessions found"
+
+        dispatched = 0
+        for token, entry in sessions.items():
+            if not mark_poll_pending(token):
+                continue
+            options = {'countdown': poll_jitter(token)}
+            if settings.NOTIFICATION_POLL_SHARDS > 1:
+                options['queue'] = f"notifications-{poll_shard(token)}"
+            poll_session_notifications.apply_async((token, entry['university']), **options)
+            dispatched += 1
+
+        metrics = poll_metrics(sessions)
+        logger.info(f"Notification polling: {metrics}")
+        return f"Dispatched {dispatched} notification polls"
     except Exception as e:
         logger.error(f"Error in scheduled notification scraping: {e}")
         raise e
 
+
+@shared_task(bind=True, max_retries=None)
+def poll_session_notifications(self, token, university_name):
+    """
+    Task that scrapes the notifications of one session and stores the new ones.
+
+    At most NOTIFICATION_POLL_HOST_CONCURRENCY polls run against a Moodle host
+    at the same time; a poll finding the host busy is retried shortly after,
+    up to NOTIFICATION_POLL_MAX_RETRIES times, then left to the next beat.
+    """
+    cookie_json = cache.get(f"scrape_session_{token}")
+    if not cookie_json:
+        clear_poll_pending(token)
+        unregister_session(token)
+        return f"Session {token} expired"
+
+    host = urlparse(moodle_url(university_name)).netloc
+    if not acquire_host_slot(host):
+        if self.request.retries >= settings.NOTIFICATION_POLL_MAX_RETRIES:
+            clear_poll_pending(token)
+            record_poll(token, 0, error=f"{host} busy")
+            logger.warning(f"Skipping notification poll of session {token}: {host} busy")
+            return f"Host {host} busy"
+        raise self.retry(countdown=random.uniform(1, 5))
+
+    start = time.monotonic()
+    try:
+        notifications, new_ids = sync_notifications(json.loads(cookie_json), university_name)
+        enqueue_webhooks(new_ids)
+    except Exception as e:
+        record_poll(token, time.monotonic() - start, error=str(e))
+        logger.error(f"Error polling notifications for session {token}: {e}")
+        return f"Error polling notifications: {str(e)}"
+    finally:
+        release_host_slot(host)
+        clear_poll_pending(token)
+
+    record_poll(token, time.monotonic() - start)
+    return f"Scraped {len(notifications)} notifications, {len(new_ids)} new"
+
+
 @shared_task
-def send_notification_to_webhook(notification_id):
+def refresh_sessions():
     """
-    Task that sends a notification to the webhook.
+    Task that renews the sessions whose cached cookies are about to expire
+    (see session_needs_refresh()), so that users stay logged in and polled
+    past SESSION_TIMEOUT without logging in again. Scheduled via Celery Beat.
+    """
+    now = time.time()
+    due = [(token, entry) for token, entry in active_sessions().items() if session_needs_refresh(entry, now)]
+    for token, entry in due:
+        # Spread over the beat like the notification polls
+        refresh_session.apply_async((token, entry['university']), countdown=poll_jitter(token))
+    return f"Renewing {len(due)} session(s)"
+
+
+@shared_task
+def refresh_session(token, university_name):
+    """
+    Task that probes the Moodle session of one token and renews it.
     """
-    logger.info(f"Starting webhook task for notification {notification_id}")
     try:
-        # Get the notification from the database
-        notification = Notification.objects.get(notification_id=notification_id, sent=False)
-        logger.info(f"Found notification: {notification.notification_id}, message: {notification.message[:50]}...")
+        if renew_session(token, university_name):
+            return f"Session {token} renewed"
+        logger.info(f"Session {token} was logged out of Moodle, dropped")
+        return f"Session {token} expired"
+    except requests.RequestException as e:
+        # Tried again on the next beat, before the cookies expire
+        logger.warning(f"Could not renew session {token}: {e}")
+        return f"Error renewing session: {e}"
+
 
-        # Log the webhook URL
-        webhook_url = settings.NOTIFICATION_WEBHOOK_URL
-        logger.info(f"Sending to webhook URL: {webhook_url}")
+def enqueue_webhooks(notification_ids):
+    """
+    Queues the webhook delivery of new notifications (primary keys) as a
+    single batched task. Falls back to sending them directly if the broker
+    is unavailable.
+    """
+    if not notification_ids:
+        return
+    logger.info(f"Queueing webhook delivery for {len(notification_ids)} notifications")
+    try:
+        deliver_notifications.delay(list(notification_ids))
+    except Exception as task_error:
+        logger.error(f"Error queueing task: {task_error}")
+        # Try direct execution as fallback
+        try:
+            result = deliver_notifications(list(notification_ids))
+            logger.info(f"Direct execution result: {result}")
+        except Exception as direct_error:
+            logger.error(f"Error in direct execution: {direct_error}")
+
+
+_webhook_session = None
+
+
+def _get_webhook_session():
+    """
+    Returns the keep-alive session shared by the webhook deliveries of this worker.
+    """
+    global _webhook_session
+    if _webhook_session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _webhook_session = session
+    return _webhook_session
 
-        # Prepare payload
+
+def _notification_payload(notification):
+    return {
+        'university': notification.university,
+        'notification_id': notification.notification_id,
+        'message': notification.message,
+        'aria_label': notification.aria_label,
+        'timestamp': notification.timestamp.isoformat(),
+    }
+
+
+def _claim_notifications(pks, claim):
+    """
+    Claims the unsent notifications among `pks` that no other delivery
+    holds, for NOTIFICATION_WEBHOOK_CLAIM_SECONDS. The conditional UPDATE
+    lets a single delivery win each row.
+
+    Returns:
+        list: The notifications claimed by `claim`
+    """
+    now = timezone.now()
+    Notification.objects.filter(pk__in=pks, sent=False).filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now) | Q(claim=claim)
+    ).update(claim=claim, claimed_until=now + timedelta(seconds=settings.NOTIFICATION_WEBHOOK_CLAIM_SECONDS))
+    return list(Notification.objects.filter(pk__in=pks, sent=False, claim=claim).order_by('timestamp'))
+
+
+@shared_task(bind=True, max_retries=None)
+def deliver_notifications(self, notification_ids=None, claim=None):
+    """
+    Task that sends unsent notifications to the webhook in batches.
+
+    Rows are grouped into payloads of NOTIFICATION_WEBHOOK_BATCH_SIZE
+    notifications, claimed before being sent over a pooled keep-alive
+    session and marked as sent with one UPDATE per batch, so overlapping
+    deliveries (the periodic sweep, the per-sync deliveries and their
+    retries) never post a notification twice. Failed batches are retried
+    with exponential backoff and stay claimed until their retry runs.
+
+    Args:
+        notification_ids: Primary keys of the notifications to send; all
+                          unsent notifications if omitted
+        claim: Claim of the failed notifications, passed by retries
+    """
+    pending = Notification.objects.filter(sent=False)
+    if notification_ids is not None:
+        pending = pending.filter(pk__in=notification_ids)
+    pending = list(pending.order_by('timestamp').values_list('pk', flat=True))
+    if not pending:
+        return "No new notifications to send."
+
+    claim = claim or str(uuid.uuid4())
+    session = _get_webhook_session()
+    batch_size = settings.NOTIFICATION_WEBHOOK_BATCH_SIZE
+    sent = 0
+    failed_ids = []
+    for start in range(0, len(pending), batch_size):
+        batch = _claim_notifications(pending[start:start + batch_size], claim)
+        if not batch:
+            # Being sent by another delivery
+            continue
         payload = {
-            'notification_id': notification.notification_id,
-            'message': notification.message,
-            'aria_label': notification.aria_label,
-            'timestamp': notification.timestamp.isoformat(),
-            'token': settings.WEBHOOK_SECRET_TOKEN  # Simple authentication
+            'token': settings.WEBHOOK_SECRET_TOKEN,  # Simple authentication
+            'notifications': [_notification_payload(notification) for notification in batch],
         }
-        logger.debug(f"Payload: {payload}")
-
-        # Send it to the webhook with simple token authentication
-        logger.info("Sending POST request to webhook...")
-        response = requests.post(
-            webhook_url,
-            json=payload,
-            timeout=5
+        try:
+            response = session.post(settings.NOTIFICATION_WEBHOOK_URL, json=payload, timeout=10)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to send {len(batch)} notifications to webhook: {e}")
+            failed_ids.extend(notification.pk for notification in batch)
+            continue
+
+        # Mark the whole batch as sent in one query
+        Notification.objects.filter(id__in=[notification.id for notification in batch]).update(
+            sent=True, claim=None, claimed_until=None,
         )
+        sent += len(batch)
 
-        # Log response details
-        logger.info(f"Webhook response status: {response.status_code}")
-        logger.debug(f"Webhook response content: {response.text[:200]}")
-
-        # Check for success
-        response.raise_for_status()
-
-        # Mark as sent
-        notification.sent = True
-        notification.save()
-        logger.info(f"Successfully sent notification {notification_id} to webhook and marked as sent")
-
-        return f"Sent notification {notification_id} to webhook"
-    except Notification.DoesNotExist:
-        logger.warning(f"Notification {notification_id} not found or already sent")
-        return f"Notification {notification_id} not found or already sent"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to send notification {notification_id} to webhook: {e}")
-        return f"Error sending notification: {str(e)}"
+    if failed_ids:
+        failed = Notification.objects.filter(pk__in=failed_ids, claim=claim)
+        retries = self.request.retries
+        if retries >= settings.NOTIFICATION_WEBHOOK_MAX_RETRIES:
+            logger.error(f"Giving up on {len(failed_ids)} notifications after {retries} retries")
+            # Left to the next sweep
+            failed.update(claim=None, claimed_until=None)
+        else:
+            countdown = settings.NOTIFICATION_WEBHOOK_RETRY_BACKOFF * 2 ** retries
+            logger.info(f"Retrying {len(failed_ids)} notifications in {countdown}s")
+            failed.update(claimed_until=timezone.now() + timedelta(
+                seconds=countdown + settings.NOTIFICATION_WEBHOOK_CLAIM_SECONDS
+            ))
+            raise self.retry(args=(failed_ids, claim), countdown=countdown)
+
+    return f"Sent {sent} notification(s), {len(failed_ids)} failed"
+
+
+@shared_task
+def refresh_catalog_entry(kind, university_name, token=None, object_id=None):
+    """
+    Task that refreshes a stale catalog cache entry in the background.
+    """
+    try:
+        if refresh_catalog(kind, university_name, token, object_id):
+            return f"Refreshed {kind} {object_id or ''} for {university_name}"
+        return f"Session expired, {kind} {object_id or ''} not refreshed"
+    except Exception as e:
+        logger.error(f"Error refreshing {kind} {object_id} for {university_name}: {e}")
+        return f"Error refreshing catalog: {str(e)}"
+
+
+@shared_task
+def store_catalog_rows(kind, university_name, object_id, data, etag):
+    """
+    Task that copies freshly fetched catalog data into the catalog tables.
+    """
+    try:
+        written = store_catalog_data(kind, university_name, object_id, data, etag)
+        return f"Stored {kind} {object_id or ''} for {university_name}: {written} rows written"
     except Exception as e:
-        logger.error(f"Unexpected error sending notification {notification_id}: {e}")
-        return f"Unexpected error: {str(e)}"
+        logger.error(f"Error storing {kind} {object_id} for {university_name}: {e}")
+        return f"Error storing catalog: {str(e)}"
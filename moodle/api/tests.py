@@ -1,3 +1,476 @@
-from django.test import TestCase
+# api/tests.py
+# Offline tests: the parsers read the pages recorded in benchmarks/fixtures/
+# and the endpoints talk to the fake Moodle of benchmarks/fake_moodle.py.
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from benchmarks.fake_moodle import start_fake_moodle
+from services.categories import _crawl_workers, get_categories, parse_categories, parse_category_courses
+from services.chapters import parse_chapters
+from services.notification import high_water_mark
+from services.tenants import Tenant
+from services.upstream import CircuitBreaker, _LocalBucket
+
+from . import singleflight
+from .catalog_cache import content_etag, is_complete
+from .catalog_store import _diff, store_chapters, stored_chapters
+from .models import Notification
+from .notifications import ingest_rows
+from .responses import _parse_range, conditional_data_response, etag_matches, file_resource_response
+from .tasks import _claim_notifications, poll_session_notifications, scrape_notifications
+
+
+FIXTURES_DIR = os.path.join(settings.BASE_DIR, "benchmarks", "fixtures")
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def _row(notification_id):
+    return {"notification_id": notification_id, "message": "m", "aria_label": "a", "timestamp": timezone.now()}
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_whole_file(self):
+        self.assertIsNone(_parse_range(None, 100))
+        self.assertIsNone(_parse_range("bytes=-", 100))
+        # Multi-range requests get the whole file
+        self.assertIsNone(_parse_range("bytes=0-1,5-6", 100))
+        self.assertIsNone(_parse_range("items=0-1", 100))
+
+    def test_ranges(self):
+        self.assertEqual(_parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(_parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=90-500", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=-500", 100), (0, 99))
+
+    def test_unsatisfiable(self):
+        self.assertIs(_parse_range("bytes=100-", 100), False)
+        self.assertIs(_parse_range("bytes=9-3", 100), False)
+        self.assertIs(_parse_range("bytes=-0", 100), False)
+
+
+class FileResourceResponseTests(SimpleTestCase):
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(bytes(range(100)))
+        f.close()
+        self.path = f.name
+        self.addCleanup(os.remove, self.path)
+        self.factory = RequestFactory()
+
+    def _get(self, **headers):
+        request = self.factory.get("/", headers=headers)
+        return file_resource_response(request, self.path, 100, "application/pdf", "a.pdf", etag='"v1"')
+
+    def test_range(self):
+        response = self._get(Range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(10, 20)))
+
+    def test_unsatisfiable_range(self):
+        response = self._get(Range="bytes=200-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */100")
+
+    def test_if_range_mismatch_serves_whole_file(self):
+        response = self._get(Range="bytes=10-19", **{"If-Range": '"v0"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_not_modified(self):
+        self.assertEqual(self._get(**{"If-None-Match": '"v1"'}).status_code, 304)
+
+    def test_not_modified_weak_or_listed_tag(self):
+        self.assertEqual(self._get(**{"If-None-Match": 'W/"v1"'}).status_code, 304)
+        self.assertEqual(self._get(**{"If-None-Match": '"v0", "v1"'}).status_code, 304)
+        self.assertEqual(self._get(**{"If-None-Match": "*"}).status_code, 304)
+        response = self._get(**{"If-None-Match": '"v0"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+
+class ParserFixtureTests(SimpleTestCase):
+    def test_parse_categories(self):
+        categories = parse_categories(_fixture("course_index.html"))
+        self.assertTrue(categories)
+        for category in categories:
+            self.assertTrue(category["id"])
+            self.assertIn(f"categoryid={category['id']}", category["url"])
+
+    def test_parse_category_courses(self):
+        courses = parse_category_courses(_fixture("course_category.html"))
+        self.assertTrue(courses)
+        self.assertTrue(all(course["name"] and course["url"] for course in courses))
+
+    def test_parse_chapters(self):
+        chapters = parse_chapters(_fixture("course_view.html"), "1")
+        self.assertTrue(chapters["course_title"])
+        self.assertTrue(chapters["sections"])
+        self.assertTrue(any(section["activities"] for section in chapters["sections"]))
+
+
+def _notification_ids(pks):
+    return sorted(Notification.objects.filter(pk__in=pks).values_list("notification_id", flat=True))
+
+
+class IngestRowsTests(TestCase):
+    def test_skips_stored_notifications(self):
+        self.assertEqual(_notification_ids(ingest_rows([_row("1"), _row("2"), _row("1")], "bba")), ["1", "2"])
+        self.assertEqual(_notification_ids(ingest_rows([_row("1"), _row("2"), _row("3")], "bba")), ["3"])
+        self.assertEqual(ingest_rows([_row("3")], "bba"), [])
+        self.assertEqual(ingest_rows([], "bba"), [])
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_concurrent_insert(self):
+        atomic = transaction.atomic
+
+        def racing_atomic(*args, **kwargs):
+            # Another sync stores notification 2 after the stored ids were read
+            if not Notification.objects.filter(notification_id="2").exists():
+                Notification.objects.create(university="bba", **_row("2"))
+            return atomic(*args, **kwargs)
+
+        with mock.patch("api.notifications.transaction.atomic", side_effect=racing_atomic):
+            created = ingest_rows([_row("1"), _row("2"), _row("3")], "bba")
+        self.assertEqual(_notification_ids(created), ["1", "3"])
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_scoped_by_university(self):
+        ingest_rows([_row("1")], "bba")
+        created = ingest_rows([_row("1")], "other")
+        self.assertEqual(len(created), 1)
+        self.assertEqual(Notification.objects.get(pk=created[0]).university, "other")
+        with self.assertRaises(IntegrityError):
+            Notification.objects.create(university="bba", **_row("1"))
+
+
+class HighWaterMarkTests(SimpleTestCase):
+    def test_newest_notification(self):
+        notifications = [{"id": 3, "timecreated": 100}, {"id": 9, "timecreated": 90}, {"id": 4, "timecreated": 100}]
+        self.assertEqual(high_water_mark(notifications), {"timecreated": 100, "id": 4})
+
+    def test_keeps_previous_mark(self):
+        since = {"timecreated": 200, "id": 1}
+        self.assertEqual(high_water_mark([{"id": 3, "timecreated": 100}], since), since)
+        self.assertEqual(high_water_mark([], since), since)
+
+    def test_nothing_seen(self):
+        self.assertIsNone(high_water_mark([]))
+        self.assertIsNone(high_water_mark(["not a notification"]))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SINGLEFLIGHT_WAIT=5)
+class SingleflightTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lock(self):
+        flight = singleflight.acquire("key")
+        self.assertIsNotNone(flight)
+        self.assertIsNone(singleflight.acquire("key"))
+        # Only the holder releases it
+        singleflight.release("key", "someone else")
+        self.assertFalse(singleflight.wait_released("key", 0.05))
+        singleflight.release("key", flight)
+        self.assertTrue(singleflight.wait_released("key", 0.05))
+
+    def test_concurrent_fetches_collapse(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"data": 42}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(singleflight.do("key", fetch))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"data": 42}] * 8)
+
+    def test_async_fetches_collapse(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return {"data": 42}
+
+        async def main():
+            return await asyncio.gather(*(singleflight.ado("key", fetch) for _ in range(8)))
+
+        self.assertEqual(asyncio.run(main()), [{"data": 42}] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_error_reaches_waiters(self):
+        def fetch():
+            time.sleep(0.1)
+            raise requests.ConnectionError("down")
+
+        errors = []
+
+        def call():
+            try:
+                singleflight.do("key", fetch)
+            except requests.ConnectionError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+
+
+class ConditionalResponseTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_etag_matches(self):
+        etag = '"abc"'
+        self.assertFalse(etag_matches(self.factory.get("/"), etag))
+        self.assertTrue(etag_matches(self.factory.get("/", headers={"If-None-Match": etag}), etag))
+        self.assertTrue(etag_matches(self.factory.get("/", headers={"If-None-Match": 'W/"abc"'}), etag))
+        self.assertTrue(etag_matches(self.factory.get("/", headers={"If-None-Match": '"x", "abc"'}), etag))
+        self.assertTrue(etag_matches(self.factory.get("/", headers={"If-None-Match": "*"}), etag))
+        self.assertFalse(etag_matches(self.factory.get("/", headers={"If-None-Match": '"abcd"'}), etag))
+
+    def test_conditional_data_response(self):
+        data = [{"id": 1}]
+        etag = content_etag(data)
+        response = conditional_data_response(self.factory.get("/"), data, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+        request = self.factory.get("/", headers={"If-None-Match": etag})
+        response = conditional_data_response(request, data, etag, private=False)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+    def test_content_etag_is_stable(self):
+        self.assertEqual(content_etag({"a": 1, "b": [2]}), content_etag({"b": [2], "a": 1}))
+        self.assertNotEqual(content_etag({"a": 1}), content_etag({"a": 2}))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FakeMoodleTestCase(TestCase):
+    """
+    Points the Moodle URLs at a local fake Moodle.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server, cls.moodle = start_fake_moodle()
+        cls.addClassCleanup(cls.server.shutdown)
+        patcher = mock.patch.dict(os.environ, {"MOODLE_BASE_URL_TEMPLATE": cls.moodle.base_url})
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+
+    def setUp(self):
+        cache.clear()
+
+
+@override_settings(CATALOG_STORE=False)
+class CategoriesEndpointTests(FakeMoodleTestCase):
+    def test_not_modified(self):
+        response = self.client.get("/api/categories/")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertEqual(etag, content_etag(response.json()["data"]))
+
+        requests_before = self.moodle.requests
+        response = self.client.get("/api/categories/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        # Answered from the catalog cache
+        self.assertEqual(self.moodle.requests, requests_before)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_and_recovers(self):
+        breaker = CircuitBreaker(Tenant("test", min_calls=4, failure_ratio=0.5, open_seconds=0.05))
+        for failed in (False, True, False):
+            self.assertTrue(breaker.allow())
+            breaker.record(failed=failed)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.allow()
+        breaker.record(failed=True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        # A single trial request goes through
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record(failed=False)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(Tenant("test", min_calls=1, failure_ratio=0.5, open_seconds=0))
+        breaker.allow()
+        breaker.record(failed=True)
+        self.assertTrue(breaker.allow())
+        breaker.record(failed=True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_abandoned_trial(self):
+        breaker = CircuitBreaker(Tenant("test", min_calls=1, failure_ratio=0.5, open_seconds=0))
+        breaker.allow()
+        breaker.record(failed=True)
+        self.assertTrue(breaker.allow())
+        breaker.abandon()
+        self.assertTrue(breaker.allow())
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_wait(self):
+        bucket = _LocalBucket(Tenant("test", rate_limit=10, rate_burst=5))
+        for _ in range(5):
+            self.assertEqual(bucket.reserve(10, 5, 1), 0.0)
+        self.assertAlmostEqual(bucket.reserve(10, 5, 1), 0.1, delta=0.02)
+        # The next token would come after the longest acceptable wait
+        self.assertIsNone(bucket.reserve(10, 5, 0.05))
+
+
+class DiffTests(SimpleTestCase):
+    class Row:
+        def __init__(self, **values):
+            self.__dict__.update(values)
+
+    def test_diff(self):
+        kept = self.Row(name="a", url="u1")
+        changed = self.Row(name="b", url="u2")
+        gone = self.Row(name="c", url="u3")
+        existing = {"1": kept, "2": changed, "3": gone}
+        fresh = {"1": {"name": "a", "url": "u1"}, "2": {"name": "b2", "url": "u2"}, "4": {"name": "d", "url": "u4"}}
+
+        create, update, removed = _diff(existing, fresh, ["name", "url"])
+
+        self.assertEqual(create, ["4"])
+        self.assertEqual(update, [changed])
+        self.assertEqual(changed.name, "b2")
+        self.assertEqual(removed, [gone])
+
+
+class CatalogStoreTests(TestCase):
+    CHAPTERS = {
+        "course_id": "7",
+        "course_title": "Algebra",
+        "sections": [
+            {"id": "s1", "number": "0", "name": "General", "activities": [
+                {"name": "Syllabus", "url": "https://m/mod/resource/view.php?id=1", "id": "1", "type": "resource"},
+            ]},
+            {"id": "s2", "number": "1", "name": "Week 1", "summary": "Intro", "activities": []},
+        ],
+    }
+
+    def test_round_trip(self):
+        self.assertGreater(store_chapters("bba", self.CHAPTERS), 0)
+        self.assertEqual(stored_chapters("bba", "7")["data"], self.CHAPTERS)
+        # Unchanged data writes nothing
+        self.assertEqual(store_chapters("bba", self.CHAPTERS), 0)
+        self.assertIsNone(stored_chapters("bba", "8"))
+
+    def test_changed_sections(self):
+        store_chapters("bba", self.CHAPTERS)
+        changed = dict(self.CHAPTERS, sections=self.CHAPTERS["sections"][:1])
+        self.assertEqual(store_chapters("bba", changed), 1)
+        self.assertEqual(stored_chapters("bba", "7")["data"], changed)
+
+    def test_empty_scrape_keeps_rows(self):
+        store_chapters("bba", self.CHAPTERS)
+        login_page = {"course_id": "7", "course_title": "", "sections": []}
+        self.assertEqual(store_chapters("bba", login_page), 0)
+        self.assertEqual(stored_chapters("bba", "7")["data"], self.CHAPTERS)
+
+
+class ClaimNotificationsTests(TestCase):
+    def test_single_claim(self):
+        pks = ingest_rows([_row("1"), _row("2")], "bba")
+        self.assertEqual(len(_claim_notifications(pks, "first")), 2)
+        self.assertEqual(_claim_notifications(pks, "second"), [])
+        # The holder keeps its claim, e.g. on retry
+        self.assertEqual(len(_claim_notifications(pks, "first")), 2)
+
+    def test_lapsed_claim(self):
+        pks = ingest_rows([_row("1")], "bba")
+        _claim_notifications(pks, "first")
+        Notification.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(_claim_notifications(pks, "second")), 1)
+
+    def test_sent_notifications_are_not_claimed(self):
+        pks = ingest_rows([_row("1")], "bba")
+        Notification.objects.update(sent=True)
+        self.assertEqual(_claim_notifications(pks, "first"), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MOODLE_SESSION_COOKIES=None)
+class NotificationPollTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch("api.tasks.active_sessions", return_value={"t1": {"university": "bba", "registered_at": 0}})
+    @mock.patch("api.tasks.poll_session_notifications.apply_async")
+    def test_pending_poll_is_not_dispatched_again(self, apply_async, _):
+        scrape_notifications()
+        scrape_notifications()
+        self.assertEqual(apply_async.call_count, 1)
+
+    @mock.patch("api.tasks.acquire_host_slot", return_value=False)
+    def test_busy_host_gives_up_after_max_retries(self, _):
+        cache.set("scrape_session_t1", "{}")
+        result = poll_session_notifications.apply(("t1", "bba"), retries=settings.NOTIFICATION_POLL_MAX_RETRIES)
+        self.assertTrue(result.successful())
+        self.assertIsNone(cache.get("notification_poll_pending_t1"))
+
+
+class CatalogCompletenessTests(SimpleTestCase):
+    def test_is_complete(self):
+        self.assertFalse(is_complete("courses", []))
+        self.assertTrue(is_complete("courses", [{"id": "1"}]))
+        self.assertFalse(is_complete("categories", [{"id": "1"}, {"id": "2", "error": "timeout"}]))
+        self.assertTrue(is_complete("categories", [{"id": "1", "subcategories": []}]))
+        # The login page of an expired session
+        self.assertFalse(is_complete("chapters", {"course_id": "1", "course_title": "", "sections": []}))
+        self.assertTrue(is_complete("chapters", {"course_id": "1", "course_title": "C", "sections": [{}]}))
+
+
+class CrawlTests(FakeMoodleTestCase):
+    def test_get_categories(self):
+        with requests.Session() as session:
+            categories = get_categories(session, "bba", max_workers=4)
+        self.assertTrue(categories)
+        self.assertFalse([category for category in categories if "error" in category])
+        self.assertTrue(all(category["subcategories"] for category in categories))
+
+    def test_workers_capped_by_tenant(self):
+        with mock.patch("services.categories.get_tenant", return_value=Tenant("bba", max_concurrency=2)):
+            self.assertEqual(_crawl_workers("bba", 8), 2)
+            self.assertEqual(_crawl_workers("bba", 0), 1)
@@ -1,7 +1,9 @@
 from django.urls import path
+from . import async_views
 from .views import (
     fetch_courses, login, fetch_chapters, fetch_category,
-    fetch_resource, scrape_and_store_notifications, webhook_receiver
+    fetch_resource, fetch_course_bundle, scrape_and_store_notifications, webhook_receiver,
+    invalidate_cache, metrics, catalog_categories, catalog_courses, catalog_chapters
 )
 
 urlpatterns = [
@@ -10,6 +12,24 @@ urlpatterns = [
     path("courses/", fetch_courses),
     path("chapters/", fetch_chapters),
     path("resource/", fetch_resource),
+    path("courses/bundle/", fetch_course_bundle, name='course_bundle'),
+    path("catalog/categories/", catalog_categories, name='catalog_categories'),
+    path("catalog/courses/", catalog_courses, name='catalog_courses'),
+    path("catalog/chapters/", catalog_chapters, name='catalog_chapters'),
+    path("cache/invalidate/", invalidate_cache, name='cache_invalidate'),
+    path("metrics/", metrics, name='metrics'),
     path('notifications/', scrape_and_store_notifications, name='notifications'),
     path('webhook/notification/', webhook_receiver, name='webhook_notification'),
+
+    # Async endpoints, to be served by an ASGI server
+    path("async/login/", async_views.login, name='async_login'),
+    path("async/categories/", async_views.fetch_category, name='async_categories'),
+    path("async/courses/", async_views.fetch_courses, name='async_courses'),
+    path("async/chapters/", async_views.fetch_chapters, name='async_chapters'),
+    path("async/resource/", async_views.fetch_resource, name='async_resource'),
+    path("async/courses/bundle/", async_views.fetch_course_bundle, name='async_course_bundle'),
+    path("async/catalog/categories/", async_views.catalog_categories, name='async_catalog_categories'),
+    path("async/catalog/courses/", async_views.catalog_courses, name='async_catalog_courses'),
+    path("async/catalog/chapters/", async_views.catalog_chapters, name='async_catalog_chapters'),
+    path('async/notifications/', async_views.scrape_and_store_notifications, name='async_notifications'),
 ]
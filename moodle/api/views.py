@@ -1,27 +1,42 @@
 # views.py
 import json, uuid
-import requests
 import logging
-from datetime import datetime
 from django.conf import settings
 from django.core.cache import cache
 from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from bs4 import BeautifulSoup
 
+from services import metrics as service_metrics
 from services.login import login as login_service
-from services.categories import get_categories as get_categories
-from services.courses import get_courses
-from services.chapters import get_chapters as get_chapters
-from services.resources import get_resource
-from services.notification import get_notifications
-from .models import Notification
-from .tasks import send_notification_to_webhook
+from services.webservice import get_token as get_webservice_token
+from .catalog_cache import CATALOG_KINDS, enrolled_in, get_catalog, get_catalog_entry, invalidate_catalog
+from .catalog_store import stored_categories, stored_chapters, stored_courses
+from .course_bundle import bundle_filename, course_resources, stream_course_bundle
+from .notifications import ingest_rows, sync_notifications
+from .polling import poll_metrics
+from .resource_cache import serve_resource
+from .responses import archive_response, conditional_data_response
+from .sessions import (
+    active_sessions, get_session, login_key, moodle_backend, remember_login, request_university, reusable_session,
+    session_pool, store_session, store_webservice_token,
+)
+from .tasks import enqueue_webhooks
 
 logger = logging.getLogger(__name__)
 
+
+def _unknown_university():
+    return Response({'error': 'Unknown university'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _not_stored():
+    return Response({'error': 'Not in the catalog store yet'}, status=status.HTTP_404_NOT_FOUND)
+
+
 @api_view(['POST'])
 def login(request):
     username = request.data.get('username')
@@ -29,13 +44,37 @@ def login(request):
     if not username or not password:
         return Response({'error': 'Missing credentials'}, status=status.HTTP_400_BAD_REQUEST)
 
-    cookies_json = login_service(username, password, "bba")
+    university = request_university(request, requested=request.data.get('university'))
+    if university is None:
+        return _unknown_university()
+
+    # Reuse the session of a previous login with the same credentials while
+    # Moodle still has it logged in
+    reuse_key = login_key(username, password, university)
+    session_token, cookies_json = reusable_session(reuse_key, university)
+
+    if cookies_json is None:
+        cookies_json = login_service(username, password, university)
+
+        if cookies_json in ("Login failed", None):
+            return Response({'error': 'Login failed'}, status=status.HTTP_401_UNAUTHORIZED)
 
-    if cookies_json == "Login failed":
-        return Response({'error': 'Login failed'}, status=status.HTTP_401_UNAUTHORIZED)
+        # The token of the previous login is kept, now with fresh cookies
+        session_token = session_token or str(uuid.uuid4())
 
-    session_token = str(uuid.uuid4())
-    cache.set(f"scrape_session_{session_token}", cookies_json, timeout=7200)
+        if moodle_backend(university) == 'webservice':
+            # The password is only available now, request the web service token
+            try:
+                ws_token = get_webservice_token(
+                    session_pool.get(session_token, cookies_json), username, password, university,
+                    settings.MOODLE_WEBSERVICE_NAME,
+                )
+                store_webservice_token(session_token, ws_token, university)
+            except Exception as e:
+                logger.warning(f"Could not obtain a web service token, scraping instead: {e}")
+
+    store_session(session_token, cookies_json, university)
+    remember_login(reuse_key, session_token)
 
     # Immediately scrape notifications after successful login
     try:
@@ -132,59 +171,113 @@ def login(request):
 @api_view(['GET'])
 def fetch_category(request):
     token = request.query_params.get('session_token')
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
 
-    # Rebuild session
-    session = requests.Session()
-
-    cookie_json = cache.get(f"scrape_session_{token}")
-    if  cookie_json:
-        #return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
-        session.cookies.update(json.loads(cookie_json))
+    # Categories are public, fall back to an anonymous session
+    session = get_session(token, allow_anonymous=True, university_name=university)
 
+    entry = get_catalog_entry('categories', session, university, token)
 
+    # Unchanged data is answered with 304 Not Modified
+    return conditional_data_response(request, entry['data'], entry['etag'], Response, private=False)
 
 
-    courses = get_categories(session, 'bba')
 
+@api_view(['GET'])
+def fetch_courses(request):
+    token = request.query_params.get('session_token')
+    session = get_session(token)
+    if session is None:
+        return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
 
-    return Response({'data': courses})
+    id = request.query_params.get('id')
+    if id:
+        entry = get_catalog_entry('courses', session, university, token, id)
+    else:
+        # Without a category, list the courses the user is enrolled in
+        entry = get_catalog_entry('enrolled', session, university, token)
 
+    return conditional_data_response(request, entry['data'], entry['etag'], Response)
 
 
 @api_view(['GET'])
-def fetch_courses(request):
+def fetch_chapters(request):
+
     token = request.query_params.get('session_token')
-    cookie_json = cache.get(f"scrape_session_{token}")
-    if not cookie_json:
+    session = get_session(token)
+    if session is None:
         return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
-
-    # Rebuild session
-    session = requests.Session()
-    session.cookies.update(json.loads(cookie_json))
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
 
     id = request.query_params.get('id')
-    data = get_courses(session, id, 'bba')
-
+    entry = get_catalog_entry('chapters', session, university, token, id)
 
-    return Response({'data': data})
+    return conditional_data_response(request, entry['data'], entry['etag'], Response)
 
+# Catalog store views: the data last fetched from Moodle, read from the
+# catalog tables without contacting Moodle
 
 @api_view(['GET'])
-def fetch_chapters(request):
+def catalog_categories(request):
+    token = request.query_params.get('session_token')
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
 
+    entry = stored_categories(university)
+    if entry is None:
+        return _not_stored()
+    return conditional_data_response(request, entry['data'], entry['etag'], Response, private=False)
+
+
+@api_view(['GET'])
+def catalog_courses(request):
     token = request.query_params.get('session_token')
-    cookie_json = cache.get(f"scrape_session_{token}")
-    if not cookie_json:
+    id = request.query_params.get('id')
+    if not id:
+        return Response({'error': 'Missing category ID'}, status=status.HTTP_400_BAD_REQUEST)
+
+    session = get_session(token)
+    if session is None:
         return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    entry = stored_courses(university, id)
+    if entry is None:
+        return _not_stored()
+    return conditional_data_response(request, entry['data'], entry['etag'], Response)
 
-    # Rebuild session
-    session = requests.Session()
-    session.cookies.update(json.loads(cookie_json))
 
+@api_view(['GET'])
+def catalog_chapters(request):
+    token = request.query_params.get('session_token')
     id = request.query_params.get('id')
-    data = get_chapters(session, id, 'bba')
+    if not id:
+        return Response({'error': 'Missing course ID'}, status=status.HTTP_400_BAD_REQUEST)
+
+    session = get_session(token)
+    if session is None:
+        return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    # Chapters depend on the user's access: the stored copy is only served
+    # to users enrolled in the course, the others get Moodle's answer
+    entry = stored_chapters(university, id) if enrolled_in(session, university, token, id) else None
+    if entry is None:
+        entry = get_catalog_entry('chapters', session, university, token, id)
+    return conditional_data_response(request, entry['data'], entry['etag'], Response)
 
-    return Response({'data': data})
 
 @api_view(['GET'])
 def fetch_resource(request):
@@ -194,28 +287,94 @@ def fetch_resource(request):
     if not token or not resource_id:
         return Response({'error': 'Missing session token or resource ID'}, status=status.HTTP_400_BAD_REQUEST)
 
-    cookie_json = cache.get(f"scrape_session_{token}")
-    if not cookie_json:
+    session = get_session(token)
+    if session is None:
         return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
+
+    # Serve the file from the blob store, or stream it from Moodle
+    response = serve_resource(request, session, resource_id, university)
+    if response is None:
+        return Response({'error': 'Could not retrieve the resource'}, status=status.HTTP_404_NOT_FOUND)
+    return response
+
+
+@api_view(['GET'])
+def fetch_course_bundle(request):
+    """
+    Downloads every resource file of a course as one ZIP archive, one folder
+    per section, streamed while the files are fetched.
+    """
+    token = request.query_params.get('session_token')
+    course_id = request.query_params.get('id')
 
-    # Rebuild session
-    session = requests.Session()
-    session.cookies.update(json.loads(cookie_json))
+    if not token or not course_id:
+        return Response({'error': 'Missing session token or course ID'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Use the service to get the resource
-    result = get_resource(session, resource_id, 'bba')
+    session = get_session(token)
+    if session is None:
+        return Response({'error': 'Invalid or expired session'}, status=status.HTTP_401_UNAUTHORIZED)
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
 
-    if 'error' in result:
-        return Response({'error': result['error']}, status=status.HTTP_404_NOT_FOUND)
+    chapters = get_catalog('chapters', session, university, token, course_id)
+    resources = course_resources(chapters)
+    if not resources:
+        return Response({'error': 'No files in this course'}, status=status.HTTP_404_NOT_FOUND)
 
-    # Create a response with the file content
-    response = HttpResponse(result['content'], content_type=result['content_type'])
-    response['Content-Disposition'] = f'inline; filename="{result["filename"]}"'
-    return response
+    return archive_response(
+        stream_course_bundle(session, resources, university), bundle_filename(chapters, course_id)
+    )
 
 
 
 
+@api_view(['POST'])
+def invalidate_cache(request):
+    """
+    Invalidates cached catalog data.
+
+    Body:
+        token: The CATALOG_CACHE_INVALIDATION_TOKEN secret
+        kind: 'categories', 'courses' or 'chapters' (all kinds if omitted)
+        university: The university subdomain, required with `id`
+        id: The category or course id to invalidate (whole kind if omitted)
+        session_token: The session token owning a per-user entry
+    """
+    data = request.data
+    if data.get('token') != settings.CATALOG_CACHE_INVALIDATION_TOKEN:
+        return Response({'error': 'Invalid token'}, status=status.HTTP_403_FORBIDDEN)
+
+    kind = data.get('kind')
+    if kind and kind not in CATALOG_KINDS:
+        return Response({'error': f'Unknown kind: {kind}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    kinds = invalidate_catalog(
+        kind=kind,
+        university_name=data.get('university'),
+        object_id=data.get('id'),
+        token=data.get('session_token'),
+    )
+    return Response({'status': 'invalidated', 'kinds': kinds})
+
+
+@api_view(['GET'])
+def metrics(request):
+    """
+    Exposes the metrics of this worker process in the Prometheus text format:
+    upstream, parse, database and rendering time histograms, cache, login and
+    retry counters, and the session pool and notification polling state.
+    """
+    for stat, value in session_pool.stats().items():
+        service_metrics.SESSION_POOL.set(value, stat=stat)
+    for stat, value in poll_metrics(active_sessions()).items():
+        if value is not None:
+            service_metrics.NOTIFICATION_POLLS.set(value, stat=stat)
+    return HttpResponse(service_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 # Notification views
 
@@ -241,72 +400,24 @@ def scrape_and_store_notifications(request):
     except Exception as e:
         return Response({'error': f'Error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    university = request_university(request, token)
+    if university is None:
+        return _unknown_university()
+
     # Step 2: Scrape notifications using MoodleTerminator
     try:
-        notifications = get_notifications(session_cookies, 'bba')
+        # Only the notifications posted since the last sync are fetched
+        notifications, new_ids = sync_notifications(session_cookies, university)
 
         if not notifications:
-            return JsonResponse({'status': 'No notifications found'})
+            return JsonResponse({'status': 'No new notifications found'})
 
-        new_notifications = []
-        for notif in notifications:
-            # Extract notification details
-            # Make sure notif is a dictionary before using get()
-            if not isinstance(notif, dict):
-                logger.warning(f"Unexpected notification format: {notif}")
-                continue
-
-            notif_id = str(notif.get("id", ""))
-            message = notif.get("fullmessage", "")
-            subject = notif.get("subject", "")
-
-            # Use fullmessagehtml as a fallback if fullmessage is empty
-            if not message and notif.get("fullmessagehtml"):
-                message = notif.get("fullmessagehtml")
-
-            # Use subject as aria_label if available
-            aria_label = subject or message[:50]
-
-            # Get timestamp
-            timestamp_str = notif.get("timecreated")
-            try:
-                # Convert Unix timestamp to datetime if available
-                timestamp = datetime.fromtimestamp(int(timestamp_str)) if timestamp_str else datetime.now()
-            except (ValueError, TypeError):
-                # If parsing fails, use current time
-                timestamp = datetime.now()
-
-            # Step 3: Store new notifications in the database
-            notification, created = Notification.objects.get_or_create(
-                notification_id=notif_id,
-                defaults={
-                    'message': message,
-                    'aria_label': aria_label,
-                    'timestamp': timestamp
-                }
-            )
-
-            if created:
-                new_notifications.append(notification)
-                # Trigger the task for each new notification
-                logger.info(f"Queueing webhook task for notification {notification.notification_id}")
-                try:
-                    # Use the simpler delay method
-                    task_result = send_notification_to_webhook.delay(notification.notification_id)
-                    logger.info(f"Task queued with ID: {task_result.id}")
-                except Exception as task_error:
-                    logger.error(f"Error queueing task: {task_error}")
-                    # Try direct execution as fallback
-                    try:
-                        logger.info("Attempting direct task execution...")
-                        result = send_notification_to_webhook(notification.notification_id)
-                        logger.info(f"Direct execution result: {result}")
-                    except Exception as direct_error:
-                        logger.error(f"Error in direct execution: {direct_error}")
+        # Step 3: Trigger the webhook for the new notifications
+        enqueue_webhooks(new_ids)
 
         return JsonResponse({
             'status': 'Notifications scraped and stored',
-            'notifications_count': len(new_notifications),
+            'notifications_count': len(new_ids),
             'total_notifications': len(notifications)
         })
 
@@ -326,23 +437,25 @@ def webhook_receiver(request):
         if not data.get('message'):
             return Response({'error': 'Missing required fields'}, status=status.HTTP_400_BAD_REQUEST)
 
+        university = request_university(request, requested=data.get('university'))
+        if university is None:
+            return _unknown_university()
+
         # Generate a unique ID if not provided
         notification_id = data.get('notification_id', str(uuid.uuid4()))
 
         # Create notification in database
-        notification, created = Notification.objects.get_or_create(
-            notification_id=notification_id,
-            defaults={
-                'message': data.get('message'),
-                'aria_label': data.get('aria_label', data.get('message')[:50]),
-                'timestamp': datetime.now()
-            }
-        )
+        new_ids = ingest_rows([{
+            'notification_id': notification_id,
+            'message': data.get('message'),
+            'aria_label': data.get('aria_label', data.get('message')[:50]),
+            'timestamp': timezone.now()
+        }], university)
 
         return JsonResponse({
             'status': 'success',
-            'created': created,
-            'notification_id': notification.notification_id
+            'created': bool(new_ids),
+            'notification_id': notification_id
         })
 
     except Exception as e:
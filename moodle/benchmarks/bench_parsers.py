@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Compares the HTML parser backends on the fixture pages of each scraper.
+
+For every scraper parse function and backend, reports the mean parse time
+and the peak memory allocated while parsing (tracemalloc).
+
+Run this script from the Django project root directory:
+
+python benchmarks/bench_parsers.py [--iterations 20]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Add the project root to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services import parsing
+from services.categories import parse_categories, parse_category_courses
+from services.chapters import parse_chapters
+from services.courses import parse_courses
+from services.login import parse_login_token
+from services.resources import parse_resource_link
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+SCRAPERS = [
+    ("login", "login_index.html", parse_login_token),
+    ("categories", "course_index.html", parse_categories),
+    ("category_courses", "course_category.html", parse_category_courses),
+    ("courses", "course_category.html", parse_courses),
+    ("chapters", "course_view.html", lambda html: parse_chapters(html, "1")),
+    ("resource", "resource_view.html", parse_resource_link),
+]
+
+
+def _run(parse, html):
+    # Scrapers may print progress, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        return parse(html)
+
+
+def measure(parse, html, iterations):
+    """
+    Returns:
+        tuple: Mean and p95 parse time in milliseconds, peak memory in KB
+    """
+    _run(parse, html)  # warm up
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        _run(parse, html)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    _run(parse, html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return statistics.mean(timings), p95, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--backend", action="append", choices=parsing.PARSER_BACKENDS,
+                        help="Backend to measure (default: all installed backends)")
+    args = parser.parse_args()
+
+    backends = args.backend or list(parsing.PARSER_BACKENDS)
+    print(f"{'scraper':<18}{'page KB':>8}  {'backend':<12}{'mean ms':>9}{'p95 ms':>9}{'peak KB':>10}")
+    for name, fixture, parse in SCRAPERS:
+        with open(os.path.join(FIXTURES_DIR, fixture), encoding="utf-8") as f:
+            html = f.read()
+        for backend in backends:
+            parsing.set_parser_backend(backend)
+            if parsing.get_parser_backend() != backend:
+                print(f"{name:<18}{'':>8}  {backend:<12}not installed")
+                continue
+            mean, p95, peak = measure(parse, html, args.iterations)
+            print(f"{name:<18}{len(html.encode('utf-8')) // 1024:>8}  {backend:<12}{mean:>9.2f}{p95:>9.2f}{peak:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
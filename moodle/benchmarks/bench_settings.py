@@ -0,0 +1,43 @@
+# Settings used by benchmarks/run_bench.py
+import os
+import tempfile
+
+from moodle.settings import *  # noqa: F401,F403
+
+BENCH_DIR = Path(os.environ.get('BENCH_DIR') or tempfile.mkdtemp(prefix='moodle-bench-'))
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BENCH_DIR / 'bench.sqlite3',
+        'OPTIONS': {'timeout': 30, 'transaction_mode': 'IMMEDIATE'},
+    }
+}
+
+RESOURCE_CACHE_DIR = BENCH_DIR / 'resource_cache'
+
+# Single process, no Redis needed
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Run tasks inline instead of requiring a Redis broker
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_BROKER_URL = 'memory://'
+
+NOTIFICATION_WEBHOOK_URL = os.environ.get('BENCH_WEBHOOK_URL', NOTIFICATION_WEBHOOK_URL)
+
+if os.environ.get('BENCH_NO_CATALOG_CACHE'):
+    # Measure the scraping path: entries expire as soon as they are stored
+    CATALOG_CACHE = {kind: dict(config, ttl=0, stale_ttl=0) for kind, config in CATALOG_CACHE.items()}
+
+# Catalog backend measured: "scraper" (default) or "webservice"
+MOODLE_DEFAULT_BACKEND = os.environ.get('BENCH_MOODLE_BACKEND', MOODLE_DEFAULT_BACKEND)
+
+# Keep the benchmark report readable
+for _logger in LOGGING['loggers'].values():
+    _logger['level'] = 'WARNING'
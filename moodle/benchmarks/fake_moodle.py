@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Local stand-in for a university Moodle, serving the recorded fixtures.
+
+Every response is delayed by the injected latency so that the API can be
+measured against realistic upstream round-trips without touching the real
+elearning.univ-*.dz servers.
+
+Run this script from the Django project root directory:
+
+python benchmarks/fake_moodle.py --port 8765 --latency-ms 150
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Add the project root to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.categories import parse_categories, parse_category_courses
+from services.chapters import parse_chapters
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+# Absolute URL used in the fixtures, rewritten to the address of this server
+FIXTURE_BASE_URL = "https://elearning.univ-bba.dz"
+SESSION_COOKIE = "MoodleSession=fakemoodlesession0123456789; path=/; HttpOnly"
+WEBSERVICE_TOKEN = "fakewebservicetoken0123456789abcdef"
+
+
+class FakeMoodle:
+    """
+    Fixture store and settings shared by the request handlers.
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, file_size=1024 * 1024):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.base_url = FIXTURE_BASE_URL
+        self.requests = 0
+        # Set to make the authenticated pages redirect to the login page
+        self.sessions_expired = False
+        self._lock = threading.Lock()
+        self.pages = {}
+        for name in os.listdir(FIXTURES_DIR):
+            with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+                self.pages[name] = f.read()
+        self.notifications = json.loads(self.pages["notifications.json"])
+        self.enrolled_courses = [
+            {"id": course_id, "fullname": f"Module {course_id}", "shortname": f"M{course_id}",
+             "viewurl": f"{FIXTURE_BASE_URL}/course/view.php?id={course_id}",
+             "coursecategory": "Licence 3", "progress": 10 * course_id}
+            for course_id in range(1, 9)
+        ]
+        self.events = [
+            {"id": 500 + i, "name": f"Devoir {i} est à remettre", "timesort": 1900000000 + i * 86400,
+             "course": {"id": i % 8 + 1}, "url": f"{FIXTURE_BASE_URL}/mod/assign/view.php?id={700 + i}"}
+            for i in range(12)
+        ]
+        self._build_webservice_data()
+        self.sesskey = re.search(r'"sesskey": "(\w+)"', self.pages["index.html"]).group(1)
+        # Deterministic pseudo-PDF served for every resource file
+        self.file = b"%PDF-1.4\n" + random.Random(0).randbytes(file_size)
+        self.file_etag = '"%s"' % hashlib.sha1(self.file).hexdigest()
+
+    def page(self, name):
+        return self.pages[name].replace(FIXTURE_BASE_URL, self.base_url).encode("utf-8")
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def _build_webservice_data(self):
+        """
+        Builds the web service responses from the same fixture pages the
+        scraper reads, so that both backends return the same catalog.
+        """
+        category_courses = [
+            {"id": int(re.search(r"id=(\d+)", course["url"]).group(1)), "fullname": course["name"]}
+            for course in parse_category_courses(self.pages["course_category.html"])
+        ]
+        self.ws_categories = []
+        self.ws_courses = []
+        for sortorder, category in enumerate(parse_categories(self.pages["course_index.html"])):
+            category_id = int(category["id"])
+            self.ws_categories.append({
+                "id": category_id, "name": category["name"], "parent": 0,
+                "sortorder": sortorder, "coursecount": len(category_courses),
+            })
+            self.ws_courses.extend(dict(course, categoryid=category_id) for course in category_courses)
+
+        chapters = parse_chapters(self.pages["course_view.html"], "1")
+        self.ws_course_title = chapters["course_title"]
+        self.ws_contents = [
+            {
+                "id": int(section["id"] or 0), "section": int(section["number"] or 0), "name": section["name"],
+                "summary": f"<p>{section['summary']}</p>" if section.get("summary") else "", "summaryformat": 1,
+                "modules": [
+                    {"id": int(activity.get("id", 0)), "name": activity.get("name"), "url": activity.get("url"),
+                     "modname": activity.get("type")}
+                    for activity in section["activities"]
+                ],
+            }
+            for section in chapters["sections"]
+        ]
+
+    def webservice(self, wsfunction, params):
+        if wsfunction == "core_webservice_get_site_info":
+            return {"userid": 4242, "sitename": "Fake Moodle", "username": "student"}
+        if wsfunction == "core_course_get_categories":
+            return self.ws_categories
+        if wsfunction == "core_course_get_courses_by_field":
+            field, value = params.get("field"), params.get("value")
+            if field == "category":
+                return {"courses": [c for c in self.ws_courses if str(c["categoryid"]) == value], "warnings": []}
+            if field == "id":
+                return {"courses": [{"id": int(value), "fullname": self.ws_course_title, "categoryid": 1}],
+                        "warnings": []}
+            return {"courses": self.ws_courses, "warnings": []}
+        if wsfunction == "core_course_get_contents":
+            return self.ws_contents
+        return {"exception": "webservice_access_exception", "errorcode": "accessexception",
+                "message": f"Access control exception ({wsfunction})"}
+
+    def ajax(self, calls, sesskey=None):
+        if sesskey != self.sesskey:
+            return [{"error": True, "exception": {
+                "message": "Votre session a probablement expiré",
+                "errorcode": "invalidsesskey",
+            }}]
+        results = []
+        for call in calls:
+            args = call.get("args", {})
+            if call.get("methodname") == "message_popup_get_popup_notifications":
+                offset = int(args.get("offset", 0))
+                limit = int(args.get("limit", 0)) or len(self.notifications)
+                results.append({"error": False, "data": {
+                    "notifications": self.notifications[offset:offset + limit],
+                    "unreadcount": len(self.notifications),
+                }})
+            elif call.get("methodname") == "core_course_get_enrolled_courses_by_timeline_classification":
+                results.append({"error": False, "data": {"courses": self.enrolled_courses, "nextoffset": 0}})
+            elif call.get("methodname") == "core_calendar_get_action_events_by_timesort":
+                results.append({"error": False, "data": {"events": self.events[:int(args.get("limitnum", 20))]}})
+            elif call.get("methodname") == "message_popup_get_unread_popup_notification_count":
+                results.append({"error": False, "data": len(self.notifications)})
+            else:
+                results.append({"error": True, "exception": {
+                    "message": "Impossible de trouver la fonction externe",
+                    "errorcode": "servicenotavailable",
+                }})
+        return results
+
+
+class FakeMoodleHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    moodle = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_file(self):
+        moodle = self.moodle
+        headers = {"ETag": moodle.file_etag, "Accept-Ranges": "bytes"}
+        if self.headers.get("If-None-Match") == moodle.file_etag:
+            self.send_response(304)
+            self.send_header("ETag", moodle.file_etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(moodle.file) - 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(moodle.file)}"
+            self._send(206, moodle.file[start:end + 1], "application/pdf", headers)
+            return
+        headers["Content-Disposition"] = 'inline; filename="chapitre1.pdf"'
+        self._send(200, moodle.file, "application/pdf", headers)
+
+    def do_GET(self):
+        moodle = self.moodle
+        moodle.delay()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/login/index.php":
+            self._send(200, moodle.page("login_index.html"))
+        elif url.path == "/user/preferences.php" and (
+                moodle.sessions_expired or "MoodleSession=" not in self.headers.get("Cookie", "")):
+            self._send(303, headers={"Location": f"{moodle.base_url}/login/index.php"})
+        elif url.path in ("/", "/index.php", "/my/", "/user/preferences.php"):
+            self._send(200, moodle.page("index.html"))
+        elif url.path == "/course/index.php":
+            name = "course_category.html" if "categoryid" in query else "course_index.html"
+            self._send(200, moodle.page(name))
+        elif url.path == "/course/view.php":
+            self._send(200, moodle.page("course_view.html"))
+        elif url.path == "/mod/resource/view.php":
+            self._send(200, moodle.page("resource_view.html"))
+        elif url.path.startswith("/pluginfile.php/"):
+            self._send_file()
+        else:
+            self._send(404, b"Not found")
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        moodle = self.moodle
+        moodle.delay()
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if url.path == "/login/index.php":
+            self._send(200, moodle.page("index.html"), headers={"Set-Cookie": SESSION_COOKIE})
+        elif url.path == "/login/token.php":
+            self._send(200, json.dumps({"token": WEBSERVICE_TOKEN}).encode("utf-8"), "application/json")
+        elif url.path == "/webservice/rest/server.php":
+            query = parse_qs(url.query)
+            params = {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+            if query.get("wstoken", [None])[0] != WEBSERVICE_TOKEN:
+                result = {"exception": "moodle_exception", "errorcode": "invalidtoken",
+                          "message": "Jeton invalide - jeton non trouvé"}
+            else:
+                result = moodle.webservice(query.get("wsfunction", [None])[0], params)
+            payload = json.dumps(result, ensure_ascii=False).replace(FIXTURE_BASE_URL, moodle.base_url)
+            self._send(200, payload.encode("utf-8"), "application/json; charset=utf-8")
+        elif url.path == "/lib/ajax/service.php":
+            sesskey = parse_qs(url.query).get("sesskey", [None])[0]
+            payload = json.dumps(moodle.ajax(json.loads(body or b"[]"), sesskey), ensure_ascii=False)
+            payload = payload.replace(FIXTURE_BASE_URL, moodle.base_url).encode("utf-8")
+            self._send(200, payload, "application/json; charset=utf-8")
+        elif url.path == "/webhook":
+            self._send(200, b'{"status": "ok"}', "application/json")
+        else:
+            self._send(404, b"Not found")
+
+
+class FakeMoodleServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing a streamed page early (e.g. once M.cfg is read) are expected
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_fake_moodle(host="127.0.0.1", port=0, **kwargs):
+    """
+    Starts the fake Moodle in a background thread.
+
+    Returns:
+        tuple: The server (call shutdown() to stop it) and the FakeMoodle state
+    """
+    moodle = FakeMoodle(**kwargs)
+    handler = type("Handler", (FakeMoodleHandler,), {"moodle": moodle})
+    server = FakeMoodleServer((host, port), handler)
+    moodle.base_url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, moodle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--file-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    server, moodle = start_fake_moodle(
+        args.host, args.port,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, file_size=args.file_kb * 1024,
+    )
+    print(f"Fake Moodle listening on {moodle.base_url}")
+    print(f"Point the API at it with MOODLE_BASE_URL_TEMPLATE={moodle.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+Generates the Moodle fixture pages used by the benchmarks.
+
+The pages reproduce the markup of a Moodle 4.x site (Boost theme) as served
+by elearning.univ-*.dz: page chrome, inline M.cfg, navigation drawers and the
+elements read by the scrapers. Sizes are configurable so that parsers can be
+compared on pages as large as real course pages.
+
+Run this script from the Django project root directory:
+
+python benchmarks/make_fixtures.py
+"""
+import argparse
+import json
+import os
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+BASE_URL = "https://elearning.univ-bba.dz"
+
+CFG = {
+    "wwwroot": BASE_URL,
+    "homeurl": {},
+    "sesskey": "Fx8kq2LzPa",
+    "sessiontimeout": "7200",
+    "sessiontimeoutwarning": 1200,
+    "themerev": "1715000000",
+    "slasharguments": 1,
+    "theme": "boost",
+    "iconsystemmodule": "core/icon_system_fontawesome",
+    "jsrev": "1715000000",
+    "admin": "admin",
+    "svgicons": True,
+    "usertimezone": "Afrique/Alger",
+    "language": "fr",
+    "courseId": 1,
+    "courseContextId": 2,
+    "contextid": 1,
+    "contextInstanceId": 0,
+    "langrev": 1715000000,
+    "templaterev": "1715000000",
+    "userId": 4242,
+}
+
+
+def page(title, body, logged_in=True):
+    """
+    Wraps `body` in the Boost theme page chrome.
+    """
+    nav_items = "\n".join(
+        f'<li class="nav-item"><a class="nav-link" href="{BASE_URL}/course/view.php?id={i}">'
+        f'Navigation entry {i}</a></li>'
+        for i in range(40)
+    )
+    usermenu = (
+        '<div class="usermenu"><div class="dropdown show">'
+        '<a href="#" class="dropdown-toggle">Etudiant Test</a></div></div>'
+        if logged_in else
+        '<div class="usermenu"><span class="login">Vous n\'êtes pas connecté.</span></div>'
+    )
+    return f"""<!DOCTYPE html>
+<html dir="ltr" lang="fr" xml:lang="fr">
+<head>
+    <title>{title}</title>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+    <meta name="keywords" content="moodle, {title}" />
+    <link rel="stylesheet" type="text/css" href="{BASE_URL}/theme/styles.php/boost/1715000000_1/all" />
+    <script>
+    //<![CDATA[
+    var M = {{}}; M.yui = {{}};
+    M.pageloadstarttime = new Date();
+    M.cfg = {json.dumps(CFG)};
+    var yui1ConfigFn = function(me) {{if(/-skin|reset|fonts|grids|base/.test(me.name)){{me.type='css';me.path=me.path.replace(/\\.js/,'.css');}}}};
+    //]]>
+    </script>
+</head>
+<body id="page-site-index" class="format-site course path-site chrome dir-ltr lang-fr yui-skin-sam yui3-skin-sam pagelayout-frontpage">
+<div id="page-wrapper" class="d-print-block">
+    <nav class="navbar fixed-top navbar-light bg-white navbar-expand" aria-label="Navigation du site">
+        <a href="{BASE_URL}/" class="navbar-brand d-none d-md-flex align-items-center m-0 mr-4 p-0">elearning</a>
+        <ul class="navbar-nav d-none d-md-flex my-1 px-1">{nav_items}</ul>
+        <div id="usernavigation" class="navbar-nav ml-auto">{usermenu}</div>
+    </nav>
+    <div id="page" data-region="mainpage" data-usertour="scroller" class="drawers show-drawer-left drag-container">
+        <div id="topofscroll" class="main-inner">
+            <div id="page-content" class="pb-3 d-print-block">
+                <div id="region-main-box">
+                    <section id="region-main" aria-label="Contenu">
+{body}
+                    </section>
+                </div>
+            </div>
+        </div>
+        <footer id="page-footer" class="footer-popover bg-white">
+            <div class="logininfo">Connecté sous le nom « Etudiant Test »</div>
+            <div class="tool_dataprivacy"><a href="{BASE_URL}/admin/tool/dataprivacy/summary.php">Résumé de conservation des données</a></div>
+        </footer>
+    </div>
+</div>
+<script>
+//<![CDATA[
+M.util.js_pending('core/first');
+require(['core/first'], function() {{ M.util.js_complete('core/first'); }});
+//]]>
+</script>
+</body>
+</html>
+"""
+
+
+def login_page():
+    body = f"""
+<div class="loginform">
+    <div class="login-heading mb-4"><h2>Connexion à elearning</h2></div>
+    <form class="login-form" action="{BASE_URL}/login/index.php" method="post" id="login">
+        <input id="anchor" type="hidden" name="anchor" value="">
+        <input type="hidden" name="logintoken" value="q8Ryq7lbS3RkwJ0y0xRzGdtoyaIu1Zvg">
+        <div class="login-form-username mb-3">
+            <label for="username" class="sr-only">Nom d'utilisateur</label>
+            <input type="text" name="username" id="username" class="form-control form-control-lg" value="" placeholder="Nom d'utilisateur" autocomplete="username">
+        </div>
+        <div class="login-form-password mb-3">
+            <label for="password" class="sr-only">Mot de passe</label>
+            <input type="password" name="password" id="password" value="" class="form-control form-control-lg" placeholder="Mot de passe" autocomplete="current-password">
+        </div>
+        <div class="login-form-submit mb-3">
+            <button class="btn btn-primary btn-lg" type="submit" id="loginbtn">Connexion</button>
+        </div>
+    </form>
+</div>"""
+    return page("elearning: Connexion au site", body, logged_in=False)
+
+
+def front_page():
+    users = "\n".join(f'<li class="listentry"><a href="{BASE_URL}/user/view.php?id={i}">Utilisateur {i}</a></li>' for i in range(30))
+    body = f"""
+<div class="block_online_users block card mb-3" role="complementary">
+    <div class="card-body p-3">
+        <h5 class="card-title d-inline">Utilisateurs en ligne</h5>
+        <div class="card-text content mt-3"><ul class="list">{users}</ul></div>
+    </div>
+</div>"""
+    return page("elearning", body)
+
+
+def course_index(categories):
+    options = "\n".join(
+        f'<option value="{BASE_URL}/course/index.php?categoryid={i}">Faculté {i // 10} / Département {i}</option>'
+        for i in range(1, categories + 1)
+    )
+    body = f"""
+<div class="course_category_tree clearfix category-browse category-browse-0">
+    <div class="categorypicker">
+        <form method="get" action="{BASE_URL}/course/index.php" class="form-inline" id="switchcategory">
+            <select id="url_select" class="custom-select urlselect" name="jump">
+                <option value="">Choisir...</option>
+{options}
+            </select>
+        </form>
+    </div>
+</div>"""
+    return page("elearning: Cours", body)
+
+
+def course_category(courses):
+    boxes = "\n".join(f"""
+<div class="coursebox clearfix odd first" data-courseid="{1000 + i}" data-type="1">
+    <div class="info">
+        <h3 class="coursename"></h3>
+        <div class="coursename"><a class="aalink" href="{BASE_URL}/course/view.php?id={1000 + i}">Module {i} - Licence</a></div>
+        <div class="moreinfo"></div>
+        <div class="enrolmenticons"><i class="icon fa fa-sign-in fa-fw" title="Auto-inscription (Etudiant)"></i></div>
+    </div>
+    <div class="content">
+        <div class="d-flex"><div class="flex-grow-1"><div class="summary"><div class="no-overflow"><p>Description du module {i}.</p></div></div>
+        <ul class="teachers"><li>Enseignant: <a href="{BASE_URL}/user/view.php?id={i}&amp;course=1">Enseignant {i}</a></li></ul>
+        </div></div>
+    </div>
+</div>""" for i in range(courses))
+    body = f"""
+<div class="course_category_tree clearfix ">
+    <div class="content"><div class="courses category-browse category-browse-1">{boxes}</div></div>
+</div>"""
+    return page("elearning: Département 1", body)
+
+
+def course_view(sections, activities):
+    modtypes = ["resource", "url", "assign", "forum", "quiz", "folder"]
+    section_items = []
+    for s in range(sections):
+        items = []
+        for a in range(activities):
+            cmid = 5000 + s * activities + a
+            modtype = modtypes[a % len(modtypes)]
+            items.append(f"""
+<li class="activity activity-wrapper {modtype} modtype_{modtype} hasinfo" id="module-{cmid}" data-for="cmitem" data-id="{cmid}">
+    <div class="activity-item focus-control" data-activityname="Activité {s}.{a}" data-region="activity-card">
+        <div class="activity-grid">
+            <div class="activity-icon activityiconcontainer smaller content courseicon align-self-start mr-2">
+                <img src="{BASE_URL}/theme/image.php/boost/{modtype}/1715000000/monologo" class="activityicon" alt="">
+            </div>
+            <div class="activity-name-area activity-instance d-flex flex-column mr-2">
+                <div class="activitytitle modtype_{modtype} position-relative align-self-start">
+                    <div class="activityname">
+                        <a href="{BASE_URL}/mod/{modtype}/view.php?id={cmid}" class=" aalink stretched-link" onclick="">
+                            <span class="instancename">Activité {s}.{a} <span class="accesshide "> {modtype}</span></span>
+                        </a>
+                    </div>
+                </div>
+            </div>
+            <div class="activity-completion align-self-start ml-sm-2">
+                <div data-region="activity-information" data-activityname="Activité {s}.{a}" class="activity-information">
+                    <div class="completion-info" data-region="completion-info"></div>
+                </div>
+            </div>
+            <div class="activity-altcontent text-break"><div class="no-overflow"><p>Support de cours pour la séance {a} du chapitre {s}.</p></div></div>
+        </div>
+    </div>
+</li>""")
+        section_items.append(f"""
+<li id="section-{s}" class="section course-section main clearfix" role="region" aria-labelledby="sectionid-{s}-title" data-sectionid="{s}" data-sectionreturnid="0" data-for="section" data-id="{700 + s}" data-number="{s}">
+    <div class="section-item">
+        <div class="course-section-header d-flex" data-for="section_title" data-id="{700 + s}" data-number="{s}">
+            <h3 class="h4 sectionname course-content-item d-flex align-self-stretch align-items-center mb-0" id="sectionid-{s}-title" data-for="section_title" data-id="{700 + s}" data-number="{s}">
+                <a href="{BASE_URL}/course/section.php?id={700 + s}">Chapitre {s}</a>
+            </h3>
+        </div>
+        <div id="coursecontentcollapse{s}" class="content course-content-item-content collapse show">
+            <div class="my-3" data-for="sectioninfo"><div class="summarytext"><div class="no-overflow"><p>Résumé du chapitre {s}.</p></div></div></div>
+            <ul class="section m-0 p-0 img-text d-block " data-for="cmlist">{''.join(items)}</ul>
+        </div>
+    </div>
+</li>""")
+    body = f"""
+<div class="page-header-headings"><h1 class="h2">Module 1 - Licence</h1></div>
+<div class="course-content">
+    <ul class="topics">{''.join(section_items)}</ul>
+</div>"""
+    return page("Cours: Module 1 - Licence", body)
+
+
+def resource_view():
+    body = f"""
+<div role="main"><h2>Chapitre 1 - Introduction</h2>
+<div class="box py-3 generalbox center flex-column" id="intro"><div class="no-overflow"><p>Support du cours.</p></div></div>
+<div class="resourceworkaround">Cliquer sur le lien <a class="resourcelinkdetails" href="{BASE_URL}/pluginfile.php/1234/mod_resource/content/1/chapitre1.pdf" onclick="this.target='_blank'">chapitre1.pdf</a> pour afficher le fichier.</div>
+</div>"""
+    return page("Module 1: Chapitre 1", body)
+
+
+def notifications(count):
+    """
+    Popup notifications as returned by message_popup_get_popup_notifications,
+    newest first.
+    """
+    items = []
+    for i in range(count):
+        notification_id = 90000 + count - i
+        items.append({
+            "id": notification_id,
+            "useridfrom": 17,
+            "useridto": CFG["userId"],
+            "subject": f"Nouveau devoir: TP {count - i}",
+            "shortenedsubject": f"Nouveau devoir: TP {count - i}",
+            "text": f"Un nouveau devoir a été déposé dans le module {i % 7}.",
+            "fullmessage": f"Un nouveau devoir a été déposé dans le module {i % 7}.",
+            "fullmessageformat": 2,
+            "fullmessagehtml": f"<p>Un nouveau devoir a été déposé dans le module {i % 7}.</p>",
+            "smallmessage": f"Nouveau devoir: TP {count - i}",
+            "contexturl": f"{BASE_URL}/mod/assign/view.php?id={5000 + i}",
+            "contexturlname": f"TP {count - i}",
+            "timecreated": 1715000000 - i * 3600,
+            "timecreatedpretty": f"{i} heures",
+            "timeread": None,
+            "read": False,
+            "deleted": False,
+            "iconurl": f"{BASE_URL}/theme/image.php/boost/assign/1715000000/monologo",
+            "component": "mod_assign",
+            "eventtype": "assign_notification",
+            "customdata": "{}",
+        })
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--categories", type=int, default=150)
+    parser.add_argument("--courses", type=int, default=40)
+    parser.add_argument("--sections", type=int, default=20)
+    parser.add_argument("--activities", type=int, default=15)
+    parser.add_argument("--notifications", type=int, default=60)
+    args = parser.parse_args()
+
+    fixtures = {
+        "login_index.html": login_page(),
+        "index.html": front_page(),
+        "course_index.html": course_index(args.categories),
+        "course_category.html": course_category(args.courses),
+        "course_view.html": course_view(args.sections, args.activities),
+        "resource_view.html": resource_view(),
+        "notifications.json": json.dumps(notifications(args.notifications), indent=1, ensure_ascii=False),
+    }
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for name, content in fixtures.items():
+        with open(os.path.join(FIXTURES_DIR, name), "w", encoding="utf-8") as f:
+            f.write(content)
+        print(f"{name}: {len(content.encode('utf-8')) // 1024} KB")
+
+
+if __name__ == "__main__":
+    main()
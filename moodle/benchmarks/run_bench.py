@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Drives the API endpoints against the fake Moodle at a given concurrency.
+
+Starts the fake Moodle (benchmarks/fake_moodle.py) with the injected latency,
+serves the Django application from a threaded WSGI server in this process,
+logs in a few users and then fires requests at each endpoint. Reports
+latency percentiles, throughput and peak Python memory per endpoint.
+
+Run this script from the Django project root directory:
+
+python benchmarks/run_bench.py --concurrency 16 --requests 200 --latency-ms 100
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Add the project root to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.fake_moodle import start_fake_moodle
+
+# name -> (method, path, query parameters besides the session token)
+ENDPOINTS = {
+    "categories": ("GET", "/api/categories/", {}),
+    "courses": ("GET", "/api/courses/", {"id": "1"}),
+    "enrolled": ("GET", "/api/courses/", {}),
+    "chapters": ("GET", "/api/chapters/", {"id": "1"}),
+    "resource": ("GET", "/api/resource/", {"id": "1"}),
+    "notifications": ("GET", "/api/notifications/", {}),
+    "login": ("POST", "/api/login/", {}),
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def start_asgi_api():
+    """
+    Serves the Django application from uvicorn (one event loop) on a free
+    local port.
+
+    Returns:
+        tuple: A function stopping the server and its base URL
+    """
+    import socket
+
+    import uvicorn
+    from django.core.asgi import get_asgi_application
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    config = uvicorn.Config(get_asgi_application(), log_level="warning", lifespan="off", access_log=False)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+
+    return stop, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def start_api(asgi=False):
+    """
+    Serves the Django application on a free local port.
+
+    Returns:
+        tuple: A function stopping the server and its base URL
+    """
+    import django
+    from django.core.management import call_command
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    django.setup()
+    call_command("migrate", verbosity=0)
+    if asgi:
+        return start_asgi_api()
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(("127.0.0.1", 0), QuietHandler)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def login(api_url, username, prefix="/api/"):
+    response = requests.post(f"{api_url}{prefix}login/", json={"username": username, "password": "secret"})
+    response.raise_for_status()
+    return response.json()["session_token"]
+
+
+def run_endpoint(api_url, name, tokens, total, concurrency, prefix="/api/"):
+    """
+    Sends `total` requests to an endpoint from `concurrency` client threads.
+
+    Returns:
+        dict: Latencies (ms), error count and wall-clock duration (s)
+    """
+    method, path, params = ENDPOINTS[name]
+    path = path.replace("/api/", prefix, 1)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        client = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            token = tokens[i % len(tokens)]
+            start = time.perf_counter()
+            try:
+                if method == "POST":
+                    response = client.post(f"{api_url}{path}", json={"username": f"user{i}", "password": "secret"})
+                else:
+                    response = client.get(f"{api_url}{path}", params=dict(params, session_token=token))
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    return {"latencies": latencies, "errors": errors[0], "duration": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--users", type=int, default=8, help="Number of logged in users (session tokens)")
+    parser.add_argument("--latency-ms", type=float, default=100, help="Injected upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--file-kb", type=int, default=1024, help="Size of the served resource file")
+    parser.add_argument("--endpoint", action="append", choices=list(ENDPOINTS),
+                        help="Endpoint to measure (default: all)")
+    parser.add_argument("--no-catalog-cache", action="store_true",
+                        help="Expire catalog cache entries immediately to measure scraping")
+    parser.add_argument("--backend", choices=["scraper", "webservice"], default="scraper",
+                        help="Catalog backend: HTML scraping or the REST web service")
+    parser.add_argument("--asgi", action="store_true",
+                        help="Serve the async endpoints (/api/async/) from uvicorn instead of threaded WSGI")
+    parser.add_argument("--memory", action="store_true",
+                        help="Trace peak Python memory per endpoint (slower)")
+    args = parser.parse_args()
+
+    fake_server, moodle = start_fake_moodle(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, file_size=args.file_kb * 1024,
+    )
+    os.environ["MOODLE_BASE_URL_TEMPLATE"] = moodle.base_url
+    os.environ["BENCH_WEBHOOK_URL"] = f"{moodle.base_url}/webhook"
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.bench_settings"
+    if args.no_catalog_cache:
+        os.environ["BENCH_NO_CATALOG_CACHE"] = "1"
+    os.environ["BENCH_MOODLE_BACKEND"] = args.backend
+
+    prefix = "/api/async/" if args.asgi else "/api/"
+    stop_api, api_url = start_api(asgi=args.asgi)
+    tokens = [login(api_url, f"user{i}", prefix) for i in range(args.users)]
+    print(f"Fake Moodle at {moodle.base_url} ({args.latency_ms:.0f}±{args.jitter_ms:.0f} ms), "
+          f"API at {api_url} ({'ASGI' if args.asgi else 'WSGI'}), {args.users} users, "
+          f"concurrency {args.concurrency}, {args.backend} backend")
+    print(f"{'endpoint':<15}{'reqs':>6}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'req/s':>9}{'upstream':>10}{'peak MB':>9}")
+
+    for name in args.endpoint or list(ENDPOINTS):
+        upstream_before = moodle.requests
+        if args.memory:
+            tracemalloc.start()
+        result = run_endpoint(api_url, name, tokens, args.requests, args.concurrency, prefix)
+        peak = ""
+        if args.memory:
+            peak = f"{tracemalloc.get_traced_memory()[1] / 1024 ** 2:.1f}"
+            tracemalloc.stop()
+        latencies = result["latencies"]
+        print(f"{name:<15}{len(latencies):>6}{result['errors']:>8}"
+              f"{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}{percentile(latencies, 99):>9.1f}"
+              f"{len(latencies) / result['duration']:>9.1f}{moodle.requests - upstream_before:>10}{peak:>9}")
+
+    stop_api()
+    fake_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
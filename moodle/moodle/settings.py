@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
+    'api.middleware.UpstreamErrorMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,10 +81,54 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Concurrent writers (e.g. the course bundle downloads) wait for the
+        # write lock instead of failing with "database is locked"
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
     }
 }
 
 
+# Cache shared by all the workers and nodes: session cookies and registry,
+# catalog data, locks. Production sets MOODLE_CACHE_URL to Redis, e.g.
+# "redis://127.0.0.1:6379/1" (db 1, Celery uses db 0); unset, it falls back
+# to a per-process "locmem://" cache for development and tests.
+CACHE_URL = os.environ.get('MOODLE_CACHE_URL', 'locmem://')
+# Redis connections per worker process; requests wait for a free one
+# (at most CACHE_REDIS_POOL_TIMEOUT seconds) instead of failing
+CACHE_REDIS_MAX_CONNECTIONS = 50
+CACHE_REDIS_POOL_TIMEOUT = 5
+# Seconds before a connect or command gives up
+CACHE_REDIS_SOCKET_TIMEOUT = 2
+
+if CACHE_URL.startswith('locmem://'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_URL,
+            'KEY_PREFIX': 'moodle',
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                # Values are pickled, then zlib-compressed (cookies, catalog data)
+                'COMPRESSOR': 'django_redis.compressors.zlib.ZlibCompressor',
+                'SOCKET_CONNECT_TIMEOUT': CACHE_REDIS_SOCKET_TIMEOUT,
+                'SOCKET_TIMEOUT': CACHE_REDIS_SOCKET_TIMEOUT,
+                'CONNECTION_POOL_CLASS': 'redis.BlockingConnectionPool',
+                'CONNECTION_POOL_KWARGS': {
+                    'max_connections': CACHE_REDIS_MAX_CONNECTIONS,
+                    'timeout': CACHE_REDIS_POOL_TIMEOUT,
+                    'health_check_interval': 30,
+                },
+            },
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -137,18 +184,168 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'api.tasks.scrape_notifications',
         'schedule': crontab(minute='*/5'),
     },
+    'deliver-pending-notifications-every-10-minutes': {
+        'task': 'api.tasks.deliver_notifications',
+        'schedule': crontab(minute='*/10'),
+    },
+    'refresh-sessions-every-5-minutes': {
+        'task': 'api.tasks.refresh_sessions',
+        'schedule': crontab(minute='*/5'),
+    },
 }
 
 # Webhook settings for notifications
 # Make sure this URL points to your Laravel application's webhook endpoint
 NOTIFICATION_WEBHOOK_URL = "http://127.0.0.1:8001/api/webhook/moodle-notification"  # URL to your Laravel webhook endpoint
 WEBHOOK_SECRET_TOKEN = "moodle-notification-secret"  # Secret token for webhook authentication
+# Notifications are delivered in batches: {"token": ..., "notifications": [{university, notification_id, message, aria_label, timestamp}, ...]}
+NOTIFICATION_WEBHOOK_BATCH_SIZE = 50
+# Failed batches are retried after 30s, 60s, 120s, ...
+NOTIFICATION_WEBHOOK_RETRY_BACKOFF = 30
+NOTIFICATION_WEBHOOK_MAX_RETRIES = 5
+# Seconds a delivery holds the notifications it is sending, so that the
+# sweep and the other deliveries skip them (a pending retry holds them
+# until it runs)
+NOTIFICATION_WEBHOOK_CLAIM_SECONDS = 60
+
+# Scheduled notification polling of all active sessions
+# Polls are routed to the queues notifications-0 .. notifications-<N-1> when N > 1
+NOTIFICATION_POLL_SHARDS = 1
+# Polls of a beat are spread over this many seconds
+NOTIFICATION_POLL_JITTER = 120
+# Maximum concurrent polls against one Moodle host, across all workers
+NOTIFICATION_POLL_HOST_CONCURRENCY = 4
+# Retries of a poll finding its host busy before it waits for the next beat
+NOTIFICATION_POLL_MAX_RETRIES = 5
+
+# Session tokens are cached for 2 hours; the Moodle sessions expiring within
+# SESSION_REFRESH_MARGIN seconds are probed and renewed in the background
+# (keep it above the refresh-sessions beat interval). Renewal stops
+# SESSION_MAX_AGE seconds after the login, a later login with the same
+# credentials reuses the session token while Moodle keeps it logged in.
+SESSION_REFRESH_MARGIN = 15 * 60
+SESSION_MAX_AGE = 7 * 24 * 3600
 
 # Optional: Store default Moodle session cookies for scheduled tasks
 # This is useful for the Celery task that scrapes notifications periodically
 # Format: {"MoodleSession": "your-session-id", "MOODLEID1_": "your-moodle-id"}
 MOODLE_SESSION_COOKIES = None  # Set this in local_settings.py or environment variables
 
+# Category crawl settings
+# Number of category pages fetched in parallel by /api/categories/ (1 = sequential),
+# within the max_concurrency of the Moodle (MOODLE_TENANTS)
+MOODLE_CATEGORY_CRAWL_WORKERS = 8
+
+# Pooled Moodle sessions (per worker process)
+# Maximum number of session tokens with a warm connection pool
+MOODLE_SESSION_POOL_MAX_SESSIONS = 200
+# Seconds after which an unused pooled session is closed
+MOODLE_SESSION_POOL_IDLE_TIMEOUT = 900
+# Keep-alive connections per session and host
+MOODLE_SESSION_POOL_MAXSIZE = 4
+# Upper bound of keep-alive connections across all pooled sessions
+MOODLE_SESSION_POOL_MAX_CONNECTIONS = 400
+
+# Catalog cache for scraped categories, courses and chapters
+# scope: 'public' entries are shared by all users, 'user' entries are per session token
+# ttl: seconds an entry is served as fresh
+# stale_ttl: extra seconds a stale entry is served while Celery refreshes it
+CATALOG_CACHE = {
+    'categories': {'scope': 'public', 'ttl': 6 * 3600, 'stale_ttl': 24 * 3600},
+    'courses': {'scope': 'public', 'ttl': 3600, 'stale_ttl': 12 * 3600},
+    'chapters': {'scope': 'user', 'ttl': 600, 'stale_ttl': 3600},
+    'enrolled': {'scope': 'user', 'ttl': 600, 'stale_ttl': 3600},
+}
+# Seconds an expired entry is kept to be served while Moodle is unreachable
+CATALOG_CACHE_OUTAGE_TTL = 24 * 3600
+# Seconds partial or empty data (e.g. category pages that failed) is cached
+CATALOG_CACHE_INCOMPLETE_TTL = 60
+# Copy fetched categories, courses and chapters into the catalog tables,
+# served by /api/catalog/*
+CATALOG_STORE = True
+# Secret token required by /api/cache/invalidate/
+CATALOG_CACHE_INVALIDATION_TOKEN = "catalog-invalidation-secret"
+
+# Concurrent identical fetches from Moodle (catalog misses, resource downloads)
+# are collapsed into one, the other requests wait for it (at most
+# SINGLEFLIGHT_WAIT seconds, then they fetch on their own). The lock timeouts
+# cover a process dying mid-fetch.
+SINGLEFLIGHT_WAIT = 30
+SINGLEFLIGHT_LOCK_TIMEOUT = 120
+RESOURCE_FILL_LOCK_TIMEOUT = 600
+# Seconds a resource request waits for a concurrent download of the same
+# file to be stored, before fetching the file itself
+RESOURCE_FILL_WAIT = 1
+
+# Connection pools of the async views (api/async/...), one per Moodle host
+# shared by all users of a worker process
+MOODLE_ASYNC_MAX_CONNECTIONS = 400
+MOODLE_ASYNC_MAX_KEEPALIVE = 100
+MOODLE_ASYNC_TIMEOUT = 30
+
+# Backend used to fetch catalog data of the universities that do not set
+# one: "scraper" parses the HTML pages, "webservice" calls
+# webservice/rest/server.php with a token obtained at login (falls back to
+# scraping when unavailable)
+MOODLE_DEFAULT_BACKEND = "scraper"
+
+# Universities served by this deployment, selected by the `university`
+# parameter at login (then by the session token) and defaulting to
+# MOODLE_DEFAULT_TENANT. Options, all optional:
+# base_url: Moodle root URL, defaults to https://elearning.univ-<name>.dz
+# backend: "scraper" or "webservice", defaults to MOODLE_DEFAULT_BACKEND
+# max_concurrency: requests waiting on this Moodle at once, per worker process
+# queue_timeout: seconds a request waits for one of those slots, then fails
+# max_connections: async pool size for this Moodle (MOODLE_ASYNC_MAX_CONNECTIONS)
+# timeout: (connect, read) seconds of the requests to it, defaults to (5, 30)
+# rate_limit: requests per second to it from all the workers (shared through
+#     Redis), defaults to 50; rate_burst: burst above it, defaults to 2x
+# failure_ratio, min_calls, slow_call_seconds, open_seconds: its circuit
+#     breaker, which fails fast (503) for open_seconds once failure_ratio of
+#     at least min_calls recent requests failed or were slower than
+#     slow_call_seconds (defaults 0.5, 10, 10, 30)
+MOODLE_TENANTS = {
+    'bba': {},
+    # 'usthb': {'base_url': 'https://elearning.usthb.dz', 'backend': 'webservice', 'max_concurrency': 32},
+}
+MOODLE_DEFAULT_TENANT = 'bba'
+# External service the web service tokens are requested for
+MOODLE_WEBSERVICE_NAME = "moodle_mobile_app"
+
+# Size of the chunks streamed to the client by /api/resource/
+RESOURCE_STREAM_CHUNK_SIZE = 64 * 1024
+
+# On-disk cache of downloaded resources (content-addressed, LRU evicted)
+RESOURCE_CACHE_DIR = BASE_DIR / 'resource_cache'
+RESOURCE_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# Files of a course fetched at once by /api/courses/bundle/
+COURSE_BUNDLE_CONCURRENCY = 4
+
+# Debug capture of the fetched Moodle pages and parsed data, off by default.
+# Set DEBUG_CAPTURE_SAMPLE_RATE (0 to 1) to keep that fraction of the
+# captures; only the newest DEBUG_CAPTURE_MAX_FILES are kept on disk.
+DEBUG_CAPTURE_DIR = BASE_DIR / 'debug_capture'
+DEBUG_CAPTURE_SAMPLE_RATE = 0.0
+DEBUG_CAPTURE_MAX_FILES = 200
+
+# Leveled logging of the api and services modules (DEBUG traces scraping)
+LOG_LEVEL = 'INFO'
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'api': {'handlers': ['console'], 'level': LOG_LEVEL},
+        'services': {'handlers': ['console'], 'level': LOG_LEVEL},
+    },
+}
+
 # Try to load local settings if they exist
 try:
     from .local_settings import *
@@ -0,0 +1,295 @@
+import json
+import logging
+import re
+
+import httpx
+import requests
+
+from .hosts import moodle_url
+from .metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Pages the M.cfg block is read from, lightest first. The block is in the
+# page <head>, so the download stops as soon as it has been read.
+CFG_PAGES = ('/user/preferences.php', '/')
+
+
+class AjaxError(RuntimeError):
+    """
+    Error returned by Moodle for one call of a lib/ajax/service.php request.
+    """
+
+    def __init__(self, message, errorcode=None):
+        super().__init__(message)
+        self.errorcode = errorcode
+
+
+class SessionKeyError(AjaxError):
+    """
+    Raised when Moodle rejects the sesskey of an AJAX request.
+    """
+
+
+def extract_cfg(html):
+    """
+    Extracts the M.cfg JavaScript object of a Moodle page.
+    """
+    # Fix: Adjust regex to match unescaped JS variable
+    match = re.search(r'M\.cfg\s*=\s*({.*?});', html, re.DOTALL)
+    if not match:
+        raise ValueError("M.cfg block not found")
+    return json.loads(match.group(1))
+
+
+def _read_cfg(session, university_name, path):
+    resp = session.get(
+        moodle_url(university_name, path),
+        headers={'Referer': 'https://google.com'},
+        stream=True,
+    )
+    try:
+        resp.raise_for_status()
+        html = b''
+        for chunk in resp.iter_content(chunk_size=8192):
+            html += chunk
+            try:
+                return extract_cfg(html.decode('utf-8', errors='replace'))
+            except ValueError:
+                # Not (entirely) received yet
+                continue
+        raise ValueError(f"M.cfg block not found in {path}")
+    finally:
+        resp.close()
+
+
+def _checked_cfg(cfg):
+    if not cfg.get('sesskey') or not cfg.get('userId'):
+        raise RuntimeError(f"Failed to extract sesskey/userId from M.cfg: {cfg}")
+    return {'sesskey': cfg['sesskey'], 'userId': cfg['userId']}
+
+
+def load_cfg(session, university_name):
+    """
+    Loads the sesskey and userId of a session from the M.cfg block of the
+    lightest page that has it (see CFG_PAGES).
+
+    Returns:
+        dict: {"sesskey": ..., "userId": ...}
+    """
+    cfg = None
+    for path in CFG_PAGES:
+        try:
+            cfg = _read_cfg(session, university_name, path)
+            break
+        except (ValueError, requests.HTTPError) as e:
+            logger.warning(f"Could not read M.cfg from {path}: {e}")
+    if cfg is None:
+        raise ValueError("M.cfg block not found")
+    return _checked_cfg(cfg)
+
+
+async def _aread_cfg(session, university_name, path):
+    resp = await session.get(
+        moodle_url(university_name, path),
+        headers={'Referer': 'https://google.com'},
+        stream=True,
+    )
+    try:
+        resp.raise_for_status()
+        html = b''
+        async for chunk in resp.aiter_bytes(8192):
+            html += chunk
+            try:
+                return extract_cfg(html.decode('utf-8', errors='replace'))
+            except ValueError:
+                # Not (entirely) received yet
+                continue
+        raise ValueError(f"M.cfg block not found in {path}")
+    finally:
+        await resp.aclose()
+
+
+async def aload_cfg(session, university_name):
+    """
+    Async counterpart of load_cfg(), with an AsyncMoodleSession.
+    """
+    cfg = None
+    for path in CFG_PAGES:
+        try:
+            cfg = await _aread_cfg(session, university_name, path)
+            break
+        except (ValueError, httpx.HTTPStatusError) as e:
+            logger.warning(f"Could not read M.cfg from {path}: {e}")
+    if cfg is None:
+        raise ValueError("M.cfg block not found")
+    return _checked_cfg(cfg)
+
+
+def _ajax_payload(calls):
+    return [
+        {"index": index, "methodname": methodname, "args": args or {}}
+        for index, (methodname, args) in enumerate(calls)
+    ]
+
+
+def _ajax_params(cfg, calls):
+    return {
+        'sesskey': cfg['sesskey'],
+        'info': ','.join(methodname for methodname, _ in calls),
+    }
+
+
+def _ajax_headers(university_name):
+    return {
+        'X-Requested-With': 'XMLHttpRequest',
+        'Content-Type':      'application/json',
+        'Origin':            moodle_url(university_name)
+    }
+
+
+def _ajax_results(data, calls):
+    """
+    Demultiplexes a service.php response into one result per call.
+    """
+    if not isinstance(data, list) or not data:
+        raise RuntimeError(f"Unexpected response format: {data}")
+
+    # Moodle stops at the first failing call, the following ones are
+    # missing from the response
+    results = [AjaxError("Not executed, a previous call failed") for _ in calls]
+    for index, result in enumerate(data[:len(calls)]):
+        if result.get('exception') or result.get('error'):
+            exception = result.get('exception') or {}
+            errorcode = exception.get('errorcode')
+            if errorcode == 'invalidsesskey':
+                raise SessionKeyError(f"Moodle rejected the sesskey: {result}", errorcode)
+            results[index] = AjaxError(f"Moodle API Error: {result}", errorcode)
+        else:
+            results[index] = result.get('data')
+    return results
+
+
+class AjaxClient:
+    """
+    Client of Moodle's lib/ajax/service.php, which runs several external
+    functions in a single POST.
+
+    The sesskey/userId of the session are loaded on first use (or passed in
+    from a previous client through `cfg`) and reloaded once when Moodle
+    rejects the sesskey.
+    """
+
+    def __init__(self, session, university_name, cfg=None):
+        self.session = session
+        self.university_name = university_name
+        self.cfg = cfg
+
+    @property
+    def user_id(self):
+        self.ensure_cfg()
+        return self.cfg['userId']
+
+    def ensure_cfg(self):
+        if not self.cfg:
+            self.load_cfg()
+
+    def load_cfg(self):
+        self.cfg = load_cfg(self.session, self.university_name)
+
+    def _post(self, calls):
+        r = self.session.post(
+            moodle_url(self.university_name, "/lib/ajax/service.php"),
+            params=_ajax_params(self.cfg, calls),
+            json=_ajax_payload(calls),
+            headers=_ajax_headers(self.university_name),
+        )
+        r.raise_for_status()
+        return _ajax_results(r.json(), calls)
+
+    def batch(self, calls):
+        """
+        Runs several external functions in one request.
+
+        Args:
+            calls: List of (methodname, args) tuples
+
+        Returns:
+            list: The result of each call, in order; failed calls are
+                  returned as AjaxError instances
+        """
+        if not calls:
+            return []
+        self.ensure_cfg()
+        try:
+            return self._post(calls)
+        except SessionKeyError:
+            # The cached sesskey is stale (Moodle session renewed), reload it once
+            logger.info("sesskey rejected, reloading M.cfg")
+            RETRIES.inc(reason="sesskey")
+            self.load_cfg()
+            return self._post(calls)
+
+    def call(self, methodname, args=None):
+        """
+        Runs a single external function.
+
+        Raises:
+            AjaxError: If Moodle returned an error for the call
+        """
+        result = self.batch([(methodname, args)])[0]
+        if isinstance(result, AjaxError):
+            raise result
+        return result
+
+
+class AsyncAjaxClient:
+    """
+    Async counterpart of AjaxClient, over an AsyncMoodleSession. The
+    sesskey/userId must be loaded (ensure_cfg) before reading user_id.
+    """
+
+    def __init__(self, session, university_name, cfg=None):
+        self.session = session
+        self.university_name = university_name
+        self.cfg = cfg
+
+    async def ensure_cfg(self):
+        if not self.cfg:
+            await self.load_cfg()
+
+    async def load_cfg(self):
+        self.cfg = await aload_cfg(self.session, self.university_name)
+
+    @property
+    def user_id(self):
+        return self.cfg['userId']
+
+    async def _post(self, calls):
+        r = await self.session.post(
+            moodle_url(self.university_name, "/lib/ajax/service.php"),
+            params=_ajax_params(self.cfg, calls),
+            json=_ajax_payload(calls),
+            headers=_ajax_headers(self.university_name),
+        )
+        r.raise_for_status()
+        return _ajax_results(r.json(), calls)
+
+    async def batch(self, calls):
+        if not calls:
+            return []
+        await self.ensure_cfg()
+        try:
+            return await self._post(calls)
+        except SessionKeyError:
+            # The cached sesskey is stale (Moodle session renewed), reload it once
+            logger.info("sesskey rejected, reloading M.cfg")
+            RETRIES.inc(reason="sesskey")
+            await self.load_cfg()
+            return await self._post(calls)
+
+    async def call(self, methodname, args=None):
+        result = (await self.batch([(methodname, args)]))[0]
+        if isinstance(result, AjaxError):
+            raise result
+        return result
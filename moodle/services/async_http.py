@@ -0,0 +1,151 @@
+import asyncio
+import time
+import weakref
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from http.cookies import SimpleCookie
+from urllib.parse import urljoin, urlparse
+
+import httpx
+
+from .metrics import observe_upstream
+from .tenants import tenant_for_url
+from .upstream import aguard
+
+# Connections to one Moodle host shared by all users of an event loop
+DEFAULT_MAX_CONNECTIONS = 400
+# Idle connections kept open for reuse
+DEFAULT_MAX_KEEPALIVE = 100
+# Seconds before a connect/read/write/pool wait gives up, for the hosts
+# that are not tenants (those have a timeout of their own)
+DEFAULT_TIMEOUT = 30
+MAX_REDIRECTS = 10
+
+_limits = httpx.Limits(max_connections=DEFAULT_MAX_CONNECTIONS, max_keepalive_connections=DEFAULT_MAX_KEEPALIVE)
+_timeout = httpx.Timeout(DEFAULT_TIMEOUT)
+
+# One client (connection pool) per event loop and Moodle host: httpx
+# connections cannot be shared across loops (e.g. when async views run under
+# WSGI), and a slow Moodle must not hold the connections of the others
+_clients = weakref.WeakKeyDictionary()
+
+
+def configure(max_connections=DEFAULT_MAX_CONNECTIONS, max_keepalive=DEFAULT_MAX_KEEPALIVE,
+              timeout=DEFAULT_TIMEOUT):
+    """
+    Sets the pool limits of the clients created from now on.
+    """
+    global _limits, _timeout
+    _limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+    _timeout = httpx.Timeout(timeout)
+
+
+def _host_options(url):
+    # Tenants have a timeout, and may have a connection limit, of their own
+    tenant = tenant_for_url(url)
+    if tenant is None:
+        return _limits, _timeout
+    limits = _limits
+    if tenant.max_connections:
+        limits = httpx.Limits(
+            max_connections=tenant.max_connections,
+            max_keepalive_connections=min(tenant.max_connections, _limits.max_keepalive_connections),
+        )
+    connect, read = tenant.timeout
+    return limits, httpx.Timeout(read, connect=connect)
+
+
+def get_client(url):
+    """
+    Returns the shared AsyncClient of the running event loop for the host
+    of `url`.
+
+    The client never stores cookies: it is shared by all users, each
+    AsyncMoodleSession sends its own cookies.
+    """
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    host = urlparse(url).netloc
+    client = clients.get(host)
+    if client is None:
+        limits, timeout = _host_options(url)
+        client = httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            follow_redirects=False,
+            cookies=CookieJar(DefaultCookiePolicy(allowed_domains=[])),
+        )
+        clients[host] = client
+    return client
+
+
+class AsyncMoodleSession:
+    """
+    Cookies of one Moodle user on top of the shared async client, the async
+    counterpart of a requests.Session. Redirects are followed here so that
+    cookies set along the way (e.g. at login) are kept.
+    """
+
+    def __init__(self, cookies=None):
+        self.cookies = dict(cookies or {})
+
+    def _store_cookies(self, response):
+        for header in response.headers.get_list("set-cookie"):
+            cookie = SimpleCookie()
+            try:
+                cookie.load(header)
+            except Exception:
+                continue
+            for name, morsel in cookie.items():
+                if morsel.value in ("", "deleted") or morsel["max-age"] == "0":
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+
+    def _cookie_header(self):
+        return "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+
+    async def send(self, method, url, params=None, headers=None, data=None, json=None, stream=False,
+                   follow_redirects=True):
+        """
+        Sends a request with the session cookies.
+
+        Args:
+            stream: Leave the body unread; the caller must `await response.aclose()`
+
+        Returns:
+            httpx.Response
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            client = get_client(url)
+            request_headers = dict(headers or {})
+            if self.cookies:
+                request_headers["Cookie"] = self._cookie_header()
+            request = client.build_request(method, url, params=params, headers=request_headers, data=data, json=json)
+            async with aguard(url) as call:
+                start = time.perf_counter()
+                response = await client.send(request, stream=True)
+                call.status = response.status_code
+            observe_upstream(method, str(request.url), response.status_code, time.perf_counter() - start)
+            self._store_cookies(response)
+
+            if not (follow_redirects and response.has_redirect_location):
+                break
+            await response.aclose()
+            url, params = urljoin(str(response.url), response.headers["Location"]), None
+            if response.status_code == 303 or (response.status_code in (301, 302) and method == "POST"):
+                method, data, json = "GET", None, None
+        else:
+            await response.aclose()
+            raise httpx.TooManyRedirects("Exceeded maximum allowed redirects", request=request)
+
+        if not stream:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.send("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.send("POST", url, **kwargs)
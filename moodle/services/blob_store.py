@@ -0,0 +1,73 @@
+import hashlib
+import os
+import tempfile
+
+
+class BlobWriter:
+    """
+    Writes a blob to a temporary file while hashing it. The blob only becomes
+    visible in the store once `commit()` renames it to its content address.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        """
+        Returns:
+            tuple: The sha256 hex digest and the size of the blob
+        """
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.store.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Atomic on POSIX, an identical blob written concurrently is simply replaced
+        os.replace(self._tmp_path, path)
+        return digest, self.size
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    """
+    Content-addressed file store: blobs are named after the sha256 of their
+    content, so identical files downloaded for different resources are kept
+    once. The store holds no metadata, callers keep their own index.
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def writer(self):
+        return BlobWriter(self)
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
@@ -1,73 +1,163 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
+from . import debug_capture
+from .hosts import moodle_url
+from .metrics import PARSE_SECONDS
+from .parsing import has_class, make_soup, only
+from .tenants import get_tenant
 
-def get_categories(session, university_name):
-    import requests
-    import json
-    from bs4 import BeautifulSoup
-    import os
-
-
-    # Otherwise fetch it from the website
-    response = session.get(f"https://elearning.univ-{university_name}.dz/course/index.php")
-    html_content = response.text
-    # Save for future reference
-    #with open("courses.html", "w", encoding="utf-8") as f:
-     #   f.write(html_content)
-    
-    soup = BeautifulSoup(html_content, "html.parser")
-    
-    # Find the course categories from the dropdown select
-    categories_data = []
-    select_element = soup.find("select", {"name": "jump"})
-    
-    if select_element:
-        options = select_element.find_all("option")
-        
-        for option in options:
-            category_url = option.get("value")
-            category_name = option.text.strip()
-            
-            # Skip if not a valid category URL
-            if not category_url or "categoryid" not in category_url:
-                continue
-                
-            # Extract category ID from URL
-            category_id = None
-            if "categoryid=" in category_url:
-                category_id = category_url.split("categoryid=")[1].split("&")[0]
-            
-            # Get subcategories by visiting the category page
-            subcategories = []
-            try:
-                cat_response = session.get(category_url)
-                cat_soup = BeautifulSoup(cat_response.text, "html.parser")
-                
-                # Find course items in this category
-                course_items = cat_soup.find_all("div", {"class": "coursebox"})
-                
-                for item in course_items:
-                    course_name_div = item.find("div", {"class": "coursename"})
-                    if course_name_div:
-                        course_link = course_name_div.find("a")
-                        if course_link:
-                            subcategories.append({
-                                "name": course_link.text.strip(),
-                                "url": course_link.get("href")
-                            })
-            except Exception as e:
-                print(f"Error fetching subcategories for {category_name}: {str(e)}")
-            
-            categories_data.append({
-                "id": category_id,
-                "name": category_name,
-                "url": category_url
+
+# Default fan-out used when crawling category pages
+DEFAULT_MAX_WORKERS = 8
+
+
+def _crawl_workers(university_name, max_workers):
+    # More pages in flight than the Moodle admits (services/upstream.py)
+    # would only be rejected as busy
+    return max(1, min(max_workers, get_tenant(university_name).max_concurrency))
+
+
+@PARSE_SECONDS.timed(parser="categories")
+def parse_categories(html):
+    """
+    Parses the categories listed in the jump menu of course/index.php.
+
+    Returns:
+        list: Category dicts with id, name and url
+    """
+    soup = make_soup(html, parse_only=only("select", {"name": "jump"}))
+
+    categories = []
+    for option in soup.select('select[name="jump"] option'):
+        category_url = option.get("value")
+        category_name = option.text.strip()
+
+        # Skip if not a valid category URL
+        if not category_url or "categoryid" not in category_url:
+            continue
+
+        # Extract category ID from URL
+        category_id = None
+        if "categoryid=" in category_url:
+            category_id = category_url.split("categoryid=")[1].split("&")[0]
+
+        categories.append({
+            "id": category_id,
+            "name": category_name,
+            "url": category_url
         })
-    
-    # Convert to JSON
-    categories_json = json.dumps(categories_data, indent=4, ensure_ascii=False)
-    
-    # Save to file
-    with open("courses.json", "w", encoding="utf-8") as f:
-        f.write(categories_json)
-        
+    return categories
+
+
+@PARSE_SECONDS.timed(parser="category_courses")
+def parse_category_courses(html):
+    """
+    Parses the course boxes of a category page.
+
+    Returns:
+        list: dicts with the course name and url
+    """
+    soup = make_soup(html, parse_only=only("div", {"class": has_class("coursebox")}))
+
+    courses = []
+    for item in soup.select("div.coursebox"):
+        course_link = item.select_one("div.coursename a")
+        if course_link:
+            courses.append({
+                "name": course_link.text.strip(),
+                "url": course_link.get("href")
+            })
+    return courses
+
+
+def _fetch_category(session, category):
+    """
+    Fetches a single category page and parses the courses listed in it.
+
+    Args:
+        session: The requests session with authentication cookies
+        category: dict with the category id, name and url
+
+    Returns:
+        dict: The category with its `subcategories`, and an `error` message
+              if the page could not be fetched or parsed
+    """
+    category = dict(category, subcategories=[])
+    try:
+        cat_response = session.get(category["url"])
+        category["subcategories"] = parse_category_courses(cat_response.text)
+    except Exception as e:
+        category["error"] = f"Error fetching subcategories for {category['name']}: {str(e)}"
+    return category
+
+
+def get_categories(session, university_name, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Fetches the category tree of a Moodle instance.
+
+    The jump menu of `course/index.php` lists every category; each category page
+    is then crawled with a bounded thread pool. Results keep the order of the
+    jump menu and failures are reported per category instead of aborting.
+
+    Args:
+        session: The requests session with authentication cookies
+        university_name: The university subdomain (e.g. 'bba')
+        max_workers: Number of category pages fetched in parallel
+                     (1 crawls sequentially), capped by the max_concurrency
+                     of the Moodle
+
+    Returns:
+        list: Category dicts with id, name, url and subcategories
+    """
+    response = session.get(moodle_url(university_name, "/course/index.php"))
+    categories = parse_categories(response.text)
+    max_workers = _crawl_workers(university_name, max_workers)
+
+    # Get subcategories by visiting the category pages
+    if max_workers <= 1 or len(categories) <= 1:
+        categories_data = [_fetch_category(session, c) for c in categories]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(categories))) as executor:
+            # map() yields results in submission order
+            categories_data = list(executor.map(lambda c: _fetch_category(session, c), categories))
+
+    debug_capture.capture("categories", categories_data)
+
+    return categories_data
+
+
+async def _afetch_category(session, category, semaphore):
+    category = dict(category, subcategories=[])
+    try:
+        async with semaphore:
+            cat_response = await session.get(category["url"])
+        category["subcategories"] = await asyncio.to_thread(parse_category_courses, cat_response.text)
+    except Exception as e:
+        category["error"] = f"Error fetching subcategories for {category['name']}: {str(e)}"
+    return category
+
+
+async def aget_categories(session, university_name, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Async counterpart of get_categories(). Category pages are fetched
+    concurrently on the event loop, at most `max_workers` at a time (and no
+    more than the max_concurrency of the Moodle); parsing runs in a worker
+    thread.
+
+    Args:
+        session: services.async_http.AsyncMoodleSession
+        university_name: The university subdomain (e.g. 'bba')
+        max_workers: Number of category pages fetched at once
+
+    Returns:
+        list: Category dicts with id, name, url and subcategories
+    """
+    response = await session.get(moodle_url(university_name, "/course/index.php"))
+    categories = await asyncio.to_thread(parse_categories, response.text)
+    semaphore = asyncio.Semaphore(_crawl_workers(university_name, max_workers))
+    categories_data = list(await asyncio.gather(
+        *(_afetch_category(session, c, semaphore) for c in categories)
+    ))
+    debug_capture.capture("categories", categories_data)
     return categories_data
@@ -1,27 +1,46 @@
 
 
-import requests
-import json
-from bs4 import BeautifulSoup
+import asyncio
 import re
-import os
+
+from .hosts import moodle_url
+from .metrics import PARSE_SECONDS
+from .parsing import has_class, make_soup, only
 
 
 def get_chapters(session, id, university_name):
-    response = session.get(f"https://elearning.univ-{university_name}.dz/course/view.php?id={id}")
-    
- 
-    
-    soup = BeautifulSoup(response.text, "html.parser")
-    
+    response = session.get(moodle_url(university_name, f"/course/view.php?id={id}"))
+    return parse_chapters(response.text, id)
+
+
+async def aget_chapters(session, id, university_name):
+    """
+    Async counterpart of get_chapters(); the page is parsed in a worker
+    thread so that the event loop keeps serving other requests.
+    """
+    response = await session.get(moodle_url(university_name, f"/course/view.php?id={id}"))
+    return await asyncio.to_thread(parse_chapters, response.text, id)
+
+
+@PARSE_SECONDS.timed(parser="chapters")
+def parse_chapters(html, id):
+    """
+    Parses the sections and activities of a course/view.php page.
+
+    Returns:
+        dict: The course id, title and sections with their activities
+    """
+    # Only the course title and the section lists are built into the tree
+    soup = make_soup(html, parse_only=only(["h1", "li"], {"class": has_class("h2", "section")}))
+
     # Get course title
     course_title = ""
-    title_element = soup.find("h1", {"class": "h2"})
+    title_element = soup.select_one("h1.h2")
     if title_element:
         course_title = title_element.text.strip()
     
     # Find all sections
-    sections = soup.find_all("li", {"class": "section", "data-for": "section"})
+    sections = soup.select('li.section[data-for="section"]')
     
     chapters_data = []
     
@@ -34,7 +53,7 @@ def get_chapters(session, id, university_name):
         
         # Get section name
         section_name = ""
-        section_title = section.find("h3", {"class": "sectionname"})
+        section_title = section.select_one("h3.sectionname")
         if section_title:
             section_name = section_title.text.strip()
         
@@ -46,12 +65,12 @@ def get_chapters(session, id, university_name):
         }
         
         # Get section summary
-        summary_div = section.find("div", {"class": "summarytext"})
+        summary_div = section.select_one("div.summarytext")
         if summary_div:
             section_data["summary"] = summary_div.text.strip()
         
         # Find all activities in this section
-        activities = section.find_all("li", {"class": "activity"})
+        activities = section.select("li.activity")
         
         for activity in activities:
             activity_data = {}
@@ -59,12 +78,12 @@ def get_chapters(session, id, university_name):
             # Get activity name
             activity_name_element = activity.get("data-activityname")
             if not activity_name_element:
-                activity_name_div = activity.find("div", {"data-region": "activity-information"})
+                activity_name_div = activity.select_one('div[data-region="activity-information"]')
                 if activity_name_div:
                     activity_name_element = activity_name_div.get("data-activityname")
             
             if not activity_name_element:
-                activity_name_span = activity.find("span", {"class": "instancename"})
+                activity_name_span = activity.select_one("span.instancename")
                 if activity_name_span:
                     activity_name_element = activity_name_span.text.strip()
             
@@ -72,7 +91,7 @@ def get_chapters(session, id, university_name):
                 activity_data["name"] = activity_name_element
             
             # Get activity link
-            activity_link = activity.find("a", {"class": "aalink"})
+            activity_link = activity.select_one("a.aalink")
             if activity_link:
                 activity_data["url"] = activity_link.get("href")
                 
@@ -1,99 +1,188 @@
 
-import requests
-import json
-from bs4 import BeautifulSoup
+import asyncio
+import logging
 import re
-import os
+import time
+
+from . import debug_capture
+from .ajax import AjaxError
+from .hosts import moodle_url
+from .metrics import PARSE_SECONDS
+from .parsing import make_soup
+
+logger = logging.getLogger(__name__)
 
 
 def get_courses(session, id, university_name):
     # Make the request to get the category page
-    print(f"Fetching courses for category ID: {id}")
-    response = session.get(f"https://elearning.univ-{university_name}.dz/course/index.php?categoryid={id}")
-    
-    # Save the HTML for debugging
-    with open("courses_debug.html", "w", encoding="utf-8") as f:
-        f.write(response.text)
-    
-    print(f"Response status code: {response.status_code}")
-    
-    soup = BeautifulSoup(response.text, "html.parser")
+    logger.debug(f"Fetching courses for category ID: {id}")
+    response = session.get(moodle_url(university_name, f"/course/index.php?categoryid={id}"))
+    logger.debug(f"Response status code: {response.status_code}")
+    debug_capture.capture(f"courses_category_{id}", response.text)
+
+    courses_data = parse_courses(response.text)
+    debug_capture.capture(f"courses_category_{id}", courses_data)
+
+    return courses_data
+
+
+async def aget_courses(session, id, university_name):
+    """
+    Async counterpart of get_courses(); the page is parsed in a worker thread.
+    """
+    response = await session.get(moodle_url(university_name, f"/course/index.php?categoryid={id}"))
+    debug_capture.capture(f"courses_category_{id}", response.text)
+
+    courses_data = await asyncio.to_thread(parse_courses, response.text)
+    debug_capture.capture(f"courses_category_{id}", courses_data)
+    return courses_data
+
+
+def _enrolled_calls(classification, events_limit):
+    return [
+        ("core_course_get_enrolled_courses_by_timeline_classification", {
+            "offset": 0,
+            "limit": 0,
+            "classification": classification,
+            "sort": "fullname",
+        }),
+        ("core_calendar_get_action_events_by_timesort", {
+            "timesortfrom": int(time.time()),
+            "limitnum": events_limit,
+            "limittononsuspendedevents": True,
+        }),
+    ]
+
+
+def get_enrolled_courses(client, classification="inprogress", events_limit=20):
+    """
+    Fetches the courses the user is enrolled in, with their upcoming
+    activity deadlines, in a single batched AJAX request.
+
+    Args:
+        client: services.ajax.AjaxClient of the user session
+        classification: Moodle timeline classification (e.g. 'inprogress', 'all')
+        events_limit: Maximum number of upcoming events fetched
+
+    Returns:
+        list: Course dicts with name, url, id, shortname, category, progress
+              and upcoming_events
+    """
+    courses, events = client.batch(_enrolled_calls(classification, events_limit))
+    return _enrolled_courses(courses, events)
+
+
+async def aget_enrolled_courses(client, classification="inprogress", events_limit=20):
+    """
+    Async counterpart of get_enrolled_courses(), with an AsyncAjaxClient.
+    """
+    courses, events = await client.batch(_enrolled_calls(classification, events_limit))
+    return _enrolled_courses(courses, events)
+
+
+def _enrolled_courses(courses, events):
+    if isinstance(courses, AjaxError):
+        raise courses
+    if isinstance(events, AjaxError):
+        # The calendar may be disabled, the courses are still useful
+        logger.warning(f"Could not fetch upcoming events: {events}")
+        events = {}
+
+    upcoming = {}
+    for event in events.get("events", []):
+        course_id = str((event.get("course") or {}).get("id", ""))
+        upcoming.setdefault(course_id, []).append({
+            "name": event.get("name"),
+            "timesort": event.get("timesort"),
+            "url": event.get("url"),
+        })
+
+    return [
+        {
+            "name": course.get("fullname"),
+            "url": course.get("viewurl"),
+            "id": str(course.get("id")),
+            "shortname": course.get("shortname"),
+            "category": course.get("coursecategory"),
+            "progress": course.get("progress"),
+            "upcoming_events": upcoming.get(str(course.get("id")), []),
+        }
+        for course in courses.get("courses", [])
+    ]
+
+
+@PARSE_SECONDS.timed(parser="courses")
+def parse_courses(html):
+    """
+    Parses the course boxes of a course/index.php?categoryid= page.
+
+    Returns:
+        list: Course dicts with name, url and id
+    """
+    soup = make_soup(html)
     
     # Find course items in this category
     courses_data = []
     
-    # Print the title of the page to verify we're on the right page
-    page_title = soup.find("title")
+    # Log the title of the page to verify we're on the right page
+    page_title = soup.select_one("title")
     if page_title:
-        print(f"Page title: {page_title.text}")
+        logger.debug(f"Page title: {page_title.text}")
     
     # Check if we're logged in by looking for user-specific elements
-    user_menu = soup.find("div", {"class": "usermenu"})
+    user_menu = soup.select_one("div.usermenu")
     if user_menu:
-        print("User appears to be logged in")
+        logger.debug("User appears to be logged in")
     else:
-        print("WARNING: User might not be logged in")
+        logger.debug("User might not be logged in")
     
     # Try different selectors to find course boxes
-    course_boxes = soup.find_all("div", {"class": "coursebox"})
-    print(f"Found {len(course_boxes)} course boxes with class 'coursebox'")
+    course_boxes = soup.select("div.coursebox")
+    logger.debug(f"Found {len(course_boxes)} course boxes with class 'coursebox'")
     
     if len(course_boxes) == 0:
         # Try alternative selectors
-        course_boxes = soup.find_all("div", {"class": "course-info-container"})
-        print(f"Found {len(course_boxes)} course boxes with class 'course-info-container'")
+        course_boxes = soup.select("div.course-info-container")
+        logger.debug(f"Found {len(course_boxes)} course boxes with class 'course-info-container'")
         
         if len(course_boxes) == 0:
             # Try another alternative
-            course_boxes = soup.find_all("div", {"class": "card"})
-            print(f"Found {len(course_boxes)} potential course boxes with class 'card'")
+            course_boxes = soup.select("div.card")
+            logger.debug(f"Found {len(course_boxes)} potential course boxes with class 'card'")
     
     for i, box in enumerate(course_boxes):
-        print(f"Processing course box {i+1}")
         course_data = {}
         
         # Try different selectors for course name
-        course_name_div = box.find("div", {"class": "coursename"})
+        course_name_div = box.select_one("div.coursename")
         if not course_name_div:
-            course_name_div = box.find("div", {"class": "course-name"})
+            course_name_div = box.select_one("div.course-name")
         if not course_name_div:
-            course_name_div = box.find("h3", {"class": "coursename"})
+            course_name_div = box.select_one("h3.coursename")
         
         if course_name_div:
-            print(f"Found course name div: {course_name_div.text.strip()}")
             course_link = course_name_div.find("a")
             if course_link:
                 course_data["name"] = course_link.text.strip()
                 course_data["url"] = course_link.get("href")
-                print(f"Course name: {course_data['name']}")
-                print(f"Course URL: {course_data['url']}")
                 
                 # Extract course ID from URL
                 course_id_match = re.search(r"id=(\d+)", course_link.get("href"))
                 if course_id_match:
                     course_data["id"] = course_id_match.group(1)
-                    print(f"Course ID: {course_data['id']}")
         else:
             # If we can't find the course name div, try to find any link that might be a course
             course_link = box.find("a")
             if course_link and "course/view.php" in course_link.get("href", ""):
                 course_data["name"] = course_link.text.strip()
                 course_data["url"] = course_link.get("href")
-                print(f"Found course link directly: {course_data['name']}")
         
         # Only add courses that have at least a name
         if "name" in course_data:
             courses_data.append(course_data)
         else:
-            print("No course name found in this box, skipping")
-    
-    print(f"Total courses found: {len(courses_data)}")
-    
-    # Convert to JSON
-    courses_json = json.dumps(courses_data, indent=4, ensure_ascii=False)
-    
-    # Save to file
-    with open(f"courses_category_{id}.json", "w", encoding="utf-8") as f:
-        f.write(courses_json)
+            logger.debug(f"No course name found in course box {i + 1}, skipping")
     
+    logger.debug(f"Total courses found: {len(courses_data)}")
+
     return courses_data
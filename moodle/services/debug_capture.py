@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Captures waiting to be written; further captures are dropped while it is full
+QUEUE_SIZE = 100
+
+_directory = None
+_sample_rate = 0.0
+_max_files = 0
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def configure(directory=None, sample_rate=0.0, max_files=200):
+    """
+    Enables debug capture of the fetched pages and parsed data.
+
+    Args:
+        directory: Where captures are written; None disables capture
+        sample_rate: Fraction of the captures that are kept (0 to 1)
+        max_files: Number of captures kept, the oldest are deleted first
+    """
+    global _directory, _sample_rate, _max_files
+    _directory = str(directory) if directory else None
+    _sample_rate = sample_rate
+    _max_files = max_files
+
+
+def enabled():
+    return _directory is not None and _sample_rate > 0
+
+
+def capture(name, content):
+    """
+    Queues `content` (a page as str, or JSON serializable data) for writing
+    to the capture directory, if capture is enabled and the sample is kept.
+    Never blocks: the file is written by a background thread.
+    """
+    if not enabled() or random.random() >= _sample_rate:
+        return
+    _ensure_writer()
+    try:
+        _queue.put_nowait((time.time(), name, content))
+    except queue.Full:
+        logger.debug(f"Debug capture queue full, dropping {name}")
+
+
+def _ensure_writer():
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_loop, name="debug-capture", daemon=True)
+            _writer.start()
+
+
+def _write_loop():
+    while True:
+        captured_at, name, content = _queue.get()
+        try:
+            _write(captured_at, name, content)
+            _prune()
+        except Exception as e:
+            logger.warning(f"Could not write debug capture {name}: {e}")
+
+
+def _write(captured_at, name, content):
+    os.makedirs(_directory, exist_ok=True)
+    if isinstance(content, str):
+        extension, text = "html", content
+    else:
+        extension, text = "json", json.dumps(content, indent=4, ensure_ascii=False)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(captured_at))
+    safe_name = re.sub(r"[^\w.-]", "_", name)
+    path = os.path.join(_directory, f"{stamp}-{safe_name}-{uuid.uuid4().hex[:8]}.{extension}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _prune():
+    """
+    Deletes the oldest captures beyond max_files.
+    """
+    files = sorted(
+        (entry for entry in os.scandir(_directory) if entry.is_file()),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in files[:max(len(files) - _max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
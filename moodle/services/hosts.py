@@ -0,0 +1,38 @@
+import re
+from urllib.parse import urlparse
+
+from .tenants import base_url_template, get_tenant, tenant_for_url
+
+
+def moodle_url(university_name, path=""):
+    """
+    Builds an absolute URL on the Moodle of a university.
+
+    Args:
+        university_name: The university (tenant) name (e.g. 'bba')
+        path: Path (and query string) starting with '/'
+
+    Returns:
+        str: The absolute URL
+
+    Raises:
+        tenants.UnknownTenant: If the university is not configured
+    """
+    return get_tenant(university_name).base_url + path
+
+
+def university_from_url(url):
+    """
+    Returns the university of a Moodle URL: the configured tenant serving
+    it, else the subdomain matched by the base URL template, else its host
+    (e.g. benchmarks, whose template has no {university} placeholder).
+    """
+    tenant = tenant_for_url(url)
+    if tenant is not None:
+        return tenant.name
+    prefix, placeholder, suffix = base_url_template().partition("{university}")
+    if placeholder:
+        match = re.match(re.escape(prefix) + r"([^./:]+)" + re.escape(suffix), url)
+        if match:
+            return match.group(1)
+    return urlparse(url).netloc
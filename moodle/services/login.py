@@ -1,19 +1,52 @@
 
 import requests, json
-from bs4 import BeautifulSoup
+import logging
+
+from . import debug_capture
+from .async_http import AsyncMoodleSession
+from .hosts import moodle_url
+from .metrics import LOGINS, PARSE_SECONDS, instrument
+from .parsing import make_soup, only
+from .upstream import guarded
+
+logger = logging.getLogger(__name__)
+
+# Authenticated page probed to check a session; Moodle redirects to the
+# login page once the session expired
+PROBE_PATH = "/user/preferences.php"
+
+
+@PARSE_SECONDS.timed(parser="login_token")
+def parse_login_token(html):
+    """
+    Returns the logintoken hidden input value of the login form.
+    """
+    soup = make_soup(html, parse_only=only("input", {"name": "logintoken"}))
+    return soup.select_one('input[name="logintoken"]')["value"]
+
+
+def _login_result(status_code, text, cookies):
+    if status_code != 200 or "La connexion a échoué, veuillez réessayer" in text:
+        return "Login failed"
+    if "Utilisateurs en ligne" in text:
+        return json.dumps(cookies)
+    return None
+
+
+def _count_login(university_name, result):
+    outcome = {"Login failed": "failed", None: "unknown"}.get(result, "success")
+    LOGINS.inc(university=university_name, result=outcome)
 
 
 def login(username, password, university_name):
 
 
-    login_url = f"https://elearning.univ-{university_name}.dz/login/index.php"
+    login_url = moodle_url(university_name, "/login/index.php")
 
-    session = requests.Session()
+    session = guarded(instrument(requests.Session()))
     response = session.get(login_url)
-    soup = BeautifulSoup(response.text, "html.parser")
-    login_token = soup.find("input", {"name": "logintoken"})["value"]
-    with open("login.html", "w", encoding="utf-8") as f:
-        f.write(response.text)
+    login_token = parse_login_token(response.text)
+    debug_capture.capture("login", response.text)
     login_data = {
         "username": username,
         "password": password,
@@ -21,15 +54,57 @@ def login(username, password, university_name):
     }
 
     response = session.post(login_url, data=login_data)
-    if response.status_code != 200 or "La connexion a échoué, veuillez réessayer" in response.text:
-        return "Login failed"
-        #raise Exception("[-] Login failed")
-    if "Utilisateurs en ligne" in response.text:
-        print("[+] Login successful")
-        cookies_dict = session.cookies.get_dict()
-        cookies_json = json.dumps(cookies_dict)
-        return cookies_json
-    return None
+    result = _login_result(response.status_code, response.text, session.cookies.get_dict())
+    if result not in ("Login failed", None):
+        logger.info("Login successful")
+    _count_login(university_name, result)
+    return result
 
 
+def probe_session(session, university_name, timeout=10):
+    """
+    Checks that a Moodle session is still logged in, with a HEAD request on an
+    authenticated page: no page is transferred. The probe also counts as
+    activity for Moodle's session timeout.
+
+    Args:
+        session: The requests session with the Moodle cookies
+        university_name: The university subdomain (e.g. 'bba')
+
+    Returns:
+        bool: True if the session is logged in
+    """
+    response = session.head(moodle_url(university_name, PROBE_PATH), allow_redirects=False, timeout=timeout)
+    return response.status_code == 200
+
+
+async def aprobe_session(session, university_name):
+    """
+    Async counterpart of probe_session(), with an AsyncMoodleSession.
+    """
+    response = await session.send("HEAD", moodle_url(university_name, PROBE_PATH), follow_redirects=False)
+    return response.status_code == 200
+
+
+async def alogin(username, password, university_name):
+    """
+    Async counterpart of login(), over the shared async connection pool.
+
+    Returns:
+        str: The session cookies as JSON, "Login failed", or None
+    """
+    login_url = moodle_url(university_name, "/login/index.php")
+
+    session = AsyncMoodleSession()
+    response = await session.get(login_url)
+    debug_capture.capture("login", response.text)
+    login_data = {
+        "username": username,
+        "password": password,
+        "logintoken": parse_login_token(response.text),
+    }
 
+    response = await session.post(login_url, data=login_data)
+    result = _login_result(response.status_code, response.text, session.cookies)
+    _count_login(university_name, result)
+    return result
@@ -0,0 +1,248 @@
+import functools
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from .hosts import university_from_url
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return "\n".join(lines)
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Value sampled when the metrics are rendered, e.g. a pool size.
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+                    break
+            state["sum"] += value
+
+    def timed(self, **labels):
+        """
+        Decorator observing the duration of each call of the function.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def _samples(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            le = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {state['sum']!r}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    """
+    Returns all the metrics of this process in the Prometheus text format.
+    """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+UPSTREAM_SECONDS = Histogram(
+    "moodle_upstream_request_seconds",
+    "Time until Moodle answered (response headers), per university and URL pattern",
+    ("university", "method", "pattern", "status"),
+)
+PARSE_SECONDS = Histogram(
+    "moodle_parse_seconds",
+    "Time spent parsing Moodle pages, per parser",
+    ("parser",),
+)
+REQUEST_SECONDS = Histogram(
+    "api_request_seconds",
+    "Time spent handling API requests, per endpoint and university",
+    ("endpoint", "university", "method", "status"),
+)
+DB_SECONDS = Histogram(
+    "api_db_seconds",
+    "Time spent in database queries per API request",
+    ("endpoint",),
+)
+RENDER_SECONDS = Histogram(
+    "api_render_seconds",
+    "Time spent serializing API responses",
+    ("endpoint",),
+)
+CACHE_REQUESTS = Counter(
+    "api_cache_requests_total",
+    "Catalog and resource cache lookups, by result (hit, stale, miss, fallback)",
+    ("cache", "kind", "result"),
+)
+LOGINS = Counter(
+    "moodle_logins_total",
+    "Moodle logins, by result (success, failed, unknown)",
+    ("university", "result"),
+)
+RETRIES = Counter(
+    "moodle_retries_total",
+    "Moodle requests repeated or re-routed, by reason",
+    ("reason",),
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "moodle_upstream_in_flight",
+    "Requests of this process waiting on Moodle, per university",
+    ("university",),
+)
+UPSTREAM_REJECTED = Counter(
+    "moodle_upstream_rejected_total",
+    "Requests not sent to Moodle, by reason (busy, rate_limited, circuit_open)",
+    ("university", "reason"),
+)
+CIRCUIT_STATE = Gauge(
+    "moodle_circuit_state",
+    "Circuit breaker of each Moodle in this process (0 closed, 1 open, 2 half-open)",
+    ("university",),
+)
+SESSION_POOL = Gauge(
+    "moodle_session_pool",
+    "Pooled requests sessions of this process (size and counters)",
+    ("stat",),
+)
+NOTIFICATION_POLLS = Gauge(
+    "notification_polls",
+    "Notification polling of the active sessions (counts, latency and lag in seconds)",
+    ("stat",),
+)
+
+
+def url_pattern(url):
+    """
+    Reduces a Moodle URL to a low-cardinality label: the script path with
+    ids replaced, plus the AJAX/web service function names.
+    """
+    parsed = urlparse(url)
+    path = parsed.path
+    if "/pluginfile.php" in path:
+        return path[:path.index("/pluginfile.php") + len("/pluginfile.php")]
+    pattern = re.sub(r"/\d+(?=/|$)", "/{id}", path) or "/"
+    query = parse_qs(parsed.query)
+    if "info" in query:
+        pattern += f"?info={query['info'][0]}"
+    elif "wsfunction" in query:
+        pattern += f"?wsfunction={query['wsfunction'][0]}"
+    return pattern
+
+
+def observe_upstream(method, url, status, seconds):
+    UPSTREAM_SECONDS.observe(
+        seconds,
+        university=university_from_url(url),
+        method=method,
+        pattern=url_pattern(url),
+        status=status,
+    )
+
+
+def _record_response(response, *args, **kwargs):
+    observe_upstream(
+        response.request.method, response.request.url, response.status_code, response.elapsed.total_seconds()
+    )
+
+
+def instrument(session):
+    """
+    Records the latency of every request sent by a requests session,
+    redirects included.
+    """
+    if _record_response not in session.hooks["response"]:
+        session.hooks["response"].append(_record_response)
+    return session
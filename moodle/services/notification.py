@@ -1,103 +1,192 @@
-import json
-import re
 import requests
 import logging
 
+from .ajax import AjaxClient, AjaxError
+from .metrics import instrument
+from .upstream import guarded
+
 logger = logging.getLogger(__name__)
 
+# Notifications requested per page of a sync
+DEFAULT_PAGE_SIZE = 20
+# Safety bound on the pages requested by one sync
+DEFAULT_MAX_PAGES = 50
+
 class MoodleTerminator:
-    def __init__(self, session_cookies, university_name):
-        self.session = requests.Session()
+    def __init__(self, session_cookies, university_name, cfg=None):
+        self.session = guarded(instrument(requests.Session()))
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36',
             'Accept-Encoding': 'gzip, deflate, br, zstd',
         })
         self.session.cookies.update(session_cookies)
+        self.university_name = university_name
+        # cfg: sesskey/userId of a previous terminator of the same session
+        self.ajax = AjaxClient(self.session, university_name, cfg)
+
+    @property
+    def cfg(self):
+        """
+        The sesskey and userId of the session, to be passed back to the
+        constructor of the next MoodleTerminator of the same session.
+        """
+        return self.ajax.cfg
+
+    @property
+    def user_id(self):
+        return self.ajax.user_id
+
+    def load_cfg(self):
+        self.ajax.load_cfg()
+
+    def get_notifications(self, since=None, page_size=DEFAULT_PAGE_SIZE, max_pages=DEFAULT_MAX_PAGES):
+        """
+        Fetches the notifications newer than a high-water mark.
+
+        Moodle returns the notifications newest first, so pages are requested
+        until one reaches the mark (or is the last one). Without a mark only
+        the first page is fetched. When a whole request only holds new
+        notifications, the next request asks for twice as many pages in one
+        batched AJAX call, so a burst costs a logarithmic number of round-trips.
+
+        Args:
+            since: High-water mark as returned by high_water_mark(), or None
+            page_size: Notifications requested per page
+            max_pages: Upper bound on the pages requested by one sync
+
+        Returns:
+            list: The new notifications, newest first
+        """
+        page_limit = max_pages if since else 1
+        notifications = []
+        page = 0
+        pages_per_request = 1
+        while page < page_limit:
+            count = min(pages_per_request, page_limit - page)
+            results = self.ajax.batch([
+                _page_call(self.user_id, page_size, (page + i) * page_size) for i in range(count)
+            ])
+            page += count
+            pages_per_request *= 2
+            if _collect_pages(results, since, page_size, notifications):
+                break
+        else:
+            if since:
+                logger.warning(f"Stopped notification sync after {max_pages} pages")
+
+        logger.info(f"Found {len(notifications)} new notifications")
+        return notifications
+
+
+async def aget_notifications(client, since=None, page_size=DEFAULT_PAGE_SIZE, max_pages=DEFAULT_MAX_PAGES):
+    """
+    Async counterpart of MoodleTerminator.get_notifications(), with an
+    AsyncAjaxClient.
+
+    Returns:
+        list: The new notifications, newest first
+    """
+    await client.ensure_cfg()
+    page_limit = max_pages if since else 1
+    notifications = []
+    page = 0
+    pages_per_request = 1
+    while page < page_limit:
+        count = min(pages_per_request, page_limit - page)
+        results = await client.batch([
+            _page_call(client.user_id, page_size, (page + i) * page_size) for i in range(count)
+        ])
+        page += count
+        pages_per_request *= 2
+        if _collect_pages(results, since, page_size, notifications):
+            break
+    else:
+        if since:
+            logger.warning(f"Stopped notification sync after {max_pages} pages")
+
+    logger.info(f"Found {len(notifications)} new notifications")
+    return notifications
+
+
+def _page_call(user_id, limit, offset):
+    return ("message_popup_get_popup_notifications", {
+        "useridto": user_id,
+        "limit":    limit,
+        "offset":   offset
+    })
+
+
+def _collect_pages(results, since, page_size, notifications):
+    """
+    Appends the notifications newer than `since` of the pages of one request
+    to `notifications`.
+
+    Returns:
+        bool: True once a page reached the mark or was the last one
+    """
+    for result in results:
+        if isinstance(result, AjaxError):
+            raise result
+        # Get the notifications from the response
+        if isinstance(result, dict) and 'notifications' in result:
+            batch = result.get('notifications', [])
+        else:
+            # Otherwise, use the data as is (assuming it's a list of notifications)
+            batch = result or []
+        new = [notif for notif in batch if not isinstance(notif, dict) or _notification_key(notif) > _mark_key(since)]
+        notifications.extend(new)
+        if len(new) < len(batch) or len(batch) < page_size:
+            return True
+    return False
+
+
+def _notification_key(notif):
+    try:
+        return (int(notif.get('timecreated') or 0), int(notif.get('id') or 0))
+    except (TypeError, ValueError):
+        return (0, 0)
+
+
+def _mark_key(mark):
+    if not mark:
+        return (-1, -1)
+    return (mark['timecreated'], mark['id'])
+
+
+def high_water_mark(notifications, since=None):
+    """
+    Returns the high-water mark after a sync, i.e. the newest notification
+    seen so far.
+
+    Args:
+        notifications: The notifications returned by the sync
+        since: The previous high-water mark, or None
+
+    Returns:
+        dict: {"timecreated": ..., "id": ...}, or None if nothing was seen
+    """
+    keys = [_notification_key(notif) for notif in notifications if isinstance(notif, dict)]
+    key = max(keys + [_mark_key(since)])
+    if key == (-1, -1):
+        return None
+    return {'timecreated': key[0], 'id': key[1]}
+
 
-    def _extract_cfg(self, html):
-        # Fix: Adjust regex to match unescaped JS variable
-        match = re.search(r'M\.cfg\s*=\s*({.*?});', html, re.DOTALL)
-        if not match:
-            raise ValueError("M.cfg block not found")
-        return json.loads(match.group(1))
-
-    def get_notifications(self):
-        # Step 1: Load the main page to retrieve sesskey and userId
-        resp = self.session.get(
-            f'https://elearning.univ-{university_name}.dz/',
-            headers={'Referer': 'https://google.com'}
-        )
-        resp.raise_for_status()
-
-        # Step 2: Extract M.cfg JSON
-        cfg = self._extract_cfg(resp.text)
-        sesskey = cfg.get('sesskey')
-        userid  = cfg.get('userId')
-        if not sesskey or not userid:
-            raise RuntimeError(f"Failed to extract sesskey/userId from M.cfg: {cfg}")
-
-        # Step 3: Build the AJAX payload with correct parameters
-        payload = [{
-            "index":      0,
-            "methodname": "message_popup_get_popup_notifications",
-            "args": {
-                "useridto": userid,
-                "limit":    20,
-                "offset":   0
-            }
-        }]
-
-        # Step 4: Call the AJAX service
-        api_url = "https://elearning.univ-bba.dz/lib/ajax/service.php"
-        params = {
-            'sesskey': sesskey,
-            'info': 'message_popup_get_popup_notifications'
-        }
-        r2 = self.session.post(
-            api_url,
-            params=params,
-            json=payload,
-            headers={
-                'X-Requested-With': 'XMLHttpRequest',
-                'Content-Type':      'application/json',
-                'Origin':            'https://elearning.univ-bba.dz'
-            }
-        )
-        r2.raise_for_status()
-
-        # Step 5: Parse and return the notifications
-        data = r2.json()
-        if not isinstance(data, list) or not data:
-            raise RuntimeError(f"Unexpected response format: {data}")
-        first = data[0]
-        if first.get('exception') or first.get('error'):
-            raise RuntimeError(f"Moodle API Error: {first}")
-
-        # Get the data from the response
-        response_data = first.get('data', [])
-
-        # Check if the data is a dictionary with 'notifications' key
-        if isinstance(response_data, dict) and 'notifications' in response_data:
-            logger.info(f"Found notifications in response: {len(response_data.get('notifications', []))}")
-            return response_data.get('notifications', [])
-
-        # Otherwise, return the data as is (assuming it's a list of notifications)
-        return response_data
-
-
-def get_notifications(session_cookies):
+def get_notifications(session_cookies, university_name, since=None):
     """
     Helper function to get notifications using the MoodleTerminator class.
 
     Args:
         session_cookies (dict): Dictionary containing session cookies
+        university_name (str): The university subdomain (e.g. 'bba')
+        since (dict): Only return notifications newer than this high-water mark
 
     Returns:
         list: List of notification objects
     """
     try:
-        terminator = MoodleTerminator(session_cookies)
-        return terminator.get_notifications()
+        terminator = MoodleTerminator(session_cookies, university_name)
+        return terminator.get_notifications(since=since)
     except Exception as e:
         logger.error(f"Error fetching notifications: {e}")
         raise
@@ -110,7 +199,7 @@ if __name__ == "__main__":
     }
 
     try:
-        notifs = get_notifications(session_cookies)
+        notifs = get_notifications(session_cookies, 'bba')
         print(f"Captured {len(notifs)} notifications:")
         print(notifs)
     except Exception as e:
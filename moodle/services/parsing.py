@@ -0,0 +1,88 @@
+import os
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+# Tree builders in order of preference, the first installed one is used
+PARSER_BACKENDS = ("lxml", "html.parser")
+
+
+def _available(backend):
+    if backend == "lxml":
+        try:
+            import lxml  # noqa: F401
+        except ImportError:
+            return False
+    return True
+
+
+def _default_backend():
+    # MOODLE_HTML_PARSER forces a backend, e.g. to compare them in benchmarks
+    forced = os.environ.get("MOODLE_HTML_PARSER")
+    if forced:
+        return forced
+    for backend in PARSER_BACKENDS:
+        if _available(backend):
+            return backend
+    return "html.parser"
+
+
+_backend = _default_backend()
+
+
+def get_parser_backend():
+    return _backend
+
+
+def set_parser_backend(backend):
+    """
+    Selects the tree builder used by all scrapers.
+
+    Args:
+        backend: 'lxml' or 'html.parser'; 'lxml' falls back to 'html.parser'
+                 when lxml is not installed
+    """
+    global _backend
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend: {backend}")
+    _backend = backend if _available(backend) else "html.parser"
+
+
+def make_soup(html, parse_only=None, backend=None):
+    """
+    Parses an HTML page with the selected backend.
+
+    Args:
+        html: The page content
+        parse_only: Optional SoupStrainer restricting the tree to the matching
+                    elements, which skips building the rest of a large page
+        backend: Overrides the selected backend for this call
+
+    Returns:
+        BeautifulSoup: The parsed document, queryable with find()/select()
+    """
+    return BeautifulSoup(html, backend or _backend, parse_only=parse_only)
+
+
+def only(*args, **kwargs):
+    """
+    Shortcut for a SoupStrainer, e.g. only("select", {"name": "jump"}) or
+    only("div", {"class": has_class("coursebox")}).
+    """
+    return SoupStrainer(*args, **kwargs)
+
+
+def has_class(*names):
+    """
+    Returns a strainer attribute matcher accepting elements that carry any of
+    the CSS classes `names`. Strainers see the raw class attribute while the
+    page is being parsed, so plain strings would only match exact values.
+    """
+    wanted = set(names)
+
+    def match(value):
+        if not value:
+            return False
+        values = value.split() if isinstance(value, str) else value
+        return not wanted.isdisjoint(values)
+
+    return match
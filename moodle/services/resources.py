@@ -1,48 +1,134 @@
-import requests
-from bs4 import BeautifulSoup
+from .hosts import moodle_url
+from .metrics import PARSE_SECONDS
+from .parsing import has_class, make_soup, only
 
-def get_resource(session, resource_id, university_name):
+# Request headers forwarded from the client to the Moodle file request
+FORWARDED_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+
+
+def _is_file_response(response):
+    content_type = response.headers.get('Content-Type', '')
+    return str(response.url).endswith('.pdf') or not content_type.startswith('text/html')
+
+
+def _file_headers(headers):
+    file_headers = {'Accept-Encoding': 'identity'}
+    for name in FORWARDED_HEADERS:
+        if headers and headers.get(name):
+            file_headers[name] = headers[name]
+    return file_headers
+
+
+def _filename(file_response, resource_id):
+    content_disposition = file_response.headers.get('Content-Disposition', '')
+    filename = f"resource_{resource_id}"
+    if 'filename=' in content_disposition:
+        try:
+            filename = content_disposition.split('filename=')[1].strip('"\'')
+        except:
+            pass
+    return filename
+
+
+@PARSE_SECONDS.timed(parser="resource_link")
+def parse_resource_link(html):
+    """
+    Returns the file URL of a resource page, or None if there is no link.
     """
-    Fetches a resource (like PDF) from Moodle
-    
+    soup = make_soup(html, parse_only=only("a", {"class": has_class("resourcelinkdetails")}))
+    resource_link = soup.select_one("a.resourcelinkdetails")
+    if resource_link and resource_link.get("href"):
+        return resource_link.get("href")
+    return None
+
+
+def get_resource(session, resource_id, university_name, headers=None):
+    """
+    Opens a streamed download of a resource (like PDF) from Moodle
+
+    The body is not read: the caller must iterate and close `response`
+    (e.g. with `response.iter_content()`), so that memory use does not depend
+    on the file size.
+
     Args:
         session: The requests session with authentication cookies
         resource_id: The ID of the resource to fetch
-        
+        university_name: The university subdomain (e.g. 'bba')
+        headers: Client request headers; Range and conditional headers in
+                 FORWARDED_HEADERS are passed on to Moodle
+
     Returns:
-        dict: Contains content, content_type, and filename if successful
-              or error message if failed
+        dict: Contains the open upstream response, content_type, and filename
+              if successful or error message if failed
     """
-   
-    url = f"https://elearning.univ-{university_name}.dz/mod/resource/view.php?id={resource_id}"
+    file_headers = _file_headers(headers)
+
+    url = moodle_url(university_name, f"/mod/resource/view.php?id={resource_id}")
     response = session.get(url, stream=True, allow_redirects=True)
-    
-    if response.url.endswith('.pdf'):
+
+    if _is_file_response(response):
+        # view.php redirected straight to the file
+        file_response = response
+        if len(file_headers) > 1:
+            # Ranges only apply to the file itself, not to view.php
+            response.close()
+            file_response = session.get(response.url, headers=file_headers, stream=True)
         return {
-            'content': response.content,
-            'content_type': 'application/pdf',
+            'response': file_response,
+            'content_type': file_response.headers.get('Content-Type', 'application/pdf'),
             'filename': f"resource_{resource_id}.pdf"
         }
-    
-    soup = BeautifulSoup(response.text, "html.parser")
-    resource_link = soup.find("a", {"class": "resourcelinkdetails"})
-    
-    if resource_link and resource_link.get("href"):
-        file_url = resource_link.get("href")
-        file_response = session.get(file_url, stream=True)
-        
-        content_disposition = file_response.headers.get('Content-Disposition', '')
-        filename = f"resource_{resource_id}"
-        if 'filename=' in content_disposition:
-            try:
-                filename = content_disposition.split('filename=')[1].strip('"\'')
-            except:
-                pass
-        
+
+    file_url = parse_resource_link(response.text)
+
+    if file_url:
+        file_response = session.get(file_url, headers=file_headers, stream=True)
+        return {
+            'response': file_response,
+            'content_type': file_response.headers.get('Content-Type', 'application/pdf'),
+            'filename': _filename(file_response, resource_id)
+        }
+
+    return {'error': 'Could not retrieve the resource'}
+
+
+async def aget_resource(session, resource_id, university_name, headers=None):
+    """
+    Async counterpart of get_resource(), with an AsyncMoodleSession.
+
+    Returns:
+        dict: Contains the open upstream httpx response (read it with
+              `aiter_bytes()`, then `await response.aclose()`), content_type
+              and filename if successful or error message if failed
+    """
+    file_headers = _file_headers(headers)
+
+    url = moodle_url(university_name, f"/mod/resource/view.php?id={resource_id}")
+    response = await session.get(url, stream=True)
+
+    if _is_file_response(response):
+        # view.php redirected straight to the file
+        file_response = response
+        if len(file_headers) > 1:
+            # Ranges only apply to the file itself, not to view.php
+            await response.aclose()
+            file_response = await session.get(str(response.url), headers=file_headers, stream=True)
+        return {
+            'response': file_response,
+            'content_type': file_response.headers.get('Content-Type', 'application/pdf'),
+            'filename': f"resource_{resource_id}.pdf"
+        }
+
+    await response.aread()
+    await response.aclose()
+    file_url = parse_resource_link(response.text)
+
+    if file_url:
+        file_response = await session.get(file_url, headers=file_headers, stream=True)
         return {
-            'content': file_response.content,
+            'response': file_response,
             'content_type': file_response.headers.get('Content-Type', 'application/pdf'),
-            'filename': filename
+            'filename': _filename(file_response, resource_id)
         }
-    
-    return {'error': 'Could not retrieve the resource'}
\ No newline at end of file
+
+    return {'error': 'Could not retrieve the resource'}
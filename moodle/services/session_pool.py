@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from .upstream import GuardedAdapter
+from .metrics import instrument
+
+
+class _PooledSession:
+    def __init__(self, session, cookie_json):
+        self.session = session
+        self.cookie_json = cookie_json
+        self.last_used = time.monotonic()
+
+
+class SessionPool:
+    """
+    Keeps authenticated requests sessions alive between API calls.
+
+    Sessions are keyed by the API session token, so consecutive calls made with
+    the same token reuse the keep-alive connections to Moodle instead of paying
+    a new TCP+TLS handshake. The pool is bounded by the number of sessions and
+    by the total number of pooled connections; the least recently used session
+    is evicted first, and sessions idle for longer than `idle_timeout` seconds
+    are dropped.
+    """
+
+    def __init__(self, max_sessions=200, idle_timeout=900, pool_connections=2,
+                 pool_maxsize=4, max_total_connections=400):
+        """
+        Args:
+            max_sessions: Maximum number of sessions kept in the pool
+            idle_timeout: Seconds after which an unused session is evicted
+            pool_connections: Number of per-host connection pools per session
+            pool_maxsize: Maximum connections kept alive per host pool
+            max_total_connections: Upper bound of pooled connections across
+                                   all sessions of this worker
+        """
+        self.max_sessions = max(1, min(max_sessions, max_total_connections // pool_maxsize))
+        self.idle_timeout = idle_timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = GuardedAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return instrument(session)
+
+    def get(self, token, cookie_json=None):
+        """
+        Returns the pooled session for `token`, creating it on a miss.
+
+        Args:
+            token: The API session token
+            cookie_json: JSON string of the Moodle cookies for this token
+
+        Returns:
+            requests.Session: A session carrying the token's cookies
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            self._evict_idle(now, expired)
+            entry = self._sessions.get(token)
+            if entry is not None:
+                self.hits += 1
+                self._sessions.move_to_end(token)
+                if cookie_json != entry.cookie_json:
+                    # The cookies were renewed (e.g. a fresh login), refresh them in place
+                    entry.session.cookies.clear()
+                    if cookie_json:
+                        entry.session.cookies.update(json.loads(cookie_json))
+                    entry.cookie_json = cookie_json
+            else:
+                self.misses += 1
+                session = self._new_session()
+                if cookie_json:
+                    session.cookies.update(json.loads(cookie_json))
+                entry = _PooledSession(session, cookie_json)
+                self._sessions[token] = entry
+                while len(self._sessions) > self.max_sessions:
+                    _, lru = self._sessions.popitem(last=False)
+                    expired.append(lru)
+                    self.evictions += 1
+            entry.last_used = now
+        self._close(expired)
+        return entry.session
+
+    def evict(self, token):
+        """
+        Drops the session of `token`, e.g. once the token has expired.
+        """
+        with self._lock:
+            entry = self._sessions.pop(token, None)
+            if entry is not None:
+                self.evictions += 1
+        if entry is not None:
+            self._close([entry])
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._sessions.values())
+            self._sessions.clear()
+        self._close(entries)
+
+    def stats(self):
+        """
+        Returns the pool counters as a dict.
+        """
+        with self._lock:
+            return {
+                "size": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict_idle(self, now, expired):
+        # Sessions are ordered by last use, so the idle ones are at the front
+        while self._sessions:
+            token, entry = next(iter(self._sessions.items()))
+            if now - entry.last_used < self.idle_timeout:
+                break
+            del self._sessions[token]
+            expired.append(entry)
+            self.evictions += 1
+
+    @staticmethod
+    def _close(entries):
+        for entry in entries:
+            entry.session.close()
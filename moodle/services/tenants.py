@@ -0,0 +1,158 @@
+import os
+from urllib.parse import urlparse
+
+# Base URL of a university's Moodle when its tenant does not set one.
+# MOODLE_BASE_URL_TEMPLATE overrides it, e.g. to point the services at the
+# local benchmark server.
+DEFAULT_BASE_URL_TEMPLATE = "https://elearning.univ-{university}.dz"
+
+# Requests waiting on one Moodle at the same time, per worker process
+DEFAULT_MAX_CONCURRENCY = 64
+# Seconds a request waits for a free slot (or rate limit token) before
+# giving up on that Moodle
+DEFAULT_QUEUE_TIMEOUT = 10
+# Seconds to connect to Moodle and to wait between two bytes of its answer
+DEFAULT_TIMEOUT = (5, 30)
+# Requests per second sent to one Moodle by the whole deployment, and the
+# burst allowed above that rate
+DEFAULT_RATE_LIMIT = 50
+# Circuit breaker: once DEFAULT_MIN_CALLS requests were seen in its window,
+# the breaker opens when this fraction of them failed or took longer than
+# DEFAULT_SLOW_CALL_SECONDS, and stays open DEFAULT_OPEN_SECONDS
+DEFAULT_FAILURE_RATIO = 0.5
+DEFAULT_MIN_CALLS = 10
+DEFAULT_SLOW_CALL_SECONDS = 10
+DEFAULT_OPEN_SECONDS = 30
+
+BACKENDS = ("scraper", "webservice")
+
+_tenants = {}
+_default = None
+
+
+class UnknownTenant(LookupError):
+    """
+    Raised for a university that is not served by this deployment.
+    """
+
+
+def base_url_template():
+    return os.environ.get("MOODLE_BASE_URL_TEMPLATE", DEFAULT_BASE_URL_TEMPLATE)
+
+
+class Tenant:
+    """
+    A university served by this deployment: where its Moodle is, how its
+    catalog is fetched and how much load it may take from us.
+    """
+
+    def __init__(self, name, base_url=None, backend=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, max_connections=None, timeout=DEFAULT_TIMEOUT,
+                 rate_limit=DEFAULT_RATE_LIMIT, rate_burst=None, failure_ratio=DEFAULT_FAILURE_RATIO,
+                 min_calls=DEFAULT_MIN_CALLS, slow_call_seconds=DEFAULT_SLOW_CALL_SECONDS,
+                 open_seconds=DEFAULT_OPEN_SECONDS):
+        """
+        Args:
+            name: The university name used by the API (e.g. 'bba')
+            base_url: Root URL of its Moodle, defaults to the base URL template
+            backend: "scraper" or "webservice", None for the default backend
+            max_concurrency: Requests waiting on this Moodle at the same time,
+                             per worker process
+            queue_timeout: Seconds a request waits for a free slot or a
+                           rate limit token
+            max_connections: Connections of the async pool to this Moodle,
+                             None for the pool default
+            timeout: Default (connect, read) timeout in seconds, or one
+                     number for both
+            rate_limit: Requests per second to this Moodle across all the
+                        workers, None for no limit
+            rate_burst: Requests allowed at once above the rate, defaults to
+                        twice the rate
+            failure_ratio: Share of failed or slow requests opening the
+                           circuit breaker
+            min_calls: Requests seen before the breaker may open
+            slow_call_seconds: Requests slower than this count as failures
+            open_seconds: Seconds the breaker fails fast before letting a
+                          trial request through
+        """
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError(f"Unknown backend for {name}: {backend}")
+        self.name = name
+        self._base_url = base_url.rstrip("/") if base_url else None
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_connections = max_connections
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else (timeout, timeout)
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst or (2 * rate_limit if rate_limit else None)
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+
+    @property
+    def base_url(self):
+        # Read on use, so that the template can be changed at runtime
+        return self._base_url or base_url_template().format(university=self.name)
+
+    @property
+    def host(self):
+        return urlparse(self.base_url).netloc
+
+    def __repr__(self):
+        return f"<Tenant {self.name} {self.base_url}>"
+
+
+def configure(tenants, default=None):
+    """
+    Sets the universities served by this deployment.
+
+    Args:
+        tenants: dict of name -> Tenant keyword arguments
+        default: Name of the tenant used when a request names none, the
+                 first one if None
+    """
+    global _tenants, _default
+    registry = {name: Tenant(name, **(options or {})) for name, options in tenants.items()}
+    if default is not None and default not in registry:
+        raise ValueError(f"The default tenant {default} is not configured")
+    _tenants = registry
+    _default = default or next(iter(registry), None)
+
+
+def get_tenant(name):
+    """
+    Returns the tenant of a university.
+
+    Before configure() is called (e.g. services used on their own), any
+    name is accepted and gets the defaults.
+
+    Raises:
+        UnknownTenant: If the registry is configured and does not list `name`
+    """
+    tenant = _tenants.get(name)
+    if tenant is None:
+        if _tenants:
+            raise UnknownTenant(name)
+        tenant = Tenant(name)
+    return tenant
+
+
+def default_tenant():
+    return _default
+
+
+def is_tenant(name):
+    return name in _tenants if _tenants else bool(name)
+
+
+def tenant_for_url(url):
+    """
+    Returns the configured tenant whose Moodle serves `url`, or None.
+    """
+    host = urlparse(url).netloc
+    for tenant in _tenants.values():
+        if tenant.host == host:
+            return tenant
+    return None
@@ -0,0 +1,414 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import CIRCUIT_STATE, UPSTREAM_IN_FLIGHT, UPSTREAM_REJECTED
+from .tenants import tenant_for_url
+
+logger = logging.getLogger(__name__)
+
+# Errors of a request to Moodle, for the callers that fall back on them
+UPSTREAM_ERRORS = (requests.RequestException, httpx.HTTPError)
+
+# Requests older than this are forgotten by the circuit breakers (seconds)
+WINDOW_SECONDS = 30
+
+# Token bucket shared by all the workers, refilled from the Redis clock.
+# Returns the seconds to wait for the reserved token, or -1 when that would
+# exceed the longest acceptable wait (nothing is reserved then).
+_RESERVE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+    if wait > max_wait then
+        return '-1'
+    end
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+_reserve_script = None
+_key_prefix = "moodle"
+# Redis failures are logged at most once per minute
+_redis_warned_at = 0.0
+
+# Per-process state of each Moodle host: threads share one semaphore per
+# host, coroutines one per host and event loop
+_slots = {}
+_async_slots = weakref.WeakKeyDictionary()
+_breakers = {}
+_buckets = {}
+_state_lock = threading.Lock()
+
+
+class UpstreamUnavailable(requests.ConnectionError):
+    """
+    Raised instead of sending a request to a Moodle that cannot take it now.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class HostBusy(UpstreamUnavailable):
+    """
+    Raised when a Moodle already has its max_concurrency requests of this
+    process waiting on it, and none finished within its queue_timeout.
+    """
+
+
+class RateLimited(UpstreamUnavailable):
+    """
+    Raised when the rate limit of a Moodle has no token for the next
+    queue_timeout seconds.
+    """
+
+
+class CircuitOpen(UpstreamUnavailable):
+    """
+    Raised while the circuit breaker of a failing Moodle is open.
+    """
+
+
+def configure(redis_client=None, key_prefix="moodle"):
+    """
+    Shares the rate limits of all the workers through Redis. Without a
+    client (or while Redis is unreachable), each process applies the rate
+    limits on its own.
+    """
+    global _reserve_script, _key_prefix
+    _reserve_script = redis_client.register_script(_RESERVE_SCRIPT) if redis_client is not None else None
+    _key_prefix = key_prefix
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the requests to one Moodle. Once the share of
+    failed (errors, 5xx, 429) or slow requests in the last WINDOW_SECONDS
+    crosses the tenant's failure_ratio, requests fail fast for open_seconds;
+    then a single trial request decides whether to close it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    _STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.state = self.CLOSED
+        self._calls = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Tells whether a request may be sent now. Every allowed request must
+        be followed by record() or abandon().
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.tenant.open_seconds:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial:
+                    return False
+                self._trial = True
+            return True
+
+    def retry_after(self):
+        return max(self.tenant.open_seconds - (time.monotonic() - self._opened_at), 0)
+
+    def record(self, failed):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+                if failed:
+                    self._open(now)
+                else:
+                    self._calls.clear()
+                    self._failures = 0
+                    self._set_state(self.CLOSED)
+                return
+            if self.state == self.OPEN:
+                # Sent before the breaker opened
+                return
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and now - self._calls[0][0] > WINDOW_SECONDS:
+                _, old_failed = self._calls.popleft()
+                self._failures -= old_failed
+            if len(self._calls) >= self.tenant.min_calls and \
+                    self._failures / len(self._calls) >= self.tenant.failure_ratio:
+                self._open(now)
+
+    def abandon(self):
+        """
+        The allowed request was not sent after all.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+
+    def _open(self, now):
+        logger.warning(f"Circuit breaker of the {self.tenant.name} Moodle opened for {self.tenant.open_seconds}s")
+        self._opened_at = now
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(self._STATE_VALUES[state], university=self.tenant.name)
+
+
+class _LocalBucket:
+    """
+    Token bucket of this process only, used without Redis.
+    """
+
+    def __init__(self, tenant):
+        self.tokens = tenant.rate_burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, rate, burst, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            wait = 0.0
+            if tokens < 1:
+                wait = (1 - tokens) / rate
+                if wait > max_wait:
+                    return None
+            self.tokens = tokens - 1
+            self.updated = now
+            return wait
+
+
+def _state(registry, tenant, factory):
+    key = (tenant.host, tenant.name)
+    state = registry.get(key)
+    if state is None:
+        with _state_lock:
+            state = registry.get(key)
+            if state is None:
+                state = registry[key] = factory(tenant)
+    return state
+
+
+def _reserve(tenant):
+    """
+    Takes a rate limit token of a Moodle host.
+
+    Returns:
+        float: Seconds to wait before sending, or None if the token would
+               come after queue_timeout
+    """
+    if not tenant.rate_limit:
+        return 0.0
+    if _reserve_script is not None:
+        try:
+            wait = float(_reserve_script(
+                keys=[f"{_key_prefix}:upstream_rate:{tenant.host}"],
+                args=[tenant.rate_limit, tenant.rate_burst, tenant.queue_timeout],
+            ))
+            return None if wait < 0 else wait
+        except Exception as e:
+            global _redis_warned_at
+            if time.monotonic() - _redis_warned_at > 60:
+                _redis_warned_at = time.monotonic()
+                logger.warning(f"Shared rate limit unavailable, limiting this process only: {e}")
+    bucket = _state(_buckets, tenant, _LocalBucket)
+    return bucket.reserve(tenant.rate_limit, tenant.rate_burst, tenant.queue_timeout)
+
+
+def _reject(tenant, reason, error):
+    UPSTREAM_REJECTED.inc(university=tenant.name, reason=reason)
+    raise error
+
+
+def _admit(tenant):
+    """
+    Checks the circuit breaker and takes a rate limit token.
+
+    Returns:
+        tuple: (CircuitBreaker, seconds to wait before sending)
+    """
+    breaker = _state(_breakers, tenant, CircuitBreaker)
+    if not breaker.allow():
+        _reject(tenant, "circuit_open", CircuitOpen(
+            f"The {tenant.name} Moodle is failing, not sending requests to it for now",
+            retry_after=breaker.retry_after(),
+        ))
+    try:
+        wait = _reserve(tenant)
+    except BaseException:
+        breaker.abandon()
+        raise
+    if wait is None:
+        breaker.abandon()
+        _reject(tenant, "rate_limited", RateLimited(
+            f"The {tenant.name} Moodle rate limit ({tenant.rate_limit}/s) is exhausted",
+            retry_after=tenant.queue_timeout,
+        ))
+    return breaker, wait
+
+
+def _busy(tenant, breaker):
+    breaker.abandon()
+    _reject(tenant, "busy", HostBusy(
+        f"The {tenant.name} Moodle is busy ({tenant.max_concurrency} requests in flight)",
+        retry_after=tenant.queue_timeout,
+    ))
+
+
+class _Call:
+    """
+    Outcome of a guarded request, filled in by the caller.
+    """
+    status = None
+
+    @property
+    def failed(self):
+        return self.status is not None and (self.status >= 500 or self.status == 429)
+
+
+@contextmanager
+def _observed(tenant, breaker):
+    # Records the outcome of the request in the breaker
+    call = _Call()
+    start = time.perf_counter()
+    UPSTREAM_IN_FLIGHT.inc(university=tenant.name)
+    try:
+        yield call
+    except Exception:
+        breaker.record(failed=True)
+        raise
+    except BaseException:
+        breaker.abandon()
+        raise
+    else:
+        breaker.record(failed=call.failed or time.perf_counter() - start > tenant.slow_call_seconds)
+    finally:
+        UPSTREAM_IN_FLIGHT.dec(university=tenant.name)
+
+
+@contextmanager
+def guard(url):
+    """
+    Sends one request to Moodle under the limits of its tenant: fails fast
+    while its circuit breaker is open, waits for a rate limit token, then
+    holds one of its max_concurrency slots so that a slow Moodle cannot take
+    every worker thread. Hosts that are not configured tenants are not
+    guarded.
+
+    Yields:
+        An object whose `status` is to be set to the response status
+
+    Raises:
+        UpstreamUnavailable: When the request was not sent
+    """
+    tenant = tenant_for_url(url)
+    if tenant is None:
+        yield _Call()
+        return
+    breaker, wait = _admit(tenant)
+    key = (tenant.host, tenant.max_concurrency)
+    with _state_lock:
+        semaphore = _slots.get(key)
+        if semaphore is None:
+            semaphore = _slots[key] = threading.BoundedSemaphore(tenant.max_concurrency)
+    if wait:
+        time.sleep(wait)
+    if not semaphore.acquire(timeout=tenant.queue_timeout):
+        _busy(tenant, breaker)
+    try:
+        with _observed(tenant, breaker) as call:
+            yield call
+    finally:
+        semaphore.release()
+
+
+@asynccontextmanager
+async def aguard(url):
+    """
+    Async counterpart of guard(), whose slots are shared by the coroutines
+    of the running event loop.
+    """
+    tenant = tenant_for_url(url)
+    if tenant is None:
+        yield _Call()
+        return
+    if _reserve_script is not None and tenant.rate_limit:
+        # The Redis round-trip would block the event loop
+        breaker, wait = await asyncio.to_thread(_admit, tenant)
+    else:
+        breaker, wait = _admit(tenant)
+    semaphores = _async_slots.setdefault(asyncio.get_running_loop(), {})
+    key = (tenant.host, tenant.max_concurrency)
+    semaphore = semaphores.get(key)
+    if semaphore is None:
+        semaphore = semaphores[key] = asyncio.Semaphore(tenant.max_concurrency)
+    try:
+        if wait:
+            await asyncio.sleep(wait)
+        await asyncio.wait_for(semaphore.acquire(), tenant.queue_timeout)
+    except asyncio.TimeoutError:
+        _busy(tenant, breaker)
+    except BaseException:
+        breaker.abandon()
+        raise
+    try:
+        with _observed(tenant, breaker) as call:
+            yield call
+    finally:
+        semaphore.release()
+
+
+class GuardedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter sending every request (and redirect) through guard(), with
+    the tenant's timeout unless the caller passed one. Streamed bodies are
+    read after the slot is released.
+    """
+
+    def send(self, request, **kwargs):
+        tenant = tenant_for_url(request.url)
+        if tenant is not None and kwargs.get("timeout") is None:
+            kwargs["timeout"] = tenant.timeout
+        with guard(request.url) as call:
+            response = super().send(request, **kwargs)
+            call.status = response.status_code
+            return response
+
+
+def guarded(session):
+    """
+    Makes a requests session go through the upstream guard.
+    """
+    adapter = GuardedAdapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -0,0 +1,181 @@
+from .hosts import moodle_url
+from .parsing import make_soup
+
+# Web service enabled on most Moodle instances (used by the official mobile app)
+DEFAULT_SERVICE = "moodle_mobile_app"
+
+
+class WebServiceError(RuntimeError):
+    """
+    Error returned by Moodle for a web service call or token request.
+    """
+
+    def __init__(self, message, errorcode=None):
+        super().__init__(message)
+        self.errorcode = errorcode
+
+
+def get_token(session, username, password, university_name, service=DEFAULT_SERVICE):
+    """
+    Obtains a web service token from login/token.php.
+
+    Args:
+        session: The requests session sending the request, going through
+                 the upstream guard of the Moodle
+        username: The Moodle username
+        password: The Moodle password
+        university_name: The university subdomain (e.g. 'bba')
+        service: Short name of the external service
+
+    Returns:
+        str: The web service token
+
+    Raises:
+        WebServiceError: If Moodle refused to issue a token
+    """
+    response = session.post(
+        moodle_url(university_name, "/login/token.php"),
+        data={"username": username, "password": password, "service": service},
+    )
+    response.raise_for_status()
+    data = response.json()
+    if not data.get("token"):
+        raise WebServiceError(f"Could not obtain a web service token: {data.get('error')}", data.get("errorcode"))
+    return data["token"]
+
+
+def _flatten(params, prefix=""):
+    """
+    Encodes nested arguments the way webservice/rest/server.php expects them,
+    e.g. {"options": [{"name": "x"}]} -> {"options[0][name]": "x"}.
+    """
+    flat = {}
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, bool):
+            flat[name] = int(value)
+        else:
+            flat[name] = value
+    return flat
+
+
+class WebServiceClient:
+    """
+    Client of Moodle's REST web service (webservice/rest/server.php).
+    """
+
+    def __init__(self, session, university_name, token):
+        self.session = session
+        self.university_name = university_name
+        self.token = token
+
+    def call(self, wsfunction, **params):
+        """
+        Calls a web service function.
+
+        Raises:
+            WebServiceError: If Moodle returned an exception
+        """
+        response = self.session.post(
+            moodle_url(self.university_name, "/webservice/rest/server.php"),
+            params={"wstoken": self.token, "wsfunction": wsfunction, "moodlewsrestformat": "json"},
+            data=_flatten(params),
+        )
+        response.raise_for_status()
+        data = response.json()
+        if isinstance(data, dict) and data.get("exception"):
+            raise WebServiceError(f"{wsfunction}: {data.get('message')}", data.get("errorcode"))
+        return data
+
+
+def _course_url(client, course_id):
+    return moodle_url(client.university_name, f"/course/view.php?id={course_id}")
+
+
+def get_categories(client, university_name, **kwargs):
+    """
+    Web service counterpart of services.categories.get_categories: two calls
+    instead of one page per category. Crawl options are accepted and ignored.
+
+    Returns:
+        list: Category dicts with id, name, url and subcategories
+    """
+    categories = client.call("core_course_get_categories", addsubcategories=1)
+    courses = client.call("core_course_get_courses_by_field").get("courses", [])
+
+    by_category = {}
+    for course in courses:
+        by_category.setdefault(course.get("categoryid"), []).append({
+            "name": course.get("fullname"),
+            "url": _course_url(client, course.get("id")),
+        })
+
+    return [
+        {
+            "id": str(category["id"]),
+            "name": category.get("name"),
+            "url": moodle_url(university_name, f"/course/index.php?categoryid={category['id']}"),
+            "subcategories": by_category.get(category["id"], []),
+        }
+        for category in sorted(categories, key=lambda c: c.get("sortorder", 0))
+    ]
+
+
+def get_courses(client, id, university_name):
+    """
+    Web service counterpart of services.courses.get_courses.
+
+    Returns:
+        list: Course dicts with name, url and id
+    """
+    courses = client.call("core_course_get_courses_by_field", field="category", value=id).get("courses", [])
+    return [
+        {
+            "name": course.get("fullname"),
+            "url": _course_url(client, course.get("id")),
+            "id": str(course.get("id")),
+        }
+        for course in courses
+    ]
+
+
+def get_chapters(client, id, university_name):
+    """
+    Web service counterpart of services.chapters.get_chapters.
+
+    Returns:
+        dict: The course id, title and sections with their activities
+    """
+    courses = client.call("core_course_get_courses_by_field", field="id", value=id).get("courses", [])
+    contents = client.call("core_course_get_contents", courseid=id)
+
+    sections = []
+    for section in contents:
+        section_data = {
+            "id": str(section.get("id")),
+            "number": str(section.get("section")),
+            "name": section.get("name", ""),
+            "activities": [
+                {
+                    "name": module.get("name"),
+                    "url": module.get("url"),
+                    "id": str(module.get("id")),
+                    "type": module.get("modname"),
+                }
+                for module in section.get("modules", [])
+                if module.get("name") or module.get("url")
+            ],
+        }
+        if section.get("summary"):
+            section_data["summary"] = make_soup(section["summary"]).get_text(" ", strip=True)
+        sections.append(section_data)
+
+    return {
+        "course_id": id,
+        "course_title": courses[0].get("fullname", "") if courses else "",
+        "sections": sections,
+    }
+
@@ -0,0 +1,102 @@
+import io
+import re
+import time
+import zipfile
+
+
+class _Output(io.RawIOBase):
+    """
+    Unseekable sink the archive is written to. The written bytes are kept
+    until drained, so the archive never sits whole in memory or on disk.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def safe_name(name, default="file"):
+    """
+    Makes a string usable as a file or folder name in an archive.
+    """
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", name or "").strip(" .")
+    return name[:150] or default
+
+
+class ZipStream:
+    """
+    Writes a ZIP archive incrementally: each call returns the bytes to send
+    next. Entries are stored uncompressed, as course files (PDF, Office
+    documents, ...) are already compressed.
+    """
+
+    def __init__(self):
+        self._output = _Output()
+        self._zip = zipfile.ZipFile(self._output, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._names = set()
+
+    def unique_name(self, name):
+        """
+        Returns `name`, or `name (2)`, `name (3)`, ... if already in the archive.
+        """
+        stem, dot, extension = name.rpartition(".")
+        if not dot or "/" in extension:
+            stem, dot, extension = name, "", ""
+        candidate = name
+        counter = 2
+        while candidate in self._names:
+            candidate = f"{stem} ({counter}){dot}{extension}"
+            counter += 1
+        self._names.add(candidate)
+        return candidate
+
+    def open(self, name, size):
+        """
+        Starts an entry of `size` bytes; write its content to the returned
+        file object, draining the stream in between, then close it.
+        """
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = size
+        return self._zip.open(info, mode="w")
+
+    def add(self, name, data):
+        """
+        Adds a small in-memory entry.
+
+        Returns:
+            bytes: The archive bytes to send next
+        """
+        with self.open(name, len(data)) as entry:
+            entry.write(data)
+        return self.drain()
+
+    def drain(self):
+        return self._output.drain()
+
+    def close(self):
+        """
+        Writes the central directory.
+
+        Returns:
+            bytes: The last bytes of the archive
+        """
+        self._zip.close()
+        return self.drain()